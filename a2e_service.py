@@ -0,0 +1,261 @@
+"""A2E.ai avatar client and the avatar layout render spec, used by service.py.
+
+A job runs in three steps, so the async service can await the long middle
+one without holding a thread:
+
+    job = submit_avatar_video(script)                 # short POST
+    video_url = track_avatar_video(job).result()      # a Future; the shared poller waits
+    download = open_avatar_video(job, video_url)      # ranged download starts
+
+start_avatar_video() runs all three for blocking callers.
+"""
+import os
+import logging
+from concurrent.futures import Future
+
+import compositor
+from http_client import client
+from media_buffers import MediaBuffer
+from downloader import Download
+from status_poller import poller, JobFailed
+from tts_cache import normalize_script
+from metrics import span
+from callbacks import callback_url
+from provider_scheduler import scheduler, lane, RateLimited, retry_after_seconds
+from job_store import job_store, request_key, SUBMITTED, COMPLETED, DONE, FAILED
+
+logger = logging.getLogger(__name__)
+
+# Configuration (replace with your actual API key and settings)
+API_KEY = os.getenv('A2E_API_KEY')  # Set this in your environment variables
+AVATAR_ID = "68511a9dd4c7e25449f07b92"  # Default avatar ID
+API_URL = os.getenv('A2E_API_URL', "https://video.a2e.ai")  # Point at mock_providers.py for local runs
+
+def a2e_headers():
+    return {
+        'Authorization': f'Bearer {API_KEY}',
+        'Content-Type': 'application/json'
+    }
+
+async def check_a2e_job(session, job_id):
+    """Status check for the shared poller: maps an A2E job to (status, video_url or error)."""
+    async with session.get(f"{API_URL}/api/v1/job/{job_id}", headers=a2e_headers()) as resp:
+        if resp.status == 429:
+            raise RateLimited(retry_after_seconds(resp.headers))
+        status_data = await resp.json(content_type=None)
+    if status_data['status'] == 'completed':
+        video_url = status_data['result'].get('video_url')
+        if not video_url:
+            return 'failed', "No video URL in completed job response"
+        return 'completed', video_url
+    if status_data['status'] in ('failed', 'cancelled'):
+        return 'failed', status_data.get('error', 'Unknown error')
+    return 'pending', None
+
+def parse_a2e_callback(payload):
+    """Webhook body for the shared poller: maps it to (job_id, status, video_url or error)."""
+    job_id = payload.get('job_id')
+    if payload.get('status') == 'completed':
+        video_url = (payload.get('result') or {}).get('video_url')
+        if not video_url:
+            return job_id, 'failed', "No video URL in completed job callback"
+        return job_id, 'completed', video_url
+    if payload.get('status') in ('failed', 'cancelled'):
+        return job_id, 'failed', payload.get('error', 'Unknown error')
+    return job_id, 'pending', None
+
+poller.register_provider('a2e', check_a2e_job, parse_callback=parse_a2e_callback)
+
+def create_avatar_video(script):
+    """Run the A2E job for script and download the result. Returns a MediaBuffer."""
+    download = start_avatar_video(script)
+    try:
+        with span('download'):
+            return download.wait()
+    except Exception:
+        download.media.close()
+        raise
+    finally:
+        download.close()
+
+def start_avatar_video(script):
+    """Run the A2E job for script and start downloading the result. Returns the running Download.
+
+    A job recorded for the same script (by this or another worker, before or
+    after a restart) is reused instead of paying for a new one.
+    """
+    for reuse in (True, False):
+        job = submit_avatar_video(script, reuse)
+        try:
+            with span('a2e_wait'):
+                video_url = track_avatar_video(job).result()
+            return open_avatar_video(job, video_url)
+        except Exception as e:
+            if job['owned']:
+                raise
+            logger.warning(f"Could not reuse A2E job {job['job_id']}: {str(e)}, submitting a new one")
+
+def submit_avatar_video(script, reuse=True):
+    """Submit an A2E job for script, or pick up one recorded for the same script.
+
+    Returns the job for track_avatar_video(). A job submitted here ('owned')
+    holds one of A2E's concurrent job slots until its result is in; batch
+    jobs queue for it behind interactive ones.
+    """
+    # Heartbeats and recovery start with the first job, not at import
+    job_store.start()
+    key = request_key('a2e', AVATAR_ID, normalize_script(script))
+    record = job_store.find('a2e', key) if reuse else None
+    if record:
+        path = record['artifacts'].get('path')
+        return {'record_id': record['id'], 'job_id': record['provider_job_id'],
+                'video_url': record['artifacts'].get('video_url'),
+                'path': path if path and os.path.exists(path) else None,
+                'owned': False, 'callback': False}
+
+    # Generate avatar video with A2E.ai API
+    headers = a2e_headers()
+    payload = {
+        "title": "marketing clip",
+        "anchor_id": AVATAR_ID,
+        "text": script,
+        "resolution": 1080,
+        "voice_settings": {
+            "language": "en-US",
+            "speaker": "default"
+        },
+        "background": {
+            "type": "color",
+            "value": "rgba(255,255,255,1)"
+        }
+    }
+    # Completion webhook (when CALLBACK_BASE_URL is set) instead of status polling
+    webhook = callback_url('a2e')
+    if webhook:
+        payload["callback_url"] = webhook
+
+    generate_url = f"{API_URL}/api/v1/video/generate"
+    scheduler.acquire_slot('a2e')
+    record_id = job_store.create('a2e', key)
+    try:
+        logger.info("Sending POST request to A2E.ai API.")
+        with span('a2e_submit'):
+            resp = scheduler.call('a2e', lambda: client.post(generate_url, headers=headers, json=payload))
+        if resp.status_code != 200:
+            raise Exception(f"API Error: {resp.status_code} - {resp.text}")
+        job_id = resp.json().get("job_id")
+        if not job_id:
+            raise Exception("No job ID returned from API")
+    except Exception as e:
+        scheduler.release_slot('a2e')
+        job_store.update(record_id, stage=FAILED, error=str(e))
+        raise
+    logger.info(f"Job ID received: {job_id}")
+    job_store.update(record_id, stage=SUBMITTED, provider_job_id=job_id)
+    return {'record_id': record_id, 'job_id': job_id, 'video_url': None, 'path': None,
+            'owned': True, 'callback': bool(webhook)}
+
+def track_avatar_video(job):
+    """Return a Future resolved with the job's video URL (None when a saved file is reused).
+
+    The shared poller multiplexes all in-flight jobs. When an owned job
+    resolves, its slot is given back and its record updated.
+    """
+    result = Future()
+    if job['path'] or job['video_url']:
+        result.set_result(job['video_url'])
+        return result
+
+    def settle(future):
+        if job['owned']:
+            scheduler.release_slot('a2e')
+        error = future.exception()
+        if error is None:
+            logger.info(f"Video URL received: {future.result()}")
+            if job['owned']:
+                job_store.update(job['record_id'], stage=COMPLETED, video_url=future.result())
+            result.set_result(future.result())
+            return
+        if isinstance(error, JobFailed):
+            # Failed for good: later requests must not reuse it
+            job_store.update(job['record_id'], stage=FAILED, error=str(error))
+        elif job['owned']:
+            # The job may still finish: leave it to recovery, which keeps the result for a retry
+            job_store.update(job['record_id'], release=True)
+        if isinstance(error, TimeoutError):
+            error = Exception("Timed out waiting for video generation.")
+        result.set_exception(error)
+
+    poller.track('a2e', job['job_id'], timeout=300, callback=job['callback']).add_done_callback(settle)
+    return result
+
+def open_avatar_video(job, video_url):
+    """Start a Download of the job's result: its saved file, or video_url."""
+    if job['path']:
+        logger.info(f"Reusing saved video of A2E job {job['job_id']}")
+        with open(job['path'], 'rb') as f:
+            return Download.completed(MediaBuffer.from_stream(f, '.mp4'))
+    if not job['owned']:
+        logger.info(f"Reusing A2E job {job['job_id']}")
+    return download_avatar_video(job['record_id'], video_url)
+
+def download_avatar_video(record_id, video_url):
+    """Start downloading a job's result; the job is done once it arrived, else recovery retries it."""
+    def finished(error):
+        if error is None:
+            job_store.update(record_id, stage=DONE)
+        else:
+            job_store.update(record_id, stage=COMPLETED, release=True)
+
+    # Download the avatar video into a media buffer (memory-backed unless IN_MEMORY_MEDIA=0)
+    # over parallel, resumable Range requests
+    avatar_video = MediaBuffer('.mp4')
+    logger.info(f"Downloading video from {video_url}")
+    try:
+        return Download(video_url, avatar_video, on_complete=finished).start()
+    except Exception as e:
+        avatar_video.close()
+        finished(e)
+        raise
+
+def resume_a2e_job(record):
+    """Finish an A2E job orphaned by a stopped worker and save the video for the request's retry"""
+    video_url = record['artifacts'].get('video_url')
+    if not video_url:
+        # The job still occupies an A2E slot; recovery queues behind interactive work
+        with lane('batch'), scheduler.slot('a2e'):
+            try:
+                video_url = poller.wait('a2e', record['provider_job_id'], timeout=300)
+            except TimeoutError:
+                raise Exception("Timed out waiting for video generation.")
+        job_store.update(record['id'], stage=COMPLETED, video_url=video_url)
+    with MediaBuffer('.mp4') as media:
+        download = Download(video_url, media).start()
+        try:
+            download.wait()
+        finally:
+            download.close()
+        path = job_store.save_artifact(record['id'], media.path, '.mp4')
+    job_store.update(record['id'], stage=DONE, path=path)
+
+job_store.register_resumer('a2e', resume_a2e_job)
+
+def variant_spec(avatar_video, product, background, background_color, output, avatar_streams=None,
+                 profile=None):
+    """Render spec for one product/background layout around the avatar video"""
+    video_size = compositor.VIDEO_SIZE
+    spec = {
+        'layout': 'avatar',
+        'output_path': output.path,
+        'avatar_path': avatar_video.path,
+        'background_path': background.path if background else None,
+        'background_color': background_color,
+        'product_path': product.path,
+        'product_width': video_size[0]//2,
+        'avatar_width': video_size[0]//4,
+        'fragmented': True,
+        'profile': profile,
+    }
+    # Pipes replaying an avatar that is still downloading
+    spec.update(avatar_streams or {})
+    return spec
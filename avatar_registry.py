@@ -0,0 +1,130 @@
+import io
+import os
+import time
+import sqlite3
+import logging
+import threading
+from contextlib import closing, contextmanager
+
+logger = logging.getLogger(__name__)
+
+AVATAR_DB_PATH = os.getenv('AVATAR_DB_PATH', 'avatars.db')
+# Max differing bits (of 64) for two images to count as the same presenter photo
+AVATAR_HASH_THRESHOLD = int(os.getenv('AVATAR_HASH_THRESHOLD', '6'))
+# Seconds an avatar_id is reused before a fresh one is created
+AVATAR_TTL = int(os.getenv('AVATAR_TTL', str(7 * 24 * 3600)))
+
+
+def perceptual_hash(image_bytes):
+    """64-bit difference hash: robust to re-encoding, resizing and small color shifts"""
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        # Let the JPEG decoder downscale instead of decoding full resolution
+        img.draft('L', (64, 64))
+        small = img.convert('L').resize((9, 8), Image.LANCZOS)
+        pixels = list(small.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class AvatarRegistry:
+    """Persistent map of image perceptual hash -> provider avatar_id"""
+
+    def __init__(self, path=AVATAR_DB_PATH, threshold=AVATAR_HASH_THRESHOLD, ttl=AVATAR_TTL):
+        self.path = path
+        self.threshold = threshold
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS avatars ("
+                " provider TEXT NOT NULL,"
+                " phash TEXT NOT NULL,"
+                " avatar_id TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " last_used REAL NOT NULL,"
+                " uses INTEGER NOT NULL DEFAULT 0,"
+                " PRIMARY KEY (provider, phash))"
+            )
+
+    @contextmanager
+    def _connect(self):
+        """Connection for one transaction: committed (or rolled back) and closed on exit"""
+        with closing(sqlite3.connect(self.path, timeout=10)) as conn, conn:
+            yield conn
+
+    def lookup(self, provider, image_bytes):
+        """Return (avatar_id or None, phash) for the closest unexpired match"""
+        phash = perceptual_hash(image_bytes)
+        cutoff = time.time() - self.ttl
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT phash, avatar_id FROM avatars WHERE provider = ? AND created_at >= ?",
+                (provider, cutoff),
+            ).fetchall()
+            best = None
+            for stored_hash, avatar_id in rows:
+                distance = hamming(phash, int(stored_hash, 16))
+                if distance <= self.threshold and (best is None or distance < best[0]):
+                    best = (distance, stored_hash, avatar_id)
+            if best:
+                conn.execute(
+                    "UPDATE avatars SET last_used = ?, uses = uses + 1 WHERE provider = ? AND phash = ?",
+                    (time.time(), provider, best[1]),
+                )
+        with self.lock:
+            if best:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if best:
+            logger.info(f"Avatar cache hit for {provider}: {best[2]} (distance {best[0]})")
+            return best[2], phash
+        return None, phash
+
+    def register(self, provider, phash, avatar_id):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO avatars (provider, phash, avatar_id, created_at, last_used, uses)"
+                " VALUES (?, ?, ?, ?, ?, 0)",
+                (provider, f"{phash:016x}", avatar_id, now, now),
+            )
+            conn.execute("DELETE FROM avatars WHERE created_at < ?", (now - self.ttl,))
+
+    def get_or_create(self, provider, image_bytes, create):
+        """Return a cached avatar_id for a similar image, or call create(image_bytes) and remember it"""
+        avatar_id, phash = self.lookup(provider, image_bytes)
+        if avatar_id:
+            return avatar_id
+        avatar_id = create(image_bytes)
+        self.register(provider, phash, avatar_id)
+        return avatar_id
+
+    def stats(self):
+        with self._connect() as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM avatars").fetchone()[0]
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+# Shared registry used by generate_video.py and heygen_service.py
+avatar_registry = AvatarRegistry()
@@ -0,0 +1,93 @@
+"""Benchmark the streaming compositor against the MoviePy CompositeVideoClip path.
+
+    python bench_compositor.py [--seconds 5] [--repeat 2]
+
+Uses sample_image.png as product and background and a generated avatar clip.
+"""
+import os
+import time
+import argparse
+import tempfile
+import subprocess
+
+import compositor
+from mock_providers import ensure_mock_video
+
+
+def moviepy_avatar(avatar_path, product_path, output_path):
+    from moviepy.editor import ImageClip, ColorClip, CompositeVideoClip, VideoFileClip
+    video_size = compositor.VIDEO_SIZE
+    avatar_clip = VideoFileClip(avatar_path)
+    background = ColorClip(size=video_size, color=[211, 211, 211]).set_duration(avatar_clip.duration)
+    avatar_clip = avatar_clip.resize(width=video_size[0]//4).set_position(('left', 'bottom'))
+    product_clip = ImageClip(product_path).set_duration(avatar_clip.duration).resize(width=video_size[0]//2).set_position('center')
+    final_clip = CompositeVideoClip([background, product_clip, avatar_clip], size=video_size).set_audio(avatar_clip.audio)
+    final_clip.write_videofile(output_path, fps=24, codec='libx264', audio_codec='aac', logger=None)
+    final_clip.close()
+
+
+def moviepy_still(audio_path, product_path, output_path):
+    from moviepy.editor import ImageClip, AudioFileClip, ColorClip, CompositeVideoClip
+    video_size = compositor.VIDEO_SIZE
+    audio = AudioFileClip(audio_path)
+    background = ColorClip(size=video_size, color=[211, 211, 211]).set_duration(audio.duration)
+    product = ImageClip(product_path).set_duration(audio.duration).resize(width=int(video_size[0] * 0.8))
+    product = product.set_position(('center', 'center'))
+    video = CompositeVideoClip([background, product], size=video_size).set_audio(audio)
+    video.write_videofile(output_path, fps=24, codec='libx264', audio_codec='aac', logger=None)
+    video.close()
+
+
+def streaming_avatar(avatar_path, product_path, output_path):
+    video_size = compositor.VIDEO_SIZE
+    base = compositor.build_base_frame(video_size, None, '#D3D3D3', product_path, video_size[0]//2)
+    compositor.render_avatar_video(avatar_path, output_path, base, avatar_width=video_size[0]//4)
+
+
+def streaming_still(audio_path, product_path, output_path):
+    video_size = compositor.VIDEO_SIZE
+    base = compositor.build_base_frame(video_size, None, '#D3D3D3', product_path, int(video_size[0] * 0.8))
+    compositor.render_still_video(base, audio_path, output_path)
+
+
+def timed(fn, *args, repeat=1):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--repeat', type=int, default=2)
+    parser.add_argument('--product', default='sample_image.png')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        avatar = ensure_mock_video(os.path.join(workdir, 'avatar.mp4'), seconds=args.seconds)
+        audio = os.path.join(workdir, 'voice.mp3')
+        subprocess.run([compositor.ffmpeg_exe(), '-y', '-loglevel', 'error', '-f', 'lavfi',
+                        '-i', f'sine=frequency=300:duration={args.seconds}', audio], check=True)
+        out = os.path.join(workdir, 'out.mp4')
+
+        rows = [
+            ('avatar', 'moviepy', timed(moviepy_avatar, avatar, args.product, out, repeat=args.repeat)),
+            ('avatar', 'streaming', timed(streaming_avatar, avatar, args.product, out, repeat=args.repeat)),
+            ('still', 'moviepy', timed(moviepy_still, audio, args.product, out, repeat=args.repeat)),
+            ('still', 'streaming', timed(streaming_still, audio, args.product, out, repeat=args.repeat)),
+        ]
+
+    print(f"{args.seconds:g}s clip at 1080x1080, 24 fps (best of {args.repeat})")
+    print(f"{'layout':<8} {'engine':<10} {'seconds':>8} {'speedup':>8}")
+    baseline = {}
+    for layout, engine, elapsed in rows:
+        baseline.setdefault(layout, elapsed)
+        print(f"{layout:<8} {engine:<10} {elapsed:>8.2f} {baseline[layout] / elapsed:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
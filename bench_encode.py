@@ -0,0 +1,69 @@
+"""Compare encode profiles: render time against file size on the sample assets.
+
+    python bench_encode.py [--runs 3] [--product sample_image.png] [--profiles before preview balanced archival]
+
+Renders both layouts (avatar clip and still image with speech) with every
+profile in-process, using the mock provider's canned clip and speech as
+the avatar and audio. Wall and CPU time include ffmpeg. The 'before' row
+is the fixed setting used before profiles existed (preset medium, no tune).
+"""
+import os
+import argparse
+
+import compositor
+from render_pool import run_render
+from media_buffers import MediaBuffer
+from mock_providers import ensure_mock_video, ensure_mock_audio
+
+# The settings every render used before encode profiles
+BEFORE = {'preset': 'medium', 'crf': 23, 'tune': None, 'scale': 1.0,
+          'keyframe_seconds': None, 'threads': 0, 'audio_bitrate': '128k'}
+
+
+def bench(spec, runs):
+    """Best-of-runs render result, with the output size in bytes"""
+    best = None
+    for _ in range(runs):
+        with MediaBuffer('.mp4') as output:
+            result = run_render(dict(spec, output_path=output.path))
+            result['bytes'] = output.size()
+        if best is None or result['wall_seconds'] < best['wall_seconds']:
+            best = result
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--product', default='sample_image.png')
+    parser.add_argument('--profiles', nargs='+', default=['before'] + list(compositor.ENCODE_PROFILES))
+    args = parser.parse_args()
+    compositor.ENCODE_PROFILES.setdefault('before', BEFORE)
+
+    avatar_path = os.path.abspath(ensure_mock_video())
+    audio_path = os.path.abspath(ensure_mock_audio())
+    _, _, seconds = compositor.probe_video(avatar_path)
+    width = compositor.VIDEO_SIZE[0]
+    layouts = {
+        'avatar': {'layout': 'avatar', 'avatar_path': avatar_path, 'product_path': args.product,
+                   'product_width': width // 2, 'avatar_width': width // 4},
+        'still': {'layout': 'still', 'audio_path': audio_path, 'product_path': args.product,
+                  'product_width': int(width * 0.8)},
+    }
+
+    print(f"{seconds:.1f}s clip, best of {args.runs}")
+    print(f"{'layout':<8} {'profile':<10} {'size':>9} {'preset':<10} {'crf':>4} "
+          f"{'wall s':>7} {'cpu s':>7} {'x realtime':>10} {'KB':>7} {'kbit/s':>7} {'peak MB':>8}")
+    for layout, spec in layouts.items():
+        for name in args.profiles:
+            profile = compositor.get_profile(name)
+            size = compositor.profile_size(profile)
+            result = bench(dict(spec, profile=name), args.runs)
+            print(f"{layout:<8} {name:<10} {size[0]:>4}x{size[1]:<4} {profile['preset']:<10} {profile['crf']:>4} "
+                  f"{result['wall_seconds']:>7.2f} {result['cpu_seconds']:>7.2f} "
+                  f"{seconds / result['wall_seconds']:>10.1f} {result['bytes'] // 1024:>7} "
+                  f"{result['bytes'] * 8 / 1000 / seconds:>7.0f} {result['peak_rss_bytes'] // 2 ** 20:>8}")
+
+
+if __name__ == '__main__':
+    main()
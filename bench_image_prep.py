@@ -0,0 +1,88 @@
+"""Compare image preparation before and after the size-aware fast path.
+
+    python bench_image_prep.py [--runs 10] [--images sample_image.png sample_image.jpg] [--max-side 1280]
+
+Times the upload preprocessing (full decode + re-encode vs prepare_jpeg
+called exactly as generate_video.preprocess_image does, with
+AVATAR_IMAGE_MAX_SIDE), reports the avatar upload size, and times the
+product/background layer decode used for compositing (full decode +
+resize vs layer_cache, cold and warm). --max-side adds a row for
+preprocessing with that cap, to see what setting AVATAR_IMAGE_MAX_SIDE
+would cost.
+"""
+import io
+import time
+import argparse
+
+from PIL import Image
+
+import compositor
+from image_prep import prepare_jpeg, LayerCache, AVATAR_IMAGE_MAX_SIDE
+
+
+def old_preprocess(image_bytes, quality=95):
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        rgb_image = img.convert("RGB")
+        output_buffer = io.BytesIO()
+        rgb_image.save(output_buffer, format="JPEG", quality=quality)
+        return output_buffer.getvalue()
+
+
+def old_layers(path, size, product_width):
+    with Image.open(path) as bg:
+        bg.convert('RGB').resize(size, Image.LANCZOS)
+    with Image.open(path) as product:
+        product = product.convert('RGBA')
+        height = int(product.height * product_width / product.width)
+        product.resize((product_width, height), Image.LANCZOS)
+
+
+def new_layers(cache, path, size, product_width):
+    cache.load(path, size=size)
+    cache.load(path, width=product_width, mode='RGBA')
+
+
+def timed(fn, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        fn()
+    return (time.perf_counter() - start) / runs * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--images', nargs='+', default=['sample_image.png', 'sample_image.jpg'])
+    parser.add_argument('--max-side', type=int, default=0, help='also time preprocessing with this cap')
+    args = parser.parse_args()
+
+    size = compositor.VIDEO_SIZE
+    product_width = size[0] // 2
+    print(f"{'image':<18} {'stage':<26} {'before ms':>10} {'after ms':>10}")
+    for path in args.images:
+        with open(path, 'rb') as f:
+            data = f.read()
+        baseline = timed(lambda: old_preprocess(data), args.runs)
+        rows = [
+            # The production call (generate_video.preprocess_image)
+            (f'preprocess (max {AVATAR_IMAGE_MAX_SIDE}px)' if AVATAR_IMAGE_MAX_SIDE else 'preprocess (no cap)', baseline,
+             timed(lambda: prepare_jpeg(data, quality=95, max_side=AVATAR_IMAGE_MAX_SIDE), args.runs)),
+        ]
+        if args.max_side:
+            rows.append((f'preprocess (max {args.max_side}px)', baseline,
+                         timed(lambda: prepare_jpeg(data, quality=95, max_side=args.max_side), args.runs)))
+        rows.append(('layers, cold cache', timed(lambda: old_layers(path, size, product_width), args.runs),
+                     timed(lambda: new_layers(LayerCache(), path, size, product_width), args.runs)))
+        warm = LayerCache()
+        new_layers(warm, path, size, product_width)
+        rows.append(('layers, warm cache', rows[-1][1],
+                     timed(lambda: new_layers(warm, path, size, product_width), args.runs)))
+        for stage, before, after in rows:
+            print(f"{path:<18} {stage:<26} {before:>10.1f} {after:>10.1f}")
+        before_kb = len(old_preprocess(data)) // 1024
+        after_kb = len(prepare_jpeg(data, quality=95, max_side=AVATAR_IMAGE_MAX_SIDE)) // 1024
+        print(f"{path:<18} {'avatar upload size KB':<26} {before_kb:>10} {after_kb:>10}")
+
+
+if __name__ == '__main__':
+    main()
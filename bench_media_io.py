@@ -0,0 +1,67 @@
+"""Measure the disk I/O saved by in-memory media buffers.
+
+    python bench_media_io.py [--runs 3] [--seconds 3]
+
+Runs the app.py media path (buffer the uploads, download the avatar,
+composite, read the output back for sending) with disk-backed and
+memory-backed buffers and reports wall time and bytes staged on disk.
+"""
+import io
+import os
+import time
+import argparse
+import tempfile
+
+import compositor
+import media_buffers
+from media_buffers import MediaBuffer
+from mock_providers import ensure_mock_video
+
+
+def run_pipeline(product_bytes, avatar_bytes, in_memory):
+    product = MediaBuffer.from_stream(io.BytesIO(product_bytes), '.png', in_memory=in_memory)
+    avatar = MediaBuffer('.mp4', in_memory=in_memory)
+    with avatar.open('wb') as f:
+        for offset in range(0, len(avatar_bytes), 8192):
+            f.write(avatar_bytes[offset:offset + 8192])
+    output = MediaBuffer('.mp4', in_memory=in_memory)
+    size = compositor.VIDEO_SIZE
+    base = compositor.build_base_frame(size, None, '#D3D3D3', product.path, size[0]//2)
+    compositor.render_avatar_video(avatar.path, output.path, base, avatar_width=size[0]//4)
+    with output.open('rb') as f:
+        while f.read(1024 * 1024):
+            pass
+    for media in (product, avatar, output):
+        media.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument('--product', default='sample_image.png')
+    args = parser.parse_args()
+
+    with open(args.product, 'rb') as f:
+        product_bytes = f.read()
+    with tempfile.TemporaryDirectory() as workdir:
+        avatar_path = ensure_mock_video(os.path.join(workdir, 'avatar.mp4'), seconds=args.seconds)
+        with open(avatar_path, 'rb') as f:
+            avatar_bytes = f.read()
+
+    print(f"{'mode':<8} {'runs':>4} {'seconds/run':>12} {'disk files':>11} {'disk MB':>8} {'memory MB':>10}")
+    for mode, in_memory in (('disk', False), ('memory', True)):
+        before = media_buffers.stats()
+        start = time.perf_counter()
+        for _ in range(args.runs):
+            run_pipeline(product_bytes, avatar_bytes, in_memory)
+        elapsed = (time.perf_counter() - start) / args.runs
+        after = media_buffers.stats()
+        disk_files = after['disk_files'] - before['disk_files']
+        disk_mb = (after['disk_bytes'] - before['disk_bytes']) / 1e6
+        memory_mb = (after['memory_bytes'] - before['memory_bytes']) / 1e6
+        print(f"{mode:<8} {args.runs:>4} {elapsed:>12.2f} {disk_files:>11} {disk_mb:>8.2f} {memory_mb:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,508 @@
+"""Offline load benchmark for the video services against mock providers.
+
+    python bench_service.py [--target a2e still heygen service-heygen]
+                            [--requests 20] [--concurrency 4]
+                            [--job-duration 2] [--latency 0.05] [--failure-rate 0] [--rate-limit 0]
+                            [--batches 0 --batch-variants 4]
+                            [--json results.json] [--baseline results.json --max-regression 0.2]
+
+Starts mock_providers.py and, per target, the app under test in
+subprocesses, with every cache and canned payload in a temporary
+directory so nothing is spent on real APIs:
+
+    a2e     app.py under uvicorn: POST / then read the stream URL until the
+            video is done
+    still   appp.py under uvicorn: POST / and read the streamed video (gTTS
+            is pre-seeded in the speech cache, since gTTS has no
+            configurable endpoint)
+    heygen  generate_video.generate_talking_video in this process: Azure
+            TTS, tmpfiles, avatar and video jobs
+    service-heygen
+            the same HeyGen work through service.py: POST /jobs then read
+            the stream URL until the downloaded video is done
+
+With --batches the a2e target first queues that many /batch requests
+(each its own A2E job, in the batch lane), so the report's
+render_backlog.interactive and render_backlog.batch stages show how long
+interactive renders wait while batch work is running.
+
+Every request uses a unique script (still: a unique background color) so
+the output cache never hides the work. Reports p50/p95/p99 latency, time to first byte, throughput, peak
+RSS of the whole process tree, CPU split between the web process, render
+workers and ffmpeg, CPU per stage (compositing and encoding from the render
+pool's render_cpu_seconds_total; TTS, uploads, provider waits and streaming
+all run in the web process, so they share its line) and the mean wall time
+per stage from /metrics. With
+--baseline the run fails (exit 1) when p95 latency or throughput regress
+by more than --max-regression.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STILL_SCRIPT = 'Benchmark voiceover for the still layout.'
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(argv, port, env, log_path, ready_path='/metrics'):
+    log = open(log_path, 'w')
+    process = subprocess.Popen([sys.executable] + argv, cwd=HERE, env=env, stdout=log,
+                               stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise Exception(f"Server exited early, see {log_path}")
+        try:
+            requests.get(url + ready_path, timeout=1)
+            return process, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.kill()
+    raise Exception(f"Server did not start, see {log_path}")
+
+
+def process_tree(pid):
+    """pid and all of its descendants"""
+    pids = [pid]
+    for current in pids:
+        try:
+            for tid in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{tid}/children") as f:
+                    pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue
+    return pids
+
+
+def read_stat(pid):
+    """(utime + stime, cutime + cstime) in seconds"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return ((int(fields[11]) + int(fields[12])) / CLOCK_TICKS,
+            (int(fields[13]) + int(fields[14])) / CLOCK_TICKS)
+
+
+def cpu_split(pid):
+    """CPU seconds of the web process, its direct children (render workers) and their reaped children (ffmpeg)"""
+    own, _ = read_stat(pid)
+    workers = ffmpeg = 0.0
+    for child in process_tree(pid)[1:]:
+        try:
+            with open(f"/proc/{child}/stat") as f:
+                parent = int(f.read().rsplit(')', 1)[1].split()[1])
+            if parent != pid:
+                continue
+            cpu, reaped = read_stat(child)
+        except OSError:
+            continue
+        workers += cpu
+        ffmpeg += reaped
+    return {'web': own, 'workers': workers, 'ffmpeg': ffmpeg}
+
+
+class RssSampler(threading.Thread):
+    """Samples the resident set of a process tree and keeps the peak"""
+
+    def __init__(self, pid, interval=0.05):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            total = 0
+            for pid in process_tree(self.pid):
+                try:
+                    with open(f"/proc/{pid}/statm") as f:
+                        total += int(f.read().split()[1]) * PAGE_SIZE
+                except OSError:
+                    pass
+            self.peak = max(self.peak, total)
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.peak
+
+
+def parse_stages(text):
+    """{stage: [sum, count]} from video_stage_seconds in Prometheus text"""
+    stages = {}
+    for line in text.splitlines():
+        if not line.startswith(('video_stage_seconds_sum', 'video_stage_seconds_count')):
+            continue
+        name, value = line.rsplit(' ', 1)
+        stage = name.split('stage="', 1)[1].split('"', 1)[0]
+        entry = stages.setdefault(stage, [0.0, 0])
+        if name.startswith('video_stage_seconds_sum'):
+            entry[0] += float(value)
+        else:
+            entry[1] += int(float(value))
+    return stages
+
+
+def parse_render_cpu(text):
+    """{part: seconds} from render_cpu_seconds_total in Prometheus text"""
+    parts = {}
+    for line in text.splitlines():
+        if line.startswith('render_cpu_seconds_total{'):
+            name, value = line.rsplit(' ', 1)
+            parts[name.split('part="', 1)[1].split('"', 1)[0]] = float(value)
+    return parts
+
+
+def stage_cpu(cpu, before_text, after_text):
+    """CPU seconds per stage between two /metrics scrapes, given the process CPU split over the same run"""
+    before, after = parse_render_cpu(before_text), parse_render_cpu(after_text)
+    render = {part: after[part] - before.get(part, 0.0) for part in after}
+    composite = render.get('python', 0.0)
+    return {
+        'composite': composite,
+        'encode': render.get('ffmpeg', 0.0),
+        # Worker time outside renders: reading specs, pickling results, idle polling
+        'worker_other': max(0.0, cpu['workers'] - composite),
+        'web': cpu['web'],
+    }
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))]
+
+
+def post_a2e(url, index, product):
+    start = time.perf_counter()
+    resp = requests.post(url + '/', files={'product_image': ('product.png', product)},
+                         data={'script': f"Benchmark request {index} {time.time()}"})
+    if resp.status_code == 429:
+        return 'rejected', None, None
+    resp.raise_for_status()
+    return read_video(url + resp.json()['stream_url'], start)
+
+
+def post_still(url, index, product):
+    start = time.perf_counter()
+    resp = requests.post(url + '/', files={'product_image': ('product.png', product)},
+                         data={'script': STILL_SCRIPT, 'background_color': f"#{index + 1:06x}"}, stream=True)
+    if resp.status_code == 429:
+        return 'rejected', None, None
+    return consume(resp, start)
+
+
+def post_service_heygen(url, index, product):
+    start = time.perf_counter()
+    resp = requests.post(url + '/jobs', files={'product_image': ('product.png', product)},
+                         data={'script': f"Benchmark request {index} {time.time()}", 'backend': 'heygen'})
+    if resp.status_code == 429:
+        return 'rejected', None, None
+    resp.raise_for_status()
+    return read_video(url + resp.json()['stream_url'], start)
+
+
+def post_batches(url, count, variants, product):
+    """Queue background batches so the interactive load competes with batch-lane work"""
+    manifest = json.dumps({'variants': [{'product_image': 'product.png'}] * variants})
+    for index in range(count):
+        resp = requests.post(url + '/batch', files=[('images', ('product.png', product))],
+                             data={'script': f"Background batch {index} {time.time()}", 'manifest': manifest})
+        resp.raise_for_status()
+
+
+def read_video(url, start):
+    while True:
+        resp = requests.get(url, stream=True)
+        # 409 until the render has started
+        if resp.status_code != 409:
+            return consume(resp, start)
+        resp.close()
+        time.sleep(float(resp.headers.get('Retry-After', '1')))
+
+
+def consume(resp, start):
+    with resp:
+        resp.raise_for_status()
+        first_byte = None
+        size = 0
+        for chunk in resp.iter_content(256 * 1024):
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+            size += len(chunk)
+    if not size:
+        raise Exception("Empty video")
+    return 'ok', time.perf_counter() - start, first_byte
+
+
+def run_heygen(index, product):
+    import generate_video
+    start = time.perf_counter()
+    generate_video.generate_talking_video(product, f"Benchmark request {index} {time.time()}")
+    return 'ok', time.perf_counter() - start, None
+
+
+def warm_up(fn, attempts=5):
+    for _ in range(attempts):
+        try:
+            fn()
+            return
+        except Exception:
+            continue
+    raise Exception(f"Warm-up failed {attempts} times; check the failure rates")
+
+
+def run_load(fn, total, concurrency):
+    results = []
+
+    def one(index):
+        try:
+            return fn(index)
+        except Exception as e:
+            return 'failed', None, str(e)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one, range(total)))
+    return results, time.perf_counter() - start
+
+
+def summarize(target, results, elapsed, peak_rss, cpu, stages, stages_cpu):
+    latencies = [r[1] for r in results if r[0] == 'ok']
+    first_bytes = [r[2] for r in results if r[0] == 'ok' and r[2] is not None]
+    errors = sorted({r[2] for r in results if r[0] == 'failed'})
+    return {
+        'target': target,
+        'requests': len(results),
+        'ok': len(latencies),
+        'failed': sum(1 for r in results if r[0] == 'failed'),
+        'rejected': sum(1 for r in results if r[0] == 'rejected'),
+        'errors': errors[:5],
+        'throughput': round(len(latencies) / elapsed, 3),
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'ttfb_p50': percentile(first_bytes, 50),
+        'peak_rss_mb': round(peak_rss / 1024 / 1024, 1),
+        'cpu_seconds': {part: round(value, 2) for part, value in cpu.items()},
+        'stage_cpu_seconds': {stage: round(value, 2) for stage, value in stages_cpu.items()},
+        'stages': {stage: {'count': count, 'mean_seconds': round(total / count, 3)}
+                   for stage, (total, count) in sorted(stages.items()) if count},
+    }
+
+
+def bench_server(target, code, env, workdir, args, product):
+    port = free_port()
+    process, url = start_server(['-c', code.format(port=port)], port, env, os.path.join(workdir, f"{target}.log"))
+    fn = {
+        'a2e': post_a2e,
+        'still': post_still,
+        'service-heygen': post_service_heygen,
+    }[target]
+    try:
+        # Warm up: starts the render workers and fills per-process caches
+        warm_up(lambda: fn(url, -1, product))
+        before_cpu = cpu_split(process.pid)
+        before_metrics = requests.get(url + '/metrics').text
+        before_stages = parse_stages(before_metrics)
+        sampler = RssSampler(process.pid)
+        sampler.start()
+        if target == 'a2e' and args.batches:
+            post_batches(url, args.batches, args.batch_variants, product)
+        results, elapsed = run_load(lambda i: fn(url, i, product), args.requests, args.concurrency)
+        peak = sampler.stop()
+        # Render callbacks may land just after the last response finished
+        time.sleep(0.5)
+        after_cpu = cpu_split(process.pid)
+        after_metrics = requests.get(url + '/metrics').text
+        stages = parse_stages(after_metrics)
+    finally:
+        process.terminate()
+        process.wait()
+    for stage, (total, count) in before_stages.items():
+        stages[stage] = [stages[stage][0] - total, stages[stage][1] - count]
+    cpu = {part: after_cpu[part] - before_cpu[part] for part in after_cpu}
+    return summarize(target, results, elapsed, peak, cpu, stages, stage_cpu(cpu, before_metrics, after_metrics))
+
+
+def bench_heygen(args, product):
+    import metrics
+    import generate_video
+    # Failures are counted in the summary; keep the client's error logs out of the report
+    logging.getLogger().setLevel(logging.CRITICAL)
+    warm_up(lambda: generate_video.generate_talking_video(product, 'Benchmark warm-up'))
+    before_cpu = cpu_split(os.getpid())
+    before_metrics = metrics.registry.render()
+    before_stages = parse_stages(before_metrics)
+    sampler = RssSampler(os.getpid())
+    sampler.start()
+    results, elapsed = run_load(lambda i: run_heygen(i, product), args.requests, args.concurrency)
+    peak = sampler.stop()
+    after_cpu = cpu_split(os.getpid())
+    after_metrics = metrics.registry.render()
+    stages = parse_stages(after_metrics)
+    for stage, (total, count) in before_stages.items():
+        stages[stage] = [stages[stage][0] - total, stages[stage][1] - count]
+    cpu = {part: after_cpu[part] - before_cpu[part] for part in after_cpu}
+    return summarize('heygen', results, elapsed, peak, cpu, stages, stage_cpu(cpu, before_metrics, after_metrics))
+
+
+def print_report(summary):
+    fmt = lambda value: '-' if value is None else f"{value:.2f}"
+    print(f"\n== {summary['target']}: {summary['ok']}/{summary['requests']} ok, "
+          f"{summary['failed']} failed, {summary['rejected']} rejected")
+    print(f"throughput {summary['throughput']:.2f} req/s   latency p50 {fmt(summary['p50'])}s  "
+          f"p95 {fmt(summary['p95'])}s  p99 {fmt(summary['p99'])}s   ttfb p50 {fmt(summary['ttfb_p50'])}s")
+    cpu = summary['cpu_seconds']
+    print(f"peak RSS {summary['peak_rss_mb']} MB   CPU s: web {cpu['web']}  "
+          f"render workers {cpu['workers']}  ffmpeg {cpu['ffmpeg']}")
+    for error in summary['errors']:
+        print(f"  error: {error}")
+    labels = {
+        'composite': 'composite (render worker)',
+        'encode': 'encode (ffmpeg)',
+        'worker_other': 'render worker, other',
+        'web': 'web: tts, upload, provider wait, streaming',
+    }
+    print(f"{'stage CPU':<44} {'total s':>8} {'per req s':>10}")
+    for stage, seconds in summary['stage_cpu_seconds'].items():
+        per_request = seconds / summary['ok'] if summary['ok'] else 0.0
+        print(f"{labels[stage]:<44} {seconds:>8.2f} {per_request:>10.3f}")
+    print(f"{'stage':<24} {'count':>6} {'mean s':>8}")
+    for stage, entry in summary['stages'].items():
+        print(f"{stage:<24} {entry['count']:>6} {entry['mean_seconds']:>8.3f}")
+
+
+def check_regressions(summaries, baseline_path, max_regression):
+    with open(baseline_path) as f:
+        baseline = {s['target']: s for s in json.load(f)}
+    regressions = []
+    for summary in summaries:
+        base = baseline.get(summary['target'])
+        if not base:
+            continue
+        if base['p95'] and summary['p95'] and summary['p95'] > base['p95'] * (1 + max_regression):
+            regressions.append(f"{summary['target']}: p95 {base['p95']:.2f}s -> {summary['p95']:.2f}s")
+        if base['throughput'] and summary['throughput'] < base['throughput'] * (1 - max_regression):
+            regressions.append(f"{summary['target']}: throughput {base['throughput']:.2f} -> "
+                               f"{summary['throughput']:.2f} req/s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--target', nargs='+', default=['a2e', 'still', 'heygen'],
+                        choices=['a2e', 'still', 'heygen', 'service-heygen'])
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--job-duration', type=float, default=2)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--failure-rate', type=float, default=0)
+    parser.add_argument('--job-failure-rate', type=float, default=0)
+    parser.add_argument('--rate-limit', type=float, default=0, help='mock provider API requests/s before 429')
+    parser.add_argument('--video-seconds', type=float, default=3)
+    parser.add_argument('--batches', type=int, default=0, help='background batches queued during the a2e load')
+    parser.add_argument('--batch-variants', type=int, default=4)
+    parser.add_argument('--product', default=os.path.join(HERE, 'sample_image.png'))
+    parser.add_argument('--json', help='write the summaries to this file')
+    parser.add_argument('--baseline', help='summaries from an earlier run to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.2)
+    parser.add_argument('--keep', action='store_true', help='keep the work directory (logs)')
+    args = parser.parse_args()
+
+    with open(args.product, 'rb') as f:
+        product = f.read()
+    workdir = tempfile.mkdtemp(prefix='bench_service_')
+    mock_port = free_port()
+    mock_url = f"http://127.0.0.1:{mock_port}"
+    # Everything the apps (and the in-process HeyGen client) persist goes to the work directory
+    os.environ.update({
+        'A2E_API_URL': mock_url,
+        'HEYGEN_API_URL': f"{mock_url}/v1",
+        'HEYGEN_API_KEY': 'bench',
+        'AZURE_TTS_ENDPOINT': f"{mock_url}/azure",
+        'AZURE_TTS_KEY': 'bench',
+        'TMPFILES_UPLOAD_URL': f"{mock_url}/api/v1/upload",
+        'TTS_CACHE_DIR': os.path.join(workdir, 'tts_cache'),
+        'OUTPUT_CACHE_DIR': os.path.join(workdir, 'output_cache'),
+        'AVATAR_DB_PATH': os.path.join(workdir, 'avatars.db'),
+        'JOB_STORE_PATH': os.path.join(workdir, 'jobs.db'),
+        'JOB_ARTIFACT_DIR': os.path.join(workdir, 'job_artifacts'),
+        'JOB_RESULT_DIR': os.path.join(workdir, 'job_results'),
+        'MOCK_VIDEO_PATH': os.path.join(workdir, 'mock_avatar.mp4'),
+        'MOCK_AUDIO_PATH': os.path.join(workdir, 'mock_speech.mp3'),
+        'MOCK_VIDEO_SECONDS': str(args.video_seconds),
+    })
+    env = dict(os.environ)
+
+    from mock_providers import ensure_mock_video, ensure_mock_audio
+    ensure_mock_video(env['MOCK_VIDEO_PATH'], args.video_seconds)
+    ensure_mock_audio(env['MOCK_AUDIO_PATH'], args.video_seconds)
+    from tts_cache import audio_cache
+    with open(env['MOCK_AUDIO_PATH'], 'rb') as f:
+        audio_cache.put(audio_cache.key(STILL_SCRIPT, 'gtts:en', 'mp3'), f.read())
+
+    mock, _ = start_server([
+        'mock_providers.py', '--port', str(mock_port),
+        '--job-duration', str(args.job_duration), '--latency', str(args.latency),
+        '--failure-rate', str(args.failure_rate), '--job-failure-rate', str(args.job_failure_rate),
+        '--rate-limit', str(args.rate_limit),
+    ], mock_port, env, os.path.join(workdir, 'mock.log'), ready_path='/mock/stats')
+    summaries = []
+    try:
+        print(f"{args.requests} requests per target, concurrency {args.concurrency}, "
+              f"job duration {args.job_duration}s, provider latency {args.latency}s, "
+              f"failure rates {args.failure_rate}/{args.job_failure_rate}, "
+              f"provider rate limit {args.rate_limit or 'none'}")
+        for target in args.target:
+            if target == 'heygen':
+                summary = bench_heygen(args, product)
+            else:
+                module = {'a2e': 'app', 'still': 'appp', 'service-heygen': 'service'}[target]
+                summary = bench_server(target, f"import uvicorn; uvicorn.run('{module}:app', port={{port}}, "
+                                       "log_level='warning')", env, workdir, args, product)
+            summaries.append(summary)
+            print_report(summary)
+    finally:
+        mock.terminate()
+        mock.wait()
+        if args.keep:
+            print(f"\nLogs kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summaries, f, indent=2)
+    if args.baseline:
+        regressions = check_regressions(summaries, args.baseline, args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
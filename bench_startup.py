@@ -0,0 +1,104 @@
+"""Cold-start benchmark: app import time, warmup and the first render, each in a fresh interpreter.
+
+    python bench_startup.py [--runs 5] [--apps app appp] [--budget 0.5]
+
+For every app it reports the median import time (what a worker pays at
+boot without preload) and which heavy libraries the import pulled in, then
+the one-time warmup, and the latency of the first render on a cold render
+pool against one warmed with render_pool.warm(). With --budget the exit
+status is 1 when an app imports slower than that many seconds, so CI can
+catch cold-start regressions.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+# Libraries that should only load on the render path or on first use
+HEAVY_MODULES = ('numpy', 'PIL.Image', 'aiohttp', 'gtts', 'moviepy', 'imageio')
+
+
+def child(task):
+    """Run one measurement in this (fresh) interpreter and print it as JSON"""
+    kind, _, name = task.partition(':')
+    result = {}
+    if kind == 'import':
+        start = time.perf_counter()
+        __import__(name)
+        result['seconds'] = time.perf_counter() - start
+        result['heavy'] = [module for module in HEAVY_MODULES if module in sys.modules]
+    elif kind == 'warmup':
+        __import__(name)
+        import warmup
+        start = time.perf_counter()
+        warmup.warmup()
+        result['seconds'] = time.perf_counter() - start
+    elif kind in ('render-cold', 'render-warm'):
+        from render_pool import render_pool
+        from media_buffers import MediaBuffer
+        from mock_providers import ensure_mock_audio
+        import compositor
+        audio_path = os.path.abspath(ensure_mock_audio())
+        if kind == 'render-warm':
+            result['warm_seconds'] = render_pool.warm()
+        spec = {'layout': 'still', 'audio_path': audio_path, 'product_path': 'sample_image.png',
+                'product_width': int(compositor.VIDEO_SIZE[0] * 0.8), 'profile': 'preview'}
+        with MediaBuffer('.mp4', in_memory=False) as output:
+            start = time.perf_counter()
+            render_pool.render(dict(spec, output_path=output.path))
+            result['seconds'] = time.perf_counter() - start
+    print(json.dumps(result))
+
+
+def measure(task, runs):
+    """Run task in `runs` fresh interpreters; returns the parsed results"""
+    env = dict(os.environ, A2E_API_KEY=os.getenv('A2E_API_KEY', 'bench'),
+               HEYGEN_API_KEY=os.getenv('HEYGEN_API_KEY', 'bench'))
+    results = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, __file__, '--child', task], env=env, check=True,
+                                stdout=subprocess.PIPE).stdout
+        results.append(json.loads(output.decode().strip().splitlines()[-1]))
+    return results
+
+
+def median(results, key='seconds'):
+    return statistics.median(result[key] for result in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--apps', nargs='+', default=['app', 'appp'])
+    parser.add_argument('--budget', type=float, default=None,
+                        help="fail when an app's median import time exceeds this many seconds")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args.child)
+
+    print(f"median of {args.runs} fresh interpreters")
+    print(f"{'app':<6} {'import s':>9} {'warmup s':>9}  heavy modules loaded by the import")
+    over_budget = []
+    for app in args.apps:
+        imports = measure(f"import:{app}", args.runs)
+        warmups = measure(f"warmup:{app}", args.runs)
+        seconds = median(imports)
+        print(f"{app:<6} {seconds:>9.3f} {median(warmups):>9.3f}  {', '.join(imports[0]['heavy']) or '-'}")
+        if args.budget is not None and seconds > args.budget:
+            over_budget.append(app)
+
+    cold = measure('render-cold', args.runs)
+    warm = measure('render-warm', args.runs)
+    print(f"first render (still, preview): cold pool {median(cold):.3f}s, "
+          f"warmed pool {median(warm):.3f}s (warm() took {median(warm, 'warm_seconds'):.3f}s)")
+    if over_budget:
+        print(f"over the {args.budget}s import budget: {', '.join(over_budget)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
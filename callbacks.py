@@ -0,0 +1,82 @@
+"""Provider completion webhooks.
+
+When CALLBACK_BASE_URL (the public URL of this service) and
+CALLBACK_SECRET (the webhook signing secret configured at the providers)
+are set, provider jobs are submitted with a callback URL pointing at
+/callbacks/<provider> and waits skip polling until the callback is
+overdue. The receiver checks the HMAC-SHA256 signature of the body and
+hands the payload to the shared poller, which resolves the waiting job.
+
+The URL itself carries no secret, so it can show up in access logs and
+provider dashboards. Callback results are also recorded in the job store:
+a callback that lands on a worker process that is not waiting for the job
+is picked up by the waiting worker within CALLBACK_CHECK_INTERVAL instead
+of by its fallback polling.
+"""
+import os
+import hmac
+import json
+import asyncio
+import hashlib
+import logging
+
+from status_poller import poller
+from job_store import job_store
+
+logger = logging.getLogger(__name__)
+
+CALLBACK_BASE_URL = os.getenv('CALLBACK_BASE_URL', '').rstrip('/')
+# Webhook signing secret shared with the providers; callbacks are disabled without it
+CALLBACK_SECRET = os.getenv('CALLBACK_SECRET', '')
+# Request header with the hex HMAC-SHA256 of the raw body (optionally prefixed with "sha256=")
+CALLBACK_SIGNATURE_HEADER = os.getenv('CALLBACK_SIGNATURE_HEADER', 'Signature')
+
+if CALLBACK_BASE_URL and not CALLBACK_SECRET:
+    logger.warning("CALLBACK_BASE_URL is set without CALLBACK_SECRET; provider callbacks are disabled")
+
+# Callback results are shared between worker processes through the job store
+poller.share_callbacks(job_store.record_callback, job_store.find_callback)
+
+
+def callback_url(provider):
+    """Webhook URL to hand to the provider, or None when callbacks are disabled"""
+    if not CALLBACK_BASE_URL or not CALLBACK_SECRET:
+        return None
+    return f"{CALLBACK_BASE_URL}/callbacks/{provider}"
+
+
+def sign(body):
+    """Signature of a raw callback body"""
+    return hmac.new(CALLBACK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+
+
+def handle_callback(provider, signature, body):
+    """Check and resolve one webhook from its raw body; returns (JSON body, HTTP status)"""
+    signature = signature.strip().removeprefix('sha256=')
+    if not CALLBACK_SECRET or not hmac.compare_digest(signature.encode(), sign(body).encode()):
+        return {'error': 'Invalid callback signature'}, 403
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return {'error': 'Expected a JSON body'}, 400
+    try:
+        job_id = poller.resolve_callback(provider, payload)
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        logger.error(f"Rejected {provider} callback: {str(e)}")
+        return {'error': str(e)}, 400
+    logger.info(f"Callback received for {provider} job {job_id}")
+    return {'status': 'ok'}, 200
+
+
+def register_asgi_callback_routes(app):
+    """Add the POST /callbacks/{provider} receiver to a FastAPI app"""
+    from fastapi import Request
+    from fastapi.responses import JSONResponse
+
+    @app.post('/callbacks/{provider}')
+    async def provider_callback(provider: str, request: Request):
+        body = await request.body()
+        signature = request.headers.get(CALLBACK_SIGNATURE_HEADER, '')
+        # Recording the result in the job store is a blocking write
+        result, status = await asyncio.to_thread(handle_callback, provider, signature, body)
+        return JSONResponse(result, status_code=status)
@@ -0,0 +1,307 @@
+"""Streaming compositor for the static-background layouts.
+
+The background and product layers never change during a clip, so they are
+rasterized once into a NumPy base frame. For avatar videos only the avatar
+rectangle is overwritten per frame and raw frames are piped straight into
+ffmpeg. For image-plus-audio videos the base frame is encoded as a looped
+still with no per-frame Python work at all.
+
+Encode settings come from a named profile (ENCODE_PROFILES): a quick
+half-resolution preview, the balanced default, or a slower, higher-quality
+archival encode.
+"""
+import os
+import re
+import time
+import hashlib
+import logging
+import threading
+import subprocess
+from collections import OrderedDict
+
+# numpy and PIL are imported where frames are built, so web workers that
+# never render (the render pool does) don't pay for them at boot
+from image_prep import layer_cache
+from media_buffers import MediaBuffer
+
+logger = logging.getLogger(__name__)
+
+VIDEO_SIZE = (1080, 1080)
+FPS = 24
+# Keyframe (and so fragment) interval for streamed output
+FRAGMENT_SECONDS = float(os.getenv('FRAGMENT_SECONDS', '2'))
+BASE_FRAME_CACHE_SIZE = int(os.getenv('BASE_FRAME_CACHE_SIZE', '16'))
+
+# x264 settings per output target. scale shrinks the whole layout; tune is
+# only used for the still layout (avatar clips have motion); keyframe_seconds
+# of None means FRAGMENT_SECONDS; threads of 0 means one per core this
+# process is pinned to.
+ENCODE_PROFILES = {
+    'preview': {'preset': 'ultrafast', 'crf': 30, 'tune': 'stillimage', 'scale': 0.5,
+                'keyframe_seconds': None, 'threads': 0, 'audio_bitrate': '64k'},
+    'balanced': {'preset': 'veryfast', 'crf': 23, 'tune': 'stillimage', 'scale': 1.0,
+                 'keyframe_seconds': None, 'threads': 0, 'audio_bitrate': '128k'},
+    'archival': {'preset': 'slow', 'crf': 18, 'tune': 'stillimage', 'scale': 1.0,
+                 'keyframe_seconds': 10, 'threads': 0, 'audio_bitrate': '192k'},
+}
+ENCODE_PROFILE = os.getenv('ENCODE_PROFILE', 'balanced')
+
+# ffmpeg encoders every profile needs (video, audio)
+REQUIRED_ENCODERS = ('libx264', 'aac')
+
+_base_frames = OrderedDict()
+_base_frames_lock = threading.Lock()
+_encoders_checked = None
+
+
+def ffmpeg_exe():
+    """Locate the ffmpeg binary (the one bundled with MoviePy when available)."""
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except Exception:
+        return 'ffmpeg'
+
+
+def check_encoders():
+    """Run ffmpeg once to resolve and page in the binary; raise if it lacks the encoders renders use.
+
+    Returns the ffmpeg path. The result is cached for the process.
+    """
+    global _encoders_checked
+    if _encoders_checked:
+        return _encoders_checked
+    exe = ffmpeg_exe()
+    result = subprocess.run([exe, '-hide_banner', '-encoders'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    available = set(re.findall(r'^ \S+ (\w+)', result.stdout.decode('utf-8', 'replace'), re.MULTILINE))
+    missing = [name for name in REQUIRED_ENCODERS if name not in available]
+    if result.returncode != 0 or missing:
+        raise Exception(f"ffmpeg at {exe} is missing encoders: {', '.join(missing) or 'unknown'}")
+    _encoders_checked = exe
+    return exe
+
+
+def warmup():
+    """Import the frame libraries and check ffmpeg, so the first render doesn't pay for it"""
+    import numpy  # noqa: F401
+    from PIL import Image  # noqa: F401
+    return check_encoders()
+
+
+def parse_color(value):
+    """'#RRGGBB' -> (r, g, b)"""
+    return (int(value[1:3], 16), int(value[3:5], 16), int(value[5:7], 16))
+
+
+def probe_video(path):
+    """Return (width, height, duration) of a video by parsing ffmpeg's stream info."""
+    result = subprocess.run([ffmpeg_exe(), '-hide_banner', '-i', path],
+                            stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
+    info = result.stderr.decode('utf-8', 'replace')
+    size = re.search(r'Stream #.*Video:.*?, (\d{2,5})x(\d{2,5})', info)
+    duration = re.search(r'Duration: (\d+):(\d+):([\d.]+)', info)
+    if not size:
+        raise Exception(f"Could not read video stream from {path}")
+    seconds = None
+    if duration:
+        h, m, s = duration.groups()
+        seconds = int(h) * 3600 + int(m) * 60 + float(s)
+    return int(size.group(1)), int(size.group(2)), seconds
+
+
+def get_profile(name=None):
+    """Look up an encode profile by name (default ENCODE_PROFILE)"""
+    name = name or ENCODE_PROFILE
+    if name not in ENCODE_PROFILES:
+        raise ValueError(f"Unknown encode profile: {name}")
+    return ENCODE_PROFILES[name]
+
+
+def profile_size(profile, size=VIDEO_SIZE):
+    """Output size for a profile, rounded to even dimensions for yuv420p"""
+    return tuple(max(2, int(side * profile['scale']) // 2 * 2) for side in size)
+
+
+def _file_digest(path):
+    """content_hash() of a file, read in blocks"""
+    if not path:
+        return None
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def build_base_frame(size=VIDEO_SIZE, background_path=None, background_color='#D3D3D3',
+                     product_path=None, product_width=None):
+    """Rasterize background + centered product into an RGB array (cached by content and geometry)."""
+    import numpy as np
+    from PIL import Image
+
+    background_digest, product_digest = _file_digest(background_path), _file_digest(product_path)
+    key = (size, background_digest, background_color if not background_path else None,
+           product_digest, product_width)
+    with _base_frames_lock:
+        if key in _base_frames:
+            _base_frames.move_to_end(key)
+            return _base_frames[key]
+
+    if background_path:
+        canvas = layer_cache.load(background_path, size=size, digest=background_digest).copy()
+    else:
+        canvas = Image.new('RGB', size, parse_color(background_color))
+
+    if product_path:
+        product = layer_cache.load(product_path, width=product_width, mode='RGBA', digest=product_digest)
+        position = ((size[0] - product.width) // 2, (size[1] - product.height) // 2)
+        canvas.paste(product, position, product)
+
+    frame = np.asarray(canvas, dtype=np.uint8).copy()
+    frame.setflags(write=False)
+    with _base_frames_lock:
+        _base_frames[key] = frame
+        while len(_base_frames) > BASE_FRAME_CACHE_SIZE:
+            _base_frames.popitem(last=False)
+    return frame
+
+
+def _mp4_args(fragmented):
+    """Container flags; fragmented MP4 starts with an empty moov and emits one fragment per keyframe"""
+    if not fragmented:
+        return ['-f', 'mp4']
+    return ['-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4']
+
+
+def _codec_args(profile, fps, still=False):
+    """x264/AAC flags for an encode profile"""
+    threads = profile['threads']
+    if not threads and hasattr(os, 'sched_getaffinity'):
+        threads = len(os.sched_getaffinity(0))
+    args = ['-c:v', 'libx264', '-preset', profile['preset'], '-crf', str(profile['crf'])]
+    if still and profile.get('tune'):
+        args += ['-tune', profile['tune']]
+    args += ['-g', str(int(fps * (profile['keyframe_seconds'] or FRAGMENT_SECONDS)))]
+    if threads:
+        args += ['-threads', str(threads)]
+    args += ['-pix_fmt', 'yuv420p', '-c:a', 'aac', '-b:a', profile['audio_bitrate']]
+    return args
+
+
+def _encoder_args(size, fps, extra_inputs, maps, output_path, fragmented=False, profile=None):
+    args = [
+        ffmpeg_exe(), '-y', '-loglevel', 'error',
+        '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{size[0]}x{size[1]}', '-r', str(fps), '-i', 'pipe:0',
+    ]
+    args += extra_inputs + maps
+    args += _codec_args(profile or get_profile(), fps)
+    args += ['-shortest'] + _mp4_args(fragmented) + [output_path]
+    return args
+
+
+def _read_frame(stream, view):
+    """Fill view from stream; False at end of stream (a trailing partial frame is dropped)"""
+    filled = 0
+    while filled < len(view):
+        count = stream.readinto(view[filled:])
+        if not count:
+            return False
+        filled += count
+    return True
+
+
+def render_avatar_video(avatar_path, output_path, base_frame, avatar_width=None, fps=FPS, fragmented=False,
+                        audio_path=None, probe_path=None, profile=None, timings=None):
+    """Overlay the avatar clip bottom-left on the base frame and encode with its audio.
+
+    Only the avatar rectangle is written per frame; the rest of the output
+    buffer keeps the pre-rasterized static layers. With fragmented=True the
+    output is fragmented MP4 and may be a pipe. The avatar is read up to
+    three times (probe, frames, audio); when it arrives through pipes, pass
+    a separate audio_path and a probe_path holding the file's header.
+    The output size is the base frame's; profile names the encode settings.
+    A timings dict gets 'frame_copy_seconds', the time spent compositing
+    frames in Python, apart from waiting on the decoder and encoder.
+    """
+    import numpy as np
+
+    height, width = base_frame.shape[:2]
+    src_w, src_h, _ = probe_video(probe_path or avatar_path)
+    avatar_w = avatar_width or width // 4
+    avatar_h = min(int(src_h * avatar_w / src_w), height)
+    x, y = 0, height - avatar_h
+
+    # The decoder's messages go to a buffer: a pipe nobody reads while frames flow could fill up and stall it
+    with MediaBuffer('.log') as decoder_log:
+        with decoder_log.open('wb') as log:
+            decoder = subprocess.Popen([
+                ffmpeg_exe(), '-loglevel', 'error', '-i', avatar_path,
+                '-vf', f'scale={avatar_w}:{avatar_h},fps={fps}',
+                '-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:1',
+            ], stdout=subprocess.PIPE, stderr=log)
+        encoder = subprocess.Popen(
+            _encoder_args((width, height), fps, ['-i', audio_path or avatar_path], ['-map', '0:v', '-map', '1:a?'],
+                          output_path, fragmented, get_profile(profile)),
+            stdin=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+
+        # Both buffers are allocated once; every frame is read and written in place
+        frame = base_frame.copy()
+        region = frame[y:y + avatar_h, x:x + avatar_w]
+        avatar = np.empty((avatar_h, avatar_w, 3), dtype=np.uint8)
+        avatar_view = memoryview(avatar).cast('B')
+        frames = 0
+        copy_seconds = 0.0
+        try:
+            while _read_frame(decoder.stdout, avatar_view):
+                copy_start = time.perf_counter()
+                region[...] = avatar
+                copy_seconds += time.perf_counter() - copy_start
+                try:
+                    encoder.stdin.write(frame.data)
+                except BrokenPipeError:
+                    # The encoder exited; its stderr says why
+                    break
+                frames += 1
+        finally:
+            decoder.stdout.close()
+            decoder.wait()
+            try:
+                encoder.stdin.close()
+            except BrokenPipeError:
+                pass
+            error = encoder.stderr.read().decode('utf-8', 'replace')
+            encoder.wait()
+        decode_error = decoder_log.read().decode('utf-8', 'replace')
+    if timings is not None:
+        timings['frame_copy_seconds'] = copy_seconds
+    if encoder.returncode != 0:
+        raise Exception(f"ffmpeg encode failed: {error.strip()}")
+    if decoder.returncode != 0:
+        raise Exception(f"ffmpeg decode of {avatar_path} failed: {decode_error.strip()}")
+    if frames == 0:
+        raise Exception(f"No frames decoded from {avatar_path}")
+    logger.info(f"Composited {frames} frames into {output_path}")
+    return output_path
+
+
+def render_still_video(base_frame, audio_path, output_path, fps=FPS, fragmented=False, profile=None):
+    """Encode a single still frame looped for the length of the audio."""
+    from PIL import Image
+
+    with MediaBuffer('.png') as still:
+        with still.open('wb') as f:
+            Image.fromarray(base_frame).save(f, format='PNG', compress_level=1)
+        result = subprocess.run([
+            ffmpeg_exe(), '-y', '-loglevel', 'error',
+            # Decode and convert the still once per second; ffmpeg duplicates it up to fps
+            '-loop', '1', '-framerate', '1', '-f', 'image2', '-c:v', 'png', '-i', still.path,
+            '-i', audio_path,
+            '-map', '0:v', '-map', '1:a',
+            *_codec_args(get_profile(profile), fps, still=True), '-r', str(fps),
+            '-shortest', *_mp4_args(fragmented), output_path,
+        ], stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise Exception(f"ffmpeg encode failed: {result.stderr.decode('utf-8', 'replace').strip()}")
+    logger.info(f"Encoded still video into {output_path}")
+    return output_path
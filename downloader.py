@@ -0,0 +1,332 @@
+"""Parallel, resumable ranged downloads into media buffers.
+
+A Download probes the URL with a one-byte Range request. If the server
+supports ranges, the buffer is preallocated to the full length and split
+into parts. Each part is fetched on its own connection and written in
+place with pwrite. A dropped connection resumes its part from the last
+byte written instead of restarting the file, and the finished file is
+verified against the advertised length.
+
+While the download runs, tail() returns pipe paths that replay the bytes
+received so far from the start of the file and follow the download. A
+faststart MP4 (moov before mdat) can be decoded that way before the last
+part arrives. Bytes handed to a tail are never rewritten: a dropped
+single-connection download resumes after them (with a Range request, or by
+skipping them in a full response) or fails.
+"""
+import os
+import time
+import fcntl
+import struct
+import logging
+import threading
+from concurrent.futures import Future
+
+import requests
+
+from http_client import client
+from media_buffers import MediaBuffer
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_PARTS = int(os.getenv('DOWNLOAD_PARTS', '4'))
+# Files smaller than this are fetched on a single connection
+DOWNLOAD_MIN_PART_SIZE = int(os.getenv('DOWNLOAD_MIN_PART_SIZE', str(4 * 1024 * 1024)))
+# Read size; a dropped connection loses at most one partial chunk
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+PIPE_SIZE = 1024 * 1024
+# Resume attempts per part after a dropped connection
+DOWNLOAD_RETRIES = int(os.getenv('DOWNLOAD_RETRIES', '5'))
+
+
+class Download:
+    """Fetch url into a MediaBuffer over parallel Range requests"""
+
+    def __init__(self, url, media, parts=DOWNLOAD_PARTS, session=client, on_complete=None):
+        self.url = url
+        self.media = media
+        self.parts = parts
+        self.session = session
+        self.length = None
+        self.ranges = []
+        self.fd = None
+        self.threads = []
+        self.tails = []
+        self.moov_end = None
+        self.done = False
+        self.error = None
+        # Called with None or the error once the download ended
+        self.on_complete = on_complete
+        # Futures handed out by future(), settled when the download ends
+        self.futures = []
+        self.condition = threading.Condition()
+
+    @classmethod
+    def completed(cls, media):
+        """A finished Download over a buffer that already holds the whole file"""
+        download = cls(None, media)
+        download.fd = os.open(media.path, os.O_RDWR)
+        download.length = os.fstat(download.fd).st_size
+        download.ranges = [{'start': 0, 'end': download.length - 1, 'pos': download.length}]
+        download.done = True
+        return download
+
+    def start(self):
+        """Probe the URL, preallocate the buffer and start the part fetchers"""
+        self.fd = os.open(self.media.path, os.O_RDWR)
+        probe = self.session.get(self.url, headers={'Range': 'bytes=0-0'}, stream=True)
+        if probe.status_code == 206 and '/' in probe.headers.get('Content-Range', ''):
+            probe.close()
+            self.length = int(probe.headers['Content-Range'].rsplit('/', 1)[1])
+            self._preallocate()
+            count = max(1, min(self.parts, self.length // DOWNLOAD_MIN_PART_SIZE))
+            size = max(1, -(-self.length // count))
+            self.ranges = [{'start': start, 'end': min(start + size, self.length) - 1, 'pos': start}
+                           for start in range(0, self.length, size)]
+            logger.info(f"Downloading {self.length} bytes in {len(self.ranges)} ranged parts from {self.url}")
+            targets = [(self._fetch_range, part) for part in self.ranges]
+        else:
+            # No range support: one connection, resumed after the bytes already received if it drops
+            probe.raise_for_status()
+            if probe.headers.get('Content-Length'):
+                self.length = int(probe.headers['Content-Length'])
+                self._preallocate()
+            self.ranges = [{'start': 0, 'end': (self.length or 2 ** 62) - 1, 'pos': 0}]
+            logger.info(f"Server ignored Range, downloading {self.url} on one connection")
+            targets = [(self._fetch_whole, probe)]
+        for target, arg in targets:
+            thread = threading.Thread(target=self._run_part, args=(target, arg), name='download-part', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        threading.Thread(target=self._finish, name='download', daemon=True).start()
+        return self
+
+    def _preallocate(self):
+        os.ftruncate(self.fd, self.length)
+        if not self.media.in_memory:
+            try:
+                os.posix_fallocate(self.fd, 0, self.length)
+            except OSError:
+                pass
+
+    def _write(self, part, chunk):
+        chunk = chunk[:part['end'] + 1 - part['pos']]
+        os.pwrite(self.fd, chunk, part['pos'])
+        with self.condition:
+            part['pos'] += len(chunk)
+            self.condition.notify_all()
+
+    def _fetch_range(self, part):
+        attempts = 0
+        while part['pos'] <= part['end']:
+            try:
+                headers = {'Range': f"bytes={part['pos']}-{part['end']}"}
+                with self.session.get(self.url, headers=headers, stream=True) as r:
+                    content_range = r.headers.get('Content-Range', '')
+                    if r.status_code != 206 or not content_range.startswith(f"bytes {part['pos']}-"):
+                        raise Exception(f"Bad range response: {r.status_code} {content_range}")
+                    for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        self._write(part, chunk)
+                        if part['pos'] > part['end']:
+                            break
+                if part['pos'] <= part['end']:
+                    raise requests.ConnectionError(f"Connection closed at byte {part['pos']}")
+            except requests.RequestException as e:
+                attempts += 1
+                if attempts > DOWNLOAD_RETRIES:
+                    raise
+                logger.warning(f"Range {part['start']}-{part['end']} interrupted at {part['pos']} "
+                               f"({str(e)}), resuming (attempt {attempts})")
+                time.sleep(min(0.5 * 2 ** attempts, 10))
+
+    def _fetch_whole(self, response):
+        part = self.ranges[0]
+        attempts = 0
+        while True:
+            try:
+                with response:
+                    response.raise_for_status()
+                    skip = self._resume_offset(part, response)
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        if skip:
+                            dropped = min(skip, len(chunk))
+                            chunk, skip = chunk[dropped:], skip - dropped
+                        if chunk:
+                            self._write(part, chunk)
+                if skip:
+                    raise requests.ConnectionError(f"Connection closed {skip} bytes before the resume point")
+                break
+            except requests.RequestException as e:
+                attempts += 1
+                if attempts > DOWNLOAD_RETRIES:
+                    raise
+                logger.warning(f"Download of {self.url} interrupted at byte {part['pos']} ({str(e)}), resuming")
+                time.sleep(min(0.5 * 2 ** attempts, 10))
+                response = self.session.get(self.url, headers={'Range': f"bytes={part['pos']}-"}, stream=True)
+        with self.condition:
+            if self.length is None:
+                self.length = part['pos']
+                part['end'] = part['pos'] - 1
+
+    def _resume_offset(self, part, response):
+        """Bytes of the response to skip: those written before a reconnect, unless the server honored Range.
+
+        The bytes may already be in a tail, so they are never rewritten; a
+        response for a different file fails the download instead.
+        """
+        if part['pos'] == 0:
+            return 0
+        if response.status_code == 206 and response.headers.get('Content-Range', '').startswith(f"bytes {part['pos']}-"):
+            return 0
+        if response.status_code != 200:
+            raise Exception(f"Bad resume response: {response.status_code} {response.headers.get('Content-Range', '')}")
+        length = response.headers.get('Content-Length')
+        if self.length is not None and length is not None and int(length) != self.length:
+            raise Exception(f"File changed while downloading: {length} bytes instead of {self.length}")
+        return part['pos']
+
+    def _run_part(self, target, arg):
+        try:
+            target(arg)
+        except Exception as e:
+            with self.condition:
+                if self.error is None:
+                    self.error = e
+                self.condition.notify_all()
+
+    def _finish(self):
+        for thread in self.threads:
+            thread.join()
+        with self.condition:
+            if self.error is None:
+                received = sum(part['pos'] - part['start'] for part in self.ranges)
+                size = os.fstat(self.fd).st_size
+                if received != self.length or size != self.length:
+                    self.error = Exception(f"Download incomplete: got {received} of {self.length} bytes "
+                                           f"(buffer holds {size})")
+            self.done = True
+            self.condition.notify_all()
+        if self.error:
+            logger.error(f"Download of {self.url} failed: {str(self.error)}")
+        else:
+            logger.info(f"Downloaded {self.length} bytes from {self.url}")
+        if self.on_complete:
+            try:
+                self.on_complete(self.error)
+            except Exception as e:
+                logger.error(f"Download completion callback failed: {str(e)}")
+        with self.condition:
+            futures, self.futures = self.futures, []
+        for future in futures:
+            self._settle(future)
+
+    def future(self):
+        """A Future resolved with the MediaBuffer (or failed with the error) once the download ended.
+
+        For callers that must not block a thread on wait(), e.g. asyncio.wrap_future().
+        """
+        future = Future()
+        with self.condition:
+            if not self.done:
+                self.futures.append(future)
+                return future
+        self._settle(future)
+        return future
+
+    def _settle(self, future):
+        if self.error is not None:
+            future.set_exception(self.error)
+        else:
+            future.set_result(self.media)
+
+    def contiguous(self):
+        """Bytes available from the start of the file without gaps"""
+        with self.condition:
+            return self._contiguous()
+
+    def _contiguous(self):
+        available = 0
+        for part in self.ranges:
+            available = part['pos']
+            if part['pos'] <= part['end']:
+                break
+        return available
+
+    def _wait_for(self, size):
+        """Block until size bytes are contiguous (or the download ended); returns what is available"""
+        with self.condition:
+            self.condition.wait_for(lambda: self._contiguous() >= size or self.done or self.error)
+            return self._contiguous()
+
+    def streamable(self):
+        """True if the file is an MP4 with moov before mdat, so decoding can start early"""
+        offset = 0
+        while True:
+            if self._wait_for(offset + 16) < offset + 8:
+                return False
+            header = os.pread(self.fd, 16, offset)
+            size, box = struct.unpack('>I4s', header[:8])
+            if size == 1 and len(header) == 16:
+                size = struct.unpack('>Q', header[8:16])[0]
+            if box == b'moov':
+                self.moov_end = offset + size
+                return True
+            if box == b'mdat' or size < 8:
+                return False
+            offset += size
+
+    def header(self):
+        """A MediaBuffer with the file up to the end of moov, enough to probe the streams"""
+        if self.moov_end is None and not self.streamable():
+            raise ValueError("File is not a faststart MP4")
+        self._wait_for(self.moov_end)
+        return MediaBuffer.from_bytes(os.pread(self.fd, self.moov_end, 0), '.mp4')
+
+    def tail(self):
+        """Return a pipe path replaying the file from the start while it downloads"""
+        read_fd, write_fd = os.pipe()
+        try:
+            fcntl.fcntl(write_fd, fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+        except (AttributeError, OSError):
+            pass
+        self.tails.append(read_fd)
+        threading.Thread(target=self._pump, args=(write_fd,), name='download-tail', daemon=True).start()
+        return f"/proc/{os.getpid()}/fd/{read_fd}"
+
+    def _pump(self, write_fd):
+        sent = 0
+        try:
+            while True:
+                available = self._wait_for(sent + 1)
+                if available <= sent:
+                    # Finished (or failed): a short file makes the reader fail instead of hanging
+                    break
+                while sent < available:
+                    chunk = os.pread(self.fd, min(PIPE_SIZE, available - sent), sent)
+                    sent += os.write(write_fd, chunk)
+        except (BrokenPipeError, OSError):
+            pass
+        finally:
+            os.close(write_fd)
+
+    def wait(self, timeout=None):
+        """Block until every part arrived and the length checked out; returns the MediaBuffer"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.done, timeout)
+            if not self.done:
+                raise TimeoutError(f"Download of {self.url} timed out")
+        if self.error is not None:
+            raise self.error
+        return self.media
+
+    def close(self):
+        """Release the tail pipes and the buffer fd (not the buffer itself)"""
+        for read_fd in self.tails:
+            try:
+                os.close(read_fd)
+            except OSError:
+                pass
+        self.tails = []
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -1,11 +1,18 @@
 import os
-import requests
-import time
-import uuid
+from http_client import client
 import json
+import time
 import logging
-from PIL import Image
-import io
+from concurrent.futures import Future
+from status_poller import poller, JobFailed
+from tts_cache import audio_cache
+from avatar_registry import avatar_registry
+from pipeline import Pipeline
+from image_prep import prepare_jpeg, AVATAR_IMAGE_MAX_SIDE
+from metrics import span
+from callbacks import callback_url
+from provider_scheduler import scheduler, lane, RateLimited, retry_after_seconds
+from job_store import job_store, request_key, SUBMITTED, DONE, FAILED
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -14,68 +21,109 @@ logger = logging.getLogger("video-generator")
 # Load environment variables
 AZURE_TTS_KEY = os.getenv("AZURE_TTS_KEY")
 AZURE_TTS_REGION = os.getenv("AZURE_TTS_REGION")
-HEYGEN_API_KEY = os.getenv("HEYGEN_API_KEY").strip()  # Clean whitespace
+AZURE_TTS_FORMAT = "audio-16khz-32kbitrate-mono-mp3"
+# Overrides for the regional Azure hosts and tmpfiles.org (e.g. mock_providers.py)
+AZURE_TTS_ENDPOINT = os.getenv("AZURE_TTS_ENDPOINT")
+TMPFILES_UPLOAD_URL = os.getenv("TMPFILES_UPLOAD_URL", "https://tmpfiles.org/api/v1/upload")
+HEYGEN_API_KEY = (os.getenv("HEYGEN_API_KEY") or "").strip()  # Clean whitespace
+# Seconds a recorded HeyGen video URL is handed out again; older ones are refreshed from the video status
+HEYGEN_URL_TTL = int(os.getenv("HEYGEN_URL_TTL", "3600"))
 
 # HeyGen API endpoints
-HEYGEN_API_URL = "https://api.heygen.com/v1"
+HEYGEN_API_URL = os.getenv("HEYGEN_API_URL", "https://api.heygen.com/v1")
 
 def preprocess_image(image_bytes):
-    """Converts image to JPEG for compatibility"""
+    """Converts image to JPEG for compatibility (JPEG input that already fits is passed through)"""
     try:
-        with Image.open(io.BytesIO(image_bytes)) as img:
-            rgb_image = img.convert("RGB")
-            output_buffer = io.BytesIO()
-            rgb_image.save(output_buffer, format="JPEG", quality=95)
-            return output_buffer.getvalue()
+        return prepare_jpeg(image_bytes, quality=95, max_side=AVATAR_IMAGE_MAX_SIDE)
     except Exception as e:
         logger.error(f"Image processing failed: {str(e)}")
         raise
 
-def generate_azure_tts(script: str, voice: str = "en-US-AriaNeural") -> str:
-    """Generate TTS audio and return public URL"""
+def generate_azure_tts(script: str, voice: str = "en-US-AriaNeural", check_cancelled=None) -> str:
+    """Generate TTS audio and return public URL, reusing cached audio and URLs.
+
+    check_cancelled() is called before each request and may raise to stop.
+    """
+    check_cancelled = check_cancelled or (lambda: None)
     try:
-        # Get Azure auth token
-        token_url = f"https://{AZURE_TTS_REGION}.api.cognitive.microsoft.com/sts/v1.0/issueToken"
-        token_response = requests.post(token_url, headers={
-            "Ocp-Apim-Subscription-Key": AZURE_TTS_KEY,
-            "Content-Length": "0"
-        })
-        token_response.raise_for_status()
-        access_token = token_response.text
-        
-        # Generate speech
-        tts_url = f"https://{AZURE_TTS_REGION}.tts.speech.microsoft.com/cognitiveservices/v1"
-        ssml = f"<speak version='1.0' xml:lang='en-US'><voice name='{voice}'>{script}</voice></speak>"
-        
-        response = requests.post(
-            tts_url,
-            headers={
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "application/ssml+xml",
-                "X-Microsoft-OutputFormat": "audio-16khz-32kbitrate-mono-mp3"
-            },
-            data=ssml.encode('utf-8')
-        )
-        response.raise_for_status()
-        
-        # Save and host audio
-        filename = f"audio_{uuid.uuid4().hex}.mp3"
-        with open(filename, "wb") as f:
-            f.write(response.content)
-        
-        return upload_to_tmpfiles(filename)
+        cache_key = audio_cache.key(script, voice, AZURE_TTS_FORMAT)
+        audio_url = audio_cache.get_url(cache_key)
+        if audio_url:
+            logger.info("TTS cache hit: reusing hosted audio")
+            return audio_url
+
+        filename = f"audio_{cache_key[:16]}.mp3"
+        # A copy, so eviction by another request can't remove the file mid-upload
+        cached = audio_cache.get_media(cache_key)
+        if cached:
+            logger.info("TTS cache hit: re-uploading cached audio")
+            check_cancelled()
+            with cached, cached.open('rb') as f:
+                audio_url = upload_bytes_to_tmpfiles(f, filename)
+        else:
+            # Upload straight from memory; the cache write is the only copy on disk
+            check_cancelled()
+            with span('tts'):
+                audio = synthesize_azure_tts(script, voice)
+            audio_cache.put(cache_key, audio)
+            check_cancelled()
+            audio_url = upload_bytes_to_tmpfiles(audio, filename)
+        audio_cache.put_url(cache_key, audio_url)
+        return audio_url
     except Exception as e:
         logger.error(f"Azure TTS failed: {str(e)}")
         raise
 
-def upload_to_tmpfiles(file_path: str) -> str:
+def synthesize_azure_tts(script: str, voice: str) -> bytes:
+    """Call Azure TTS and return the mp3 bytes"""
+    # Get Azure auth token
+    token_host = AZURE_TTS_ENDPOINT or f"https://{AZURE_TTS_REGION}.api.cognitive.microsoft.com"
+    token_url = f"{token_host}/sts/v1.0/issueToken"
+    token_response = client.post(token_url, headers={
+        "Ocp-Apim-Subscription-Key": AZURE_TTS_KEY,
+        "Content-Length": "0"
+    })
+    token_response.raise_for_status()
+    access_token = token_response.text
+    
+    # Generate speech
+    tts_host = AZURE_TTS_ENDPOINT or f"https://{AZURE_TTS_REGION}.tts.speech.microsoft.com"
+    tts_url = f"{tts_host}/cognitiveservices/v1"
+    ssml = f"<speak version='1.0' xml:lang='en-US'><voice name='{voice}'>{script}</voice></speak>"
+    
+    response = client.post(
+        tts_url,
+        headers={
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/ssml+xml",
+            "X-Microsoft-OutputFormat": AZURE_TTS_FORMAT
+        },
+        data=ssml.encode('utf-8')
+    )
+    response.raise_for_status()
+    return response.content
+
+def upload_to_tmpfiles(file_path: str, filename: str = None, remove: bool = True) -> str:
     """Uploads file to temporary hosting with error handling"""
     try:
-        # Use a more reliable temporary host
         with open(file_path, 'rb') as f:
-            response = requests.post(
-                'https://tmpfiles.org/api/v1/upload',
-                files={'file': (os.path.basename(file_path), f)}
+            return upload_bytes_to_tmpfiles(f, filename or os.path.basename(file_path))
+    finally:
+        if remove:
+            try:
+                os.remove(file_path)
+            except:
+                pass
+
+def upload_bytes_to_tmpfiles(data, filename: str) -> str:
+    """Uploads bytes or a file object to temporary hosting without staging it on disk"""
+    try:
+        # Use a more reliable temporary host
+        with span('audio_upload'):
+            response = client.post(
+                TMPFILES_UPLOAD_URL,
+                files={'file': (filename, data)}
             )
         
         if response.status_code != 200:
@@ -85,17 +133,12 @@ def upload_to_tmpfiles(file_path: str) -> str:
     except Exception as e:
         logger.error(f"Audio upload failed: {str(e)}")
         raise
-    finally:
-        try:
-            os.remove(file_path)
-        except:
-            pass
 
 def create_did_talk(image_bytes, audio_url):
     """Create HeyGen video with custom avatar"""
     try:
         logger.info("Creating HeyGen avatar...")
-        avatar_id = create_heygen_avatar(image_bytes)
+        avatar_id = avatar_registry.get_or_create("heygen", image_bytes, create_heygen_avatar)
         
         logger.info(f"Avatar created: {avatar_id}")
         logger.info("Generating video...")
@@ -106,17 +149,139 @@ def create_did_talk(image_bytes, audio_url):
         logger.error(f"Video creation failed: {str(e)}")
         raise
 
-def create_heygen_avatar(image_bytes):
+def generate_talking_video(image_bytes, script: str, voice: str = "en-US-AriaNeural") -> str:
+    """Run the full HeyGen flow and return the video URL.
+
+    Image preprocessing + avatar creation and TTS synthesis + upload don't
+    depend on each other, so they run concurrently; only video generation
+    waits for both.
+    """
+    pipeline = _talking_video_pipeline(image_bytes, script, voice)
+    pipeline.stage("video_url", lambda video: wait_heygen_video(video), deps=["video"])
+    try:
+        return pipeline.run()["video_url"]
+    except Exception as e:
+        logger.error(f"Video creation failed: {str(e)}")
+        raise
+
+def start_talking_video(image_bytes, script: str, voice: str = "en-US-AriaNeural"):
+    """Run the HeyGen flow up to the submitted video; wait for it with track_heygen_video()"""
+    try:
+        return _talking_video_pipeline(image_bytes, script, voice).run()["video"]
+    except Exception as e:
+        logger.error(f"Video creation failed: {str(e)}")
+        raise
+
+def _talking_video_pipeline(image_bytes, script, voice):
+    pipeline = Pipeline("heygen")
+    pipeline.stage("preprocess", lambda: preprocess_image(image_bytes))
+    # Stages running alongside a failed one stop before their next request
+    pipeline.stage("audio_url", lambda: generate_azure_tts(script, voice, pipeline.check_cancelled))
+    pipeline.stage("avatar_id", lambda preprocess: avatar_registry.get_or_create(
+        "heygen", preprocess, lambda image: create_heygen_avatar(image, pipeline.check_cancelled)),
+        deps=["preprocess"])
+    pipeline.stage("video", lambda avatar_id, audio_url: submit_heygen_video(avatar_id, audio_url),
+                   deps=["avatar_id", "audio_url"])
+    return pipeline
+
+def submit_heygen_video(avatar_id, audio_url, reuse=True):
+    """Start the video, or pick up one recorded for the same avatar and audio.
+
+    A new video holds a HeyGen job slot until it resolves.
+    """
+    job_store.start()
+    key = request_key("heygen", avatar_id, audio_url)
+    record = job_store.find("heygen", key) if reuse else None
+    if record:
+        logger.info(f"Reusing HeyGen video {record['provider_job_id']}")
+        video_url = record["artifacts"].get("video_url")
+        if video_url and record["updated_at"] < time.time() - HEYGEN_URL_TTL:
+            # HeyGen's video URLs are signed and expire; the status check hands out a fresh one
+            video_url = None
+        return {"record_id": record["id"], "video_id": record["provider_job_id"], "video_url": video_url,
+                "owned": False, "avatar_id": avatar_id, "audio_url": audio_url}
+    scheduler.acquire_slot("heygen")
+    record_id = job_store.create("heygen", key)
+    try:
+        video_id = generate_heygen_video(avatar_id, audio_url)
+    except Exception as e:
+        scheduler.release_slot("heygen")
+        job_store.update(record_id, stage=FAILED, error=str(e))
+        raise
+    job_store.update(record_id, stage=SUBMITTED, provider_job_id=video_id)
+    return {"record_id": record_id, "video_id": video_id, "video_url": None, "owned": True,
+            "avatar_id": avatar_id, "audio_url": audio_url}
+
+def resubmit_heygen_video(video):
+    """Submit a new video for the avatar and audio of a reused one that did not work out"""
+    logger.warning(f"Could not reuse HeyGen video {video['video_id']}, submitting a new one")
+    return submit_heygen_video(video["avatar_id"], video["audio_url"], reuse=False)
+
+def wait_heygen_video(video):
+    """Wait for a video from submit_heygen_video() and return its URL"""
+    try:
+        try:
+            return track_heygen_video(video).result()
+        except Exception:
+            if video["owned"]:
+                raise
+        return track_heygen_video(resubmit_heygen_video(video)).result()
+    except Exception as e:
+        logger.error(f"Status check failed: {str(e)}")
+        raise
+
+def track_heygen_video(video):
+    """Return a Future resolved with the URL of a video from submit_heygen_video().
+
+    When it resolves, the video's slot is given back and its record updated.
+    """
+    result = Future()
+    if video["video_url"]:
+        result.set_result(video["video_url"])
+        return result
+
+    def settle(future):
+        if video["owned"]:
+            scheduler.release_slot("heygen")
+        error = future.exception()
+        if error is None:
+            job_store.update(video["record_id"], stage=DONE, video_url=future.result())
+            result.set_result(future.result())
+            return
+        if isinstance(error, JobFailed):
+            # Failed for good: later requests must not reuse it
+            job_store.update(video["record_id"], stage=FAILED, error=str(error))
+        elif video["owned"]:
+            # The video may still finish: leave it to recovery so a retry gets it for free
+            job_store.update(video["record_id"], release=True)
+        if isinstance(error, TimeoutError):
+            error = Exception("Video generation timed out")
+        result.set_exception(error)
+
+    poller.track("heygen", video["video_id"], timeout=60,
+                 callback=bool(callback_url("heygen"))).add_done_callback(settle)
+    return result
+
+def resume_heygen_video(record):
+    """Finish a HeyGen video orphaned by a stopped worker and record its URL for the request's retry"""
+    # The video still occupies a HeyGen slot; recovery queues behind interactive work
+    with lane("batch"), scheduler.slot("heygen"):
+        video_url = poller.wait("heygen", record["provider_job_id"], timeout=600)
+    job_store.update(record["id"], stage=DONE, video_url=video_url)
+
+def create_heygen_avatar(image_bytes, check_cancelled=None):
     """Upload image to create custom avatar"""
+    if check_cancelled:
+        check_cancelled()
     try:
         headers = {"X-Api-Key": HEYGEN_API_KEY}
         
-        response = requests.post(
+        response = scheduler.call("heygen", lambda: client.post(
             f"{HEYGEN_API_URL}/avatars",
             headers=headers,
             files={"file": ("avatar.jpg", image_bytes, "image/jpeg")},
             timeout=10
-        )
+        ))
         
         logger.debug(f"Avatar API response: {response.status_code} {response.text}")
         
@@ -161,15 +326,18 @@ def generate_heygen_video(avatar_id, audio_url):
             "test": True,
             "aspect_ratio": "16:9"
         }
+        # Completion webhook (when CALLBACK_BASE_URL is set) instead of status polling
+        if callback_url("heygen"):
+            payload["callback_url"] = callback_url("heygen")
         
         logger.debug(f"Video payload: {json.dumps(payload)}")
         
-        response = requests.post(
+        response = scheduler.call("heygen", lambda: client.post(
             f"{HEYGEN_API_URL}/video/generate",
             headers=headers,
             json=payload,
             timeout=10
-        )
+        ))
         
         logger.debug(f"Video API response: {response.status_code} {response.text}")
         
@@ -187,34 +355,49 @@ def generate_heygen_video(avatar_id, audio_url):
         logger.error(f"Video generation failed: {str(e)}")
         raise
 
+async def _check_heygen_status(session, video_id):
+    """Status check for the shared poller"""
+    headers = {"X-Api-Key": HEYGEN_API_KEY}
+    async with session.get(
+        f"{HEYGEN_API_URL}/video_status",
+        params={"video_id": video_id},
+        headers=headers
+    ) as response:
+        if response.status == 429:
+            raise RateLimited(retry_after_seconds(response.headers))
+        body = await response.text()
+        logger.debug(f"Status check: {response.status} {body}")
+        if response.status != 200:
+            return "pending", None
+        data = json.loads(body)
+
+    status = data["data"].get("status")
+    if status == "completed":
+        return "completed", data["data"]["video_url"]
+    if status == "failed":
+        return "failed", data["data"].get("error", "Unknown error")
+    return "pending", None
+
+def _parse_heygen_callback(payload):
+    """Webhook body for the shared poller"""
+    data = payload.get("event_data") or {}
+    event = payload.get("event_type")
+    if event == "avail_video.success":
+        return data.get("video_id"), "completed", data.get("url")
+    if event == "avail_video.fail":
+        return data.get("video_id"), "failed", data.get("msg", "Unknown error")
+    return data.get("video_id"), "pending", None
+
+poller.register_provider("heygen", _check_heygen_status, parse_callback=_parse_heygen_callback)
+job_store.register_resumer("heygen", resume_heygen_video)
+
 def check_talk_status(video_id):
     """Check video status and return URL when ready"""
     try:
-        headers = {"X-Api-Key": HEYGEN_API_KEY}
-        
-        for i in range(20):  # Check for 1 minute max
-            response = requests.get(
-                f"{HEYGEN_API_URL}/video_status?video_id={video_id}",
-                headers=headers,
-                timeout=5
-            )
-            
-            logger.debug(f"Status check {i+1}: {response.status_code} {response.text}")
-            
-            if response.status_code == 200:
-                data = response.json()
-                status = data["data"].get("status")
-                
-                if status == "completed":
-                    return data["data"]["video_url"]
-                
-                if status == "failed":
-                    error = data["data"].get("error", "Unknown error")
-                    raise Exception(f"Video failed: {error}")
-            
-            time.sleep(3)
-        
+        return poller.wait("heygen", video_id, timeout=60, callback=bool(callback_url("heygen")))
+    except TimeoutError:
+        logger.error("Status check failed: Video generation timed out")
         raise Exception("Video generation timed out")
     except Exception as e:
         logger.error(f"Status check failed: {str(e)}")
-        raise
\ No newline at end of file
+        raise
@@ -0,0 +1,27 @@
+"""gunicorn settings for app.py, appp.py and service.py: preload, warm up once, then fork workers (see warmup.py).
+
+They are ASGI apps, served by uvicorn workers.
+"""
+import os
+
+import warmup
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'uvicorn.workers.UvicornWorker')
+# Jobs live in process memory: more than one worker needs sticky routing per job
+workers = int(os.getenv('WEB_CONCURRENCY', '1'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '300'))
+# Import the app once in the master; workers are forked with it (and the warmup) loaded
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') == '1'
+
+
+def on_starting(server):
+    # Runs in the master after the preload and before the first fork
+    if preload_app:
+        warmup.warmup()
+
+
+def post_worker_init(worker):
+    # Per-worker startup (warmup.start_worker) runs in the app's lifespan
+    if not preload_app:
+        warmup.warmup()
@@ -0,0 +1,102 @@
+import os
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# Keep-alive connections kept per host (A2E, HeyGen, Azure, tmpfiles, ...)
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', '32'))
+# Number of distinct hosts whose pools are kept around
+HTTP_POOL_HOSTS = int(os.getenv('HTTP_POOL_HOSTS', '16'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '60'))
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', '3'))
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that applies a default timeout to requests that don't set one"""
+
+    def __init__(self, timeout, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+
+class ProviderClient:
+    """Shared keep-alive HTTP client for all provider calls.
+
+    Connections are pooled per host, so repeated status polls, uploads and
+    TTS calls reuse an open TCP+TLS connection instead of handshaking again.
+    Retries cover connection errors on every method and 502/503/504 on
+    idempotent ones; POSTs are not replayed once the request was sent.
+    """
+
+    def __init__(self, pool_maxsize=HTTP_POOL_MAXSIZE, pool_hosts=HTTP_POOL_HOSTS,
+                 timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), retries=HTTP_RETRIES):
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            backoff_factor=0.5,
+            status_forcelist=(502, 503, 504),
+            raise_on_status=False,
+        )
+        self.adapter = TimeoutHTTPAdapter(
+            timeout=timeout,
+            pool_connections=pool_hosts,
+            pool_maxsize=pool_maxsize,
+            pool_block=True,
+            max_retries=retry,
+        )
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.lock = threading.Lock()
+        self.request_count = 0
+
+    def request(self, method, url, **kwargs):
+        with self.lock:
+            self.request_count += 1
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        """Per-host connection counts: every new connection is one TCP (+TLS) handshake."""
+        hosts = {}
+        for key in list(self.adapter.poolmanager.pools.keys()):
+            pool = self.adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            host = f"{pool.scheme}://{pool.host}:{pool.port}"
+            connections = pool.num_connections
+            requests_sent = pool.num_requests
+            hosts[host] = {
+                'requests': requests_sent,
+                'handshakes': connections,
+                'reused': max(requests_sent - connections, 0),
+            }
+        handshakes = sum(h['handshakes'] for h in hosts.values())
+        sent = sum(h['requests'] for h in hosts.values())
+        return {
+            'requests': self.request_count,
+            'handshakes': handshakes,
+            'reuse_ratio': round(1 - handshakes / sent, 3) if sent else 0.0,
+            'hosts': hosts,
+        }
+
+
+# Shared client used by a2e_service.py and generate_video.py
+client = ProviderClient()
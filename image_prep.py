@@ -0,0 +1,123 @@
+"""Shared image preparation: size-aware decoding and a resized layer cache.
+
+JPEGs are decoded with ``draft()``, which lets libjpeg scale by 1/2, 1/4
+or 1/8 while decoding, so a large photo never gets fully decoded just to
+be shrunk. Other formats are resized with a reducing gap, which does a
+cheap integer reduce before the final resample.
+"""
+import io
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+LAYER_CACHE_MAX_BYTES = int(os.getenv('LAYER_CACHE_MAX_BYTES', str(128 * 1024 * 1024)))
+# Longest side sent to HeyGen when creating an avatar; 0 (default) keeps the original size.
+# A cap means a full decode, resize and re-encode of larger images, so only set it for slow uplinks.
+AVATAR_IMAGE_MAX_SIDE = int(os.getenv('AVATAR_IMAGE_MAX_SIDE', '0'))
+
+
+def content_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def _fit(size, max_side):
+    if not max_side or max(size) <= max_side:
+        return size
+    scale = max_side / max(size)
+    return (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+
+
+def prepare_jpeg(image_bytes, quality=95, max_side=None):
+    """Return JPEG bytes for upload, re-encoding only when needed.
+
+    An RGB JPEG that already fits within max_side is returned untouched.
+    """
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        target = _fit(img.size, max_side)
+        if img.format == 'JPEG' and img.mode == 'RGB' and target == img.size:
+            return image_bytes
+        if img.format == 'JPEG' and target != img.size:
+            # Let libjpeg scale by 1/2, 1/4 or 1/8 while decoding
+            img.draft('RGB', target)
+        rgb_image = img.convert("RGB")
+    if rgb_image.size != target:
+        rgb_image = rgb_image.resize(target, Image.LANCZOS, reducing_gap=3.0)
+    output_buffer = io.BytesIO()
+    rgb_image.save(output_buffer, format="JPEG", quality=quality)
+    return output_buffer.getvalue()
+
+
+class LayerCache:
+    """LRU cache of resized layer bitmaps keyed by content hash and target geometry"""
+
+    def __init__(self, max_bytes=LAYER_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def load(self, path, size=None, width=None, mode='RGB', digest=None):
+        """Decode path resized to size (exact) or width (keeping aspect); returns a PIL image.
+
+        digest is the file's content_hash() when the caller already has it, so
+        a hit doesn't read the file. Returned images are shared between
+        callers and must not be modified.
+        """
+        from PIL import Image
+
+        data = None
+        if digest is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+            digest = content_hash(data)
+        key = (digest, size, width, mode)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+
+        if data is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+
+        with Image.open(io.BytesIO(data)) as img:
+            if size is None:
+                width = width or img.size[0]
+                size = (width, int(img.size[1] * width / img.size[0]))
+            if img.format == 'JPEG':
+                img.draft(mode, size)
+            layer = img.convert(mode)
+        if layer.size != size:
+            layer = layer.resize(size, Image.LANCZOS, reducing_gap=3.0)
+
+        nbytes = size[0] * size[1] * len(mode)
+        with self.lock:
+            if key in self.entries:
+                # Decoded concurrently by another render: keep the first copy, counted once
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.entries[key] = layer
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                _, old = self.entries.popitem(last=False)
+                self.total_bytes -= old.size[0] * old.size[1] * len(old.mode)
+        return layer
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.total_bytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+# Per-process cache used by the compositor
+layer_cache = LayerCache()
@@ -0,0 +1,316 @@
+"""Durable record of paid provider jobs, with crash recovery.
+
+Every A2E / HeyGen job is recorded in SQLite (WAL mode, so web workers
+read and write concurrently) as it moves through its stages:
+
+    submitting -> submitted (provider job ID known) -> completed (result URL
+    known) -> done (result delivered, or saved to JOB_ARTIFACT_DIR)
+
+or failed.
+
+The process that owns a job refreshes a heartbeat on it. When a worker
+dies (restart, deploy, OOM), its unfinished jobs stop being refreshed and,
+after JOB_LEASE seconds, another process adopts them: submitted jobs are
+polled to completion and completed ones are downloaded into
+JOB_ARTIFACT_DIR. Requests for the same provider input (request_key) pick
+up a recorded job instead of paying for a new one.
+"""
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import hashlib
+import logging
+import threading
+import multiprocessing
+from contextlib import closing, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+JOB_STORE_PATH = os.getenv('JOB_STORE_PATH', 'jobs.db')
+JOB_ARTIFACT_DIR = os.getenv('JOB_ARTIFACT_DIR', 'job_artifacts')
+# Seconds a provider result is reused and kept
+JOB_STORE_TTL = int(os.getenv('JOB_STORE_TTL', str(24 * 3600)))
+# Seconds without a heartbeat before another process adopts a job
+JOB_LEASE = float(os.getenv('JOB_LEASE', '30'))
+# Adopted jobs resumed at once
+JOB_RECOVERY_WORKERS = int(os.getenv('JOB_RECOVERY_WORKERS', '2'))
+
+SUBMITTING = 'submitting'
+SUBMITTED = 'submitted'
+COMPLETED = 'completed'
+DONE = 'done'
+FAILED = 'failed'
+# Stages that still need their owner
+ACTIVE_STAGES = (SUBMITTING, SUBMITTED, COMPLETED)
+# Stages whose provider work can be picked up by another request
+REUSABLE_STAGES = (SUBMITTED, COMPLETED, DONE)
+
+
+def request_key(provider, *parts):
+    """Key for a provider input: identical keys mean the provider would produce the same result"""
+    digest = hashlib.sha256(provider.encode('utf-8'))
+    for part in parts:
+        digest.update(b'\0' + str(part).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class JobStore:
+    """SQLite table of provider jobs, their stage and artifacts (JSON)"""
+
+    def __init__(self, path=JOB_STORE_PATH, artifact_dir=JOB_ARTIFACT_DIR, ttl=JOB_STORE_TTL, lease=JOB_LEASE):
+        self.path = path
+        self.artifact_dir = artifact_dir
+        self.ttl = ttl
+        self.lease = lease
+        self.owner = self._new_owner()
+        self.resumers = {}
+        self.executor = None
+        self.started = False
+        self.start_lock = threading.Lock()
+        self.counts = {'adopted': 0, 'recovered': 0, 'reused': 0}
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS provider_jobs ("
+                " id TEXT PRIMARY KEY,"
+                " provider TEXT NOT NULL,"
+                " request_key TEXT NOT NULL,"
+                " provider_job_id TEXT,"
+                " stage TEXT NOT NULL,"
+                " artifacts TEXT NOT NULL DEFAULT '{}',"
+                " error TEXT,"
+                " owner TEXT,"
+                " heartbeat REAL,"
+                " created_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS provider_jobs_key"
+                         " ON provider_jobs (provider, request_key, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS provider_jobs_stage ON provider_jobs (stage, heartbeat)")
+            conn.execute("CREATE INDEX IF NOT EXISTS provider_jobs_provider_job"
+                         " ON provider_jobs (provider, provider_job_id)")
+        # A forked worker (gunicorn --preload) is a new owner and has none of the parent's threads
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _new_owner(self):
+        return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def _after_fork(self):
+        self.owner = self._new_owner()
+        self.executor = None
+        self.started = False
+        self.start_lock = threading.Lock()
+
+    @contextmanager
+    def _connect(self, immediate=False):
+        """Connection for one transaction: committed (or rolled back) and closed on exit.
+
+        immediate=True takes the write lock before the first read, for read-modify-write.
+        """
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        with closing(conn):
+            # With WAL, NORMAL only risks the last commits on power loss, not on a process crash
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                if immediate:
+                    conn.execute("BEGIN IMMEDIATE")
+                yield conn
+
+    def _record(self, row):
+        if row is None:
+            return None
+        record = dict(row)
+        record['artifacts'] = json.loads(record['artifacts'])
+        return record
+
+    def create(self, provider, key):
+        """Record a job about to be submitted; returns its record ID"""
+        record_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO provider_jobs (id, provider, request_key, stage, owner, heartbeat, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (record_id, provider, key, SUBMITTING, self.owner, now, now, now),
+            )
+        return record_id
+
+    def update(self, record_id, stage=None, provider_job_id=None, error=None, release=False, **artifacts):
+        """Move a job to a stage and merge artifacts into its record; returns the record.
+
+        release=True gives up ownership so the job can be adopted right away.
+        """
+        now = time.time()
+        # Immediate, so a concurrent update (e.g. record_callback) can't merge into a stale copy
+        with self._connect(immediate=True) as conn:
+            row = conn.execute("SELECT artifacts FROM provider_jobs WHERE id = ?", (record_id,)).fetchone()
+            if row is None:
+                return None
+            merged = dict(json.loads(row['artifacts']), **artifacts)
+            conn.execute(
+                "UPDATE provider_jobs SET stage = COALESCE(?, stage),"
+                " provider_job_id = COALESCE(?, provider_job_id), error = COALESCE(?, error),"
+                " artifacts = ?, updated_at = ?, owner = CASE WHEN ? THEN NULL ELSE owner END"
+                " WHERE id = ?",
+                (stage, provider_job_id, error, json.dumps(merged), now, release, record_id),
+            )
+            return self._record(conn.execute("SELECT * FROM provider_jobs WHERE id = ?", (record_id,)).fetchone())
+
+    def get(self, record_id):
+        with self._connect() as conn:
+            return self._record(conn.execute("SELECT * FROM provider_jobs WHERE id = ?", (record_id,)).fetchone())
+
+    def find(self, provider, key):
+        """Latest unexpired job for the same input whose provider work can be reused, or None"""
+        placeholders = ','.join('?' * len(REUSABLE_STAGES))
+        with self._connect() as conn:
+            row = conn.execute(
+                f"SELECT * FROM provider_jobs WHERE provider = ? AND request_key = ? AND created_at >= ?"
+                f" AND stage IN ({placeholders}) ORDER BY created_at DESC LIMIT 1",
+                (provider, key, time.time() - self.ttl, *REUSABLE_STAGES),
+            ).fetchone()
+        record = self._record(row)
+        if record:
+            self.counts['reused'] += 1
+        return record
+
+    def record_callback(self, provider, provider_job_id, status, value):
+        """Save a provider callback's result on the job's record, for whichever worker waits on it"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT id FROM provider_jobs WHERE provider = ? AND provider_job_id = ?",
+                               (provider, provider_job_id)).fetchone()
+        if row:
+            self.update(row['id'], callback={'status': status, 'value': value})
+
+    def find_callback(self, provider, provider_job_id):
+        """(status, value) of a callback saved for the job, or None"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT artifacts FROM provider_jobs WHERE provider = ? AND provider_job_id = ?",
+                               (provider, provider_job_id)).fetchone()
+        callback = json.loads(row['artifacts']).get('callback') if row else None
+        return (callback['status'], callback['value']) if callback else None
+
+    def artifact_path(self, record_id, suffix=''):
+        return os.path.join(self.artifact_dir, f"{record_id}{suffix}")
+
+    def save_artifact(self, record_id, source_path, suffix=''):
+        """Copy a file into the artifact directory (atomically); returns its path"""
+        os.makedirs(self.artifact_dir, exist_ok=True)
+        path = self.artifact_path(record_id, suffix)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(source_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+                while True:
+                    chunk = src.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return path
+
+    def register_resumer(self, provider, resume):
+        """Register resume(record) to finish this provider's orphaned jobs (submitted or completed)"""
+        self.resumers[provider] = resume
+
+    def start(self):
+        """Start heartbeats and recovery in this process (not in render pool children)"""
+        with self.start_lock:
+            if self.started or multiprocessing.parent_process() is not None:
+                return
+            self.started = True
+            self.executor = ThreadPoolExecutor(max_workers=JOB_RECOVERY_WORKERS, thread_name_prefix='job-recovery')
+            threading.Thread(target=self._maintain, name='job-store', daemon=True).start()
+
+    def _maintain(self):
+        while True:
+            try:
+                self.heartbeat()
+                self.adopt_orphans()
+                self.prune()
+            except sqlite3.Error as e:
+                logger.error(f"Job store maintenance failed: {str(e)}")
+            time.sleep(self.lease / 3)
+
+    def heartbeat(self):
+        placeholders = ','.join('?' * len(ACTIVE_STAGES))
+        with self._connect() as conn:
+            conn.execute(f"UPDATE provider_jobs SET heartbeat = ? WHERE owner = ? AND stage IN ({placeholders})",
+                         (time.time(), self.owner, *ACTIVE_STAGES))
+
+    def adopt_orphans(self):
+        """Claim unfinished jobs whose owner stopped heartbeating and resume them; returns the claimed IDs"""
+        now = time.time()
+        providers = list(self.resumers)
+        if not providers:
+            return []
+        stages = ','.join('?' * len(ACTIVE_STAGES))
+        names = ','.join('?' * len(providers))
+        orphaned = f"stage IN ({stages}) AND (owner IS NULL OR heartbeat < ?)"
+        claimed = []
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT id FROM provider_jobs WHERE {orphaned} AND provider IN ({names}) AND created_at >= ?",
+                (*ACTIVE_STAGES, now - self.lease, *providers, now - self.ttl),
+            ).fetchall()
+            for row in rows:
+                # Compare-and-set, so two surviving workers never resume the same job
+                cursor = conn.execute(
+                    f"UPDATE provider_jobs SET owner = ?, heartbeat = ? WHERE id = ? AND {orphaned}",
+                    (self.owner, now, row['id'], *ACTIVE_STAGES, now - self.lease),
+                )
+                if cursor.rowcount == 1:
+                    claimed.append(row['id'])
+        for record_id in claimed:
+            record = self.get(record_id)
+            self.counts['adopted'] += 1
+            if record['stage'] == SUBMITTING:
+                # Died between sending the request and storing the job ID: nothing to resume
+                self.update(record_id, stage=FAILED, error="Worker stopped while submitting")
+                continue
+            logger.info(f"Adopted orphaned {record['provider']} job {record['provider_job_id']} "
+                        f"(stage {record['stage']})")
+            self.executor.submit(self._resume, record)
+        return claimed
+
+    def _resume(self, record):
+        try:
+            self.resumers[record['provider']](record)
+            self.counts['recovered'] += 1
+            logger.info(f"Recovered {record['provider']} job {record['provider_job_id']}")
+        except Exception as e:
+            logger.error(f"Recovering {record['provider']} job {record['provider_job_id']} failed: {str(e)}")
+            self.update(record['id'], stage=FAILED, error=str(e))
+
+    def prune(self):
+        """Delete expired jobs and their artifacts"""
+        cutoff = time.time() - self.ttl
+        with self._connect() as conn:
+            rows = conn.execute("SELECT id, artifacts FROM provider_jobs WHERE created_at < ?", (cutoff,)).fetchall()
+            conn.execute("DELETE FROM provider_jobs WHERE created_at < ?", (cutoff,))
+        for row in rows:
+            path = json.loads(row['artifacts']).get('path')
+            if path:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self._connect() as conn:
+            stages = dict(conn.execute("SELECT stage, COUNT(*) FROM provider_jobs GROUP BY stage").fetchall())
+        return dict(self.counts, stages=stages)
+
+
+# Shared store used by a2e_service.py and generate_video.py
+job_store = JobStore()
@@ -0,0 +1,221 @@
+"""Media buffers that keep uploads, downloads and renders off the disk.
+
+A MediaBuffer exposes a ``path`` that ffmpeg (and render pool workers) can
+open. In memory mode it is backed by an anonymous memfd and the path is
+``/proc/<pid>/fd/<n>``: readable and writable by any process of the same
+user while the owner keeps it open, with no bytes ever touching the
+filesystem. In disk mode it is a uuid-named file in the working directory,
+which is how the apps handled media before.
+"""
+import os
+import uuid
+import shutil
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+IN_MEMORY_MEDIA = os.getenv('IN_MEMORY_MEDIA', '1') == '1' and hasattr(os, 'memfd_create')
+COPY_CHUNK_SIZE = 1024 * 1024
+
+_stats = {'disk_files': 0, 'disk_bytes': 0, 'memory_files': 0, 'memory_bytes': 0}
+_stats_lock = threading.Lock()
+
+
+class MediaBuffer:
+    """A named media object usable as a path by subprocesses"""
+
+    def __init__(self, suffix='', in_memory=None, directory=None):
+        self.in_memory = IN_MEMORY_MEDIA if in_memory is None else in_memory
+        self.suffix = suffix
+        if self.in_memory:
+            self.fd = os.memfd_create(f"media{suffix}")
+            self.path = f"/proc/{os.getpid()}/fd/{self.fd}"
+        else:
+            self.fd = None
+            # Disk mode: in directory, else the working directory
+            self.path = os.path.join(directory or '', f"{uuid.uuid4()}{suffix}")
+            open(self.path, 'wb').close()
+        self.closed = False
+
+    @classmethod
+    def from_stream(cls, stream, suffix='', in_memory=None):
+        """Copy a readable stream (e.g. a Werkzeug upload) into a new buffer"""
+        media = cls(suffix, in_memory)
+        with media.open('wb') as f:
+            shutil.copyfileobj(stream, f, COPY_CHUNK_SIZE)
+        return media
+
+    @classmethod
+    def from_bytes(cls, data, suffix='', in_memory=None):
+        media = cls(suffix, in_memory)
+        with media.open('wb') as f:
+            f.write(data)
+        return media
+
+    def open(self, mode='rb'):
+        """Open an independent file object (own offset) on the buffer"""
+        return open(self.path, mode)
+
+    def read(self):
+        with self.open('rb') as f:
+            return f.read()
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def close(self):
+        """Release the buffer; in disk mode the file is deleted"""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            size = self.size()
+        except OSError:
+            size = 0
+        kind = 'memory' if self.in_memory else 'disk'
+        with _stats_lock:
+            _stats[f'{kind}_files'] += 1
+            _stats[f'{kind}_bytes'] += size
+        try:
+            if self.in_memory:
+                os.close(self.fd)
+            else:
+                os.remove(self.path)
+        except OSError as e:
+            logger.error(f"Error releasing media buffer {self.path}: {str(e)}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return f"MediaBuffer({self.path!r})"
+
+
+def stats():
+    """Files and bytes staged through media buffers, split by disk and memory"""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _link(source, path):
+    """Replace path with a hard link to source; False when that is not possible"""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.link(source, tmp_path)
+        os.replace(tmp_path, path)
+        return True
+    except OSError:
+        return False
+
+
+class MediaStream:
+    """A render target that can be streamed to clients while it is being written.
+
+    ``path`` is the write end of an anonymous pipe, so ffmpeg sees a
+    non-seekable output and must use a streamable format (fragmented MP4).
+    A pump thread copies everything it writes into a MediaBuffer; readers
+    tail that buffer with iter_chunks() as it grows, and once the producer
+    is done the buffer holds the complete file for later downloads.
+    """
+
+    def __init__(self, suffix='.mp4', in_memory=None):
+        self.media = MediaBuffer(suffix, in_memory)
+        self.read_fd, self.write_fd = os.pipe()
+        self.path = f"/proc/{os.getpid()}/fd/{self.write_fd}"
+        self.size = 0
+        self.done = False
+        self.error = None
+        self.condition = threading.Condition()
+        threading.Thread(target=self._pump, name='media-stream', daemon=True).start()
+
+    def _pump(self):
+        try:
+            with self.media.open('wb') as f:
+                while True:
+                    chunk = os.read(self.read_fd, COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    f.flush()
+                    with self.condition:
+                        self.size += len(chunk)
+                        self.condition.notify_all()
+        finally:
+            os.close(self.read_fd)
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+
+    def finish(self, error=None):
+        """Call once the producer has exited; readers see EOF (or the error)"""
+        with self.condition:
+            if error is not None:
+                self.error = error
+            if self.write_fd is None:
+                return
+            os.close(self.write_fd)
+            self.write_fd = None
+
+    def wait(self, timeout=None):
+        """Block until the producer finished and every byte was copied"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.done, timeout)
+        if self.error is not None:
+            raise self.error
+        return self
+
+    def iter_chunks(self, chunk_size=256 * 1024, timeout=None):
+        """Yield bytes as they arrive; raises the producer's error if it failed.
+
+        With timeout, raises TimeoutError when no bytes arrived for that many seconds.
+        """
+        position = 0
+        with self.media.open('rb') as f:
+            while True:
+                with self.condition:
+                    if not self.condition.wait_for(lambda: self.size > position or self.done, timeout):
+                        raise TimeoutError(f"No output for {timeout}s")
+                    available = self.size - position
+                    done = self.done
+                while available > 0:
+                    chunk = f.read(min(chunk_size, available))
+                    if not chunk:
+                        break
+                    position += len(chunk)
+                    available -= len(chunk)
+                    yield chunk
+                if done and position >= self.size:
+                    break
+        if self.error is not None:
+            raise self.error
+
+    def open(self, mode='rb'):
+        return self.media.open(mode)
+
+    def spill(self, directory=None, source=None):
+        """Move a finished in-memory video to a disk buffer in directory, so a kept result does not hold RAM.
+
+        source is a file with the same video (e.g. its output cache entry):
+        it is hard-linked instead of copied when the filesystem allows.
+        Readers that already opened the video keep reading the memory copy.
+        """
+        if not self.done or not self.media.in_memory:
+            return
+        disk = MediaBuffer(self.media.suffix, in_memory=False, directory=directory)
+        try:
+            if not (source and _link(source, disk.path)):
+                with self.media.open('rb') as src, disk.open('wb') as dst:
+                    shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+        except Exception:
+            disk.close()
+            raise
+        memory, self.media = self.media, disk
+        memory.close()
+
+    def close(self):
+        self.finish()
+        self.media.close()
@@ -0,0 +1,195 @@
+"""Timing spans, counters and histograms with a Prometheus text exposition.
+
+    with span('download'):
+        ...
+
+records the stage duration in ``video_stage_seconds{stage="download"}``
+and logs one structured line per span. The current trace ID lives in a
+ContextVar; the service's I/O pool, the render pool and Pipeline copy
+the context into their worker threads, so spans inside background jobs
+carry the trace ID of the request that started them.
+"""
+import os
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Response header carrying the trace ID; empty disables it
+TRACE_HEADER = os.getenv('TRACE_HEADER', 'X-Trace-ID')
+# Seconds; provider jobs and encodes can take minutes
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+trace_id = contextvars.ContextVar('trace_id', default=None)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {round(value, 6)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][index] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ('le',)
+        with self.lock:
+            for key, series in sorted(self.series.items()):
+                for bound, count in zip(self.buckets, series['buckets']):
+                    lines.append(f"{self.name}_bucket{_format_labels(names, key + (bound,))} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(names, key + ('+Inf',))} {series['count']}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {round(series['sum'], 6)}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {series['count']}")
+        return lines
+
+
+class Registry:
+    """Holds metrics and gauge callbacks and renders them as Prometheus text"""
+
+    def __init__(self):
+        self.metrics = []
+        self.gauges = []
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help, fn):
+        """Register a gauge read at scrape time; fn returns a number or {label value: number}"""
+        self.gauges.append((name, help, fn))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for name, help, fn in self.gauges:
+            try:
+                value = fn()
+            except Exception as e:
+                logger.error(f"Gauge {name} failed: {str(e)}")
+                continue
+            lines.extend([f"# HELP {name} {help}", f"# TYPE {name} gauge"])
+            if isinstance(value, dict):
+                for label, item in sorted(value.items()):
+                    lines.append(f'{name}{{key="{label}"}} {item}')
+            else:
+                lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+stage_seconds = registry.histogram('video_stage_seconds', 'Time spent in each video generation stage',
+                                   labels=('stage', 'status'))
+http_requests = registry.counter('http_requests_total', 'HTTP requests handled', labels=('endpoint', 'method', 'code'))
+http_request_seconds = registry.histogram('http_request_seconds', 'Time to produce the HTTP response headers',
+                                          labels=('endpoint',))
+http_send_seconds = registry.histogram('http_send_seconds', 'Time to send the HTTP response body',
+                                       labels=('endpoint',))
+
+
+def observe_stage(stage, seconds, status='ok', trace=None, log=True):
+    """Record a stage duration measured elsewhere (e.g. in a render worker)"""
+    stage_seconds.observe(seconds, stage=stage, status=status)
+    if log:
+        logger.info(f"span stage={stage} status={status} seconds={seconds:.3f} trace_id={trace or trace_id.get() or '-'}")
+
+
+@contextmanager
+def span(stage):
+    """Time the enclosed block as one stage; failures are recorded with status=error"""
+    start = time.perf_counter()
+    status = 'error'
+    try:
+        yield
+        status = 'ok'
+    finally:
+        observe_stage(stage, time.perf_counter() - start, status)
+
+
+def instrument_asgi(app):
+    """Add trace IDs, per-endpoint request metrics and a /metrics route to a FastAPI app"""
+    from fastapi import Request
+    from fastapi.responses import PlainTextResponse
+
+    @app.middleware('http')
+    async def trace_request(request: Request, call_next):
+        incoming = request.headers.get(TRACE_HEADER or 'X-Trace-ID', '')[:64]
+        token = trace_id.set(incoming or uuid.uuid4().hex)
+        start = time.perf_counter()
+        try:
+            response = await call_next(request)
+            endpoint = getattr(request.scope.get('endpoint'), '__name__', 'unknown')
+            http_request_seconds.observe(time.perf_counter() - start, endpoint=endpoint)
+            http_requests.inc(endpoint=endpoint, method=request.method, code=response.status_code)
+            if TRACE_HEADER:
+                response.headers[TRACE_HEADER] = trace_id.get()
+        finally:
+            trace_id.reset(token)
+        body = response.body_iterator
+
+        async def timed_body():
+            send_start = time.perf_counter()
+            try:
+                async for chunk in body:
+                    yield chunk
+            finally:
+                http_send_seconds.observe(time.perf_counter() - send_start, endpoint=endpoint)
+
+        response.body_iterator = timed_body()
+        return response
+
+    @app.get('/metrics')
+    def metrics():
+        return PlainTextResponse(registry.render(), media_type='text/plain; version=0.0.4')
@@ -0,0 +1,298 @@
+"""Local stand-ins for the A2E.ai, HeyGen, Azure TTS and tmpfiles.org APIs.
+
+Run it and point the apps at it:
+
+    python mock_providers.py --port 5055 --latency 0.05 --failure-rate 0.01
+    A2E_API_URL=http://127.0.0.1:5055 python app.py
+
+    HEYGEN_API_URL=http://127.0.0.1:5055/v1
+    AZURE_TTS_ENDPOINT=http://127.0.0.1:5055/azure
+    TMPFILES_UPLOAD_URL=http://127.0.0.1:5055/api/v1/upload
+
+Every provider job stays 'processing' for the job duration and then
+completes with a canned mp4 (audio requests get a canned mp3). Latency is
+added to every request; failure rates make submit calls return 500 or
+jobs end up 'failed', to exercise error paths under load. A rate limit
+makes A2E and HeyGen API calls beyond it get 429 with Retry-After. Jobs submitted
+with a ``callback_url`` get a completion webhook when they finish (A2E
+style for A2E jobs, HeyGen avail_video events for HeyGen videos), unless
+the callback drop rate says this one gets lost. With CALLBACK_SECRET set,
+callbacks are signed with it like the apps expect.
+"""
+import os
+import hmac
+import json
+import time
+import uuid
+import hashlib
+import random
+import argparse
+import subprocess
+import threading
+import logging
+import requests
+from flask import Flask, request, jsonify, send_file
+from compositor import ffmpeg_exe
+
+logger = logging.getLogger(__name__)
+
+# Seconds a mock job stays in 'processing' before completing
+MOCK_JOB_DURATION = float(os.getenv('MOCK_JOB_DURATION', '5'))
+# Seconds added to every request, +/- MOCK_LATENCY_JITTER (a fraction)
+MOCK_LATENCY = float(os.getenv('MOCK_LATENCY', '0'))
+MOCK_LATENCY_JITTER = float(os.getenv('MOCK_LATENCY_JITTER', '0.2'))
+# Fraction of submit calls answered with a 500, and of jobs that end up failed
+MOCK_FAILURE_RATE = float(os.getenv('MOCK_FAILURE_RATE', '0'))
+MOCK_JOB_FAILURE_RATE = float(os.getenv('MOCK_JOB_FAILURE_RATE', '0'))
+# Fraction of completion callbacks that are never sent
+MOCK_CALLBACK_DROP_RATE = float(os.getenv('MOCK_CALLBACK_DROP_RATE', '0'))
+# Key for the callbacks' HMAC-SHA256 Signature header, like a provider's webhook secret
+MOCK_CALLBACK_SECRET = os.getenv('CALLBACK_SECRET', '')
+# A2E / HeyGen API requests per second (each) before answering 429; 0 means unlimited
+MOCK_RATE_LIMIT = float(os.getenv('MOCK_RATE_LIMIT', '0'))
+# Canned avatar clip and speech returned for every job (generated on first use)
+MOCK_VIDEO_PATH = os.getenv('MOCK_VIDEO_PATH', 'mock_avatar.mp4')
+MOCK_VIDEO_SECONDS = float(os.getenv('MOCK_VIDEO_SECONDS', '3'))
+MOCK_AUDIO_PATH = os.getenv('MOCK_AUDIO_PATH', 'mock_speech.mp3')
+
+_video_lock = threading.Lock()
+
+
+def ensure_mock_video(path=MOCK_VIDEO_PATH, seconds=MOCK_VIDEO_SECONDS, size=1080):
+    """Create a talking-head sized test clip with audio if it does not exist yet."""
+    with _video_lock:
+        if not os.path.exists(path):
+            subprocess.run([
+                ffmpeg_exe(), '-y', '-loglevel', 'error',
+                '-f', 'lavfi', '-i', f'testsrc=size={size}x{size}:rate=24:duration={seconds}',
+                '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+                '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-shortest',
+                # Like provider CDN output: moov first, so clients can start decoding early
+                '-movflags', '+faststart', path,
+            ], check=True)
+    return path
+
+
+def ensure_mock_audio(path=MOCK_AUDIO_PATH, seconds=MOCK_VIDEO_SECONDS):
+    """Create a speech-length mp3 if it does not exist yet."""
+    with _video_lock:
+        if not os.path.exists(path):
+            subprocess.run([
+                ffmpeg_exe(), '-y', '-loglevel', 'error',
+                '-f', 'lavfi', '-i', f'sine=frequency=220:duration={seconds}',
+                '-c:a', 'libmp3lame', '-b:a', '32k', '-f', 'mp3', path,
+            ], check=True)
+    return path
+
+
+def create_app(job_duration=MOCK_JOB_DURATION, latency=MOCK_LATENCY, latency_jitter=MOCK_LATENCY_JITTER,
+               failure_rate=MOCK_FAILURE_RATE, job_failure_rate=MOCK_JOB_FAILURE_RATE,
+               callback_drop_rate=MOCK_CALLBACK_DROP_RATE, rate_limit=MOCK_RATE_LIMIT):
+    """Build the mock provider app. Job state lives in memory."""
+    app = Flask(__name__)
+    app.config['jobs'] = {}
+    app.config['requests'] = {}
+    # Per-provider token buckets: provider -> [tokens, last refill]
+    buckets = {}
+    buckets_lock = threading.Lock()
+
+    def rate_limited():
+        """Seconds until the provider's next free request, or 0 if this one is allowed"""
+        if request.path.startswith('/api/v1/video') or request.path.startswith('/api/v1/job'):
+            provider = 'a2e'
+        elif request.path.startswith('/v1/'):
+            provider = 'heygen'
+        else:
+            return 0
+        with buckets_lock:
+            now = time.monotonic()
+            burst = max(1.0, rate_limit)
+            tokens, updated = buckets.get(provider, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate_limit)
+            if tokens < 1:
+                buckets[provider] = (tokens, now)
+                return (1 - tokens) / rate_limit
+            buckets[provider] = (tokens - 1, now)
+            return 0
+
+    def new_job(provider, payload):
+        job_id = uuid.uuid4().hex
+        job = app.config['jobs'][job_id] = {'payload': payload, 'created_at': time.time(),
+                                            'fails': random.random() < job_failure_rate}
+        if payload.get('callback_url'):
+            if random.random() < callback_drop_rate:
+                logger.info(f"Dropping callback for {provider} job {job_id}")
+            else:
+                timer = threading.Timer(job_duration, send_callback,
+                                        args=(provider, job_id, job, request.host_url))
+                timer.daemon = True
+                timer.start()
+        return job_id
+
+    def send_callback(provider, job_id, job, host_url):
+        video_url = f"{host_url}media/avatar.mp4"
+        if provider == 'a2e' and job['fails']:
+            body = {'job_id': job_id, 'status': 'failed', 'error': 'Injected job failure'}
+        elif provider == 'a2e':
+            body = {'job_id': job_id, 'status': 'completed', 'result': {'video_url': video_url}}
+        elif job['fails']:
+            body = {'event_type': 'avail_video.fail',
+                    'event_data': {'video_id': job_id, 'msg': 'Injected job failure'}}
+        else:
+            body = {'event_type': 'avail_video.success',
+                    'event_data': {'video_id': job_id, 'url': video_url}}
+        data = json.dumps(body).encode()
+        headers = {'Content-Type': 'application/json'}
+        if MOCK_CALLBACK_SECRET:
+            headers['Signature'] = hmac.new(MOCK_CALLBACK_SECRET.encode(), data, hashlib.sha256).hexdigest()
+        try:
+            requests.post(job['payload']['callback_url'], data=data, headers=headers, timeout=10)
+        except requests.RequestException as e:
+            logger.error(f"Callback for {provider} job {job_id} failed: {str(e)}")
+
+    def job_state(job_id):
+        """Return (status, job) where status is processing, completed, failed or None if unknown"""
+        job = app.config['jobs'].get(job_id)
+        if not job:
+            return None, None
+        if time.time() - job['created_at'] < job_duration:
+            return 'processing', job
+        return ('failed' if job['fails'] else 'completed'), job
+
+    def submit_fails():
+        return random.random() < failure_rate
+
+    @app.before_request
+    def add_latency():
+        counts = app.config['requests']
+        counts[request.endpoint] = counts.get(request.endpoint, 0) + 1
+        if latency:
+            time.sleep(latency * random.uniform(1 - latency_jitter, 1 + latency_jitter))
+        retry_after = rate_limited() if rate_limit else 0
+        if retry_after:
+            counts['rate_limited'] = counts.get('rate_limited', 0) + 1
+            return jsonify({'error': 'Rate limit exceeded'}), 429, {'Retry-After': f"{retry_after:.2f}"}
+
+    # A2E.ai
+
+    @app.route('/api/v1/video/generate', methods=['POST'])
+    def a2e_generate():
+        payload = request.get_json(silent=True) or {}
+        if not payload.get('text'):
+            return jsonify({'error': 'text is required'}), 400
+        if submit_fails():
+            return jsonify({'error': 'Injected failure'}), 500
+        return jsonify({'job_id': new_job('a2e', payload)})
+
+    @app.route('/api/v1/job/<job_id>')
+    def a2e_job(job_id):
+        status, _ = job_state(job_id)
+        if status is None:
+            return jsonify({'status': 'failed', 'error': 'Unknown job'}), 404
+        if status == 'failed':
+            return jsonify({'status': 'failed', 'error': 'Injected job failure'})
+        if status == 'processing':
+            return jsonify({'status': 'processing'})
+        return jsonify({
+            'status': 'completed',
+            'result': {'video_url': f"{request.host_url}media/avatar.mp4"},
+        })
+
+    # HeyGen
+
+    @app.route('/v1/avatars', methods=['POST'])
+    def heygen_avatar():
+        if 'file' not in request.files:
+            return jsonify({'error': {'message': 'file is required'}}), 400
+        if submit_fails():
+            return jsonify({'error': {'message': 'Injected failure'}}), 500
+        request.files['file'].read()
+        return jsonify({'data': {'avatar_id': uuid.uuid4().hex}})
+
+    @app.route('/v1/video/generate', methods=['POST'])
+    def heygen_generate():
+        payload = request.get_json(silent=True) or {}
+        if not payload.get('video_inputs'):
+            return jsonify({'error': {'message': 'video_inputs is required'}}), 400
+        if submit_fails():
+            return jsonify({'error': {'message': 'Injected failure'}}), 500
+        return jsonify({'data': {'video_id': new_job('heygen', payload)}})
+
+    def heygen_status(job_id):
+        status, _ = job_state(job_id)
+        if status is None:
+            return jsonify({'error': {'message': 'Unknown video'}}), 404
+        data = {'video_id': job_id, 'status': status}
+        if status == 'completed':
+            data['video_url'] = f"{request.host_url}media/avatar.mp4"
+        if status == 'failed':
+            data['error'] = 'Injected job failure'
+        return jsonify({'data': data})
+
+    @app.route('/v1/video_status')
+    def heygen_video_status():
+        return heygen_status(request.args.get('video_id'))
+
+    @app.route('/v1/video/<video_id>')
+    def heygen_video(video_id):
+        return heygen_status(video_id)
+
+    # Azure TTS
+
+    @app.route('/azure/sts/v1.0/issueToken', methods=['POST'])
+    def azure_token():
+        return uuid.uuid4().hex
+
+    @app.route('/azure/cognitiveservices/v1', methods=['POST'])
+    def azure_tts():
+        if not request.headers.get('Authorization', '').startswith('Bearer '):
+            return 'Unauthorized', 401
+        if submit_fails():
+            return 'Injected failure', 500
+        return send_file(os.path.abspath(ensure_mock_audio()), mimetype='audio/mpeg')
+
+    # tmpfiles.org
+
+    @app.route('/api/v1/upload', methods=['POST'])
+    def tmpfiles_upload():
+        if 'file' not in request.files:
+            return jsonify({'status': 'error'}), 400
+        if submit_fails():
+            return jsonify({'status': 'error', 'message': 'Injected failure'}), 500
+        request.files['file'].read()
+        # A URL per upload, as tmpfiles.org gives: provider jobs are deduplicated by their audio URL
+        return jsonify({'status': 'success', 'data': {'url': f"{request.host_url}media/speech/{uuid.uuid4().hex}.mp3"}})
+
+    # Canned media
+
+    @app.route('/media/avatar.mp4')
+    def media_avatar():
+        return send_file(os.path.abspath(ensure_mock_video()), mimetype='video/mp4')
+
+    @app.route('/media/speech.mp3')
+    @app.route('/media/speech/<upload_id>.mp3')
+    def media_speech(upload_id=None):
+        return send_file(os.path.abspath(ensure_mock_audio()), mimetype='audio/mpeg')
+
+    @app.route('/mock/stats')
+    def mock_stats():
+        """Requests served per endpoint, so benchmarks can count provider calls."""
+        return jsonify(app.config['requests'])
+
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run local provider stand-ins.')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--job-duration', type=float, default=MOCK_JOB_DURATION)
+    parser.add_argument('--latency', type=float, default=MOCK_LATENCY)
+    parser.add_argument('--latency-jitter', type=float, default=MOCK_LATENCY_JITTER)
+    parser.add_argument('--failure-rate', type=float, default=MOCK_FAILURE_RATE)
+    parser.add_argument('--job-failure-rate', type=float, default=MOCK_JOB_FAILURE_RATE)
+    parser.add_argument('--callback-drop-rate', type=float, default=MOCK_CALLBACK_DROP_RATE)
+    parser.add_argument('--rate-limit', type=float, default=MOCK_RATE_LIMIT)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    create_app(args.job_duration, args.latency, args.latency_jitter, args.failure_rate,
+               args.job_failure_rate, args.callback_drop_rate, args.rate_limit).run(port=args.port, threaded=True)
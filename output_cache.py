@@ -0,0 +1,167 @@
+import os
+import re
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_CACHE_DIR = os.getenv('OUTPUT_CACHE_DIR', 'output_cache')
+OUTPUT_CACHE_MAX_BYTES = int(os.getenv('OUTPUT_CACHE_MAX_BYTES', str(2 * 1024 * 1024 * 1024)))
+# Seconds a rendered video is served from the cache before it is re-generated
+OUTPUT_CACHE_TTL = int(os.getenv('OUTPUT_CACHE_TTL', str(24 * 3600)))
+# Bump when the rendering changes so old outputs are not served for new requests
+RENDER_VERSION = '1'
+
+_KEY_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fingerprint(files, fields):
+    """Deterministic key for a render request.
+
+    files is a list of upload paths (None for a missing optional upload),
+    hashed by content; fields is a dict of already-normalized form values
+    and render settings.
+    """
+    digest = hashlib.sha256(RENDER_VERSION.encode())
+    for path in files:
+        digest.update(b'\0' + (file_digest(path).encode() if path else b'-'))
+    for name in sorted(fields):
+        digest.update(f"\0{name}={fields[name]}".encode('utf-8'))
+    return digest.hexdigest()
+
+
+class OutputCache:
+    """On-disk cache of rendered videos keyed by request fingerprint.
+
+    Entries expire ttl seconds after they were written and are evicted
+    least-recently-used once the directory exceeds max_bytes.
+    """
+
+    def __init__(self, directory=OUTPUT_CACHE_DIR, max_bytes=OUTPUT_CACHE_MAX_BYTES, ttl=OUTPUT_CACHE_TTL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.index = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def path_for(self, key):
+        return os.path.join(self.directory, f"{key}.mp4")
+
+    def get(self, key):
+        """Return the cached video path for key, or None on a miss or expiry"""
+        if not _KEY_PATTERN.fullmatch(key or ''):
+            return None
+        path = self.path_for(key)
+        with self.lock:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            if stat and stat.st_mtime + self.ttl > time.time():
+                if key not in self.index:
+                    # Written by another worker process sharing the directory
+                    self._add(key, stat.st_size)
+                self.index.move_to_end(key)
+                self.hits += 1
+                return path
+            if key in self.index:
+                self.total_bytes -= self.index.pop(key)
+            if stat:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, stream):
+        """Copy a readable stream into the cache under key and return the cached path"""
+        path = self.path_for(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                shutil.copyfileobj(stream, f, 1024 * 1024)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self.lock:
+            if key in self.index:
+                self.total_bytes -= self.index.pop(key)
+            self._add(key, os.path.getsize(path))
+            self._evict()
+        logger.info(f"Cached rendered video: {key}")
+        return path
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.index),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def _add(self, key, size):
+        self.index[key] = size
+        self.total_bytes += size
+
+    def _remove(self, key):
+        try:
+            os.remove(self.path_for(key))
+            logger.info(f"Evicted cached video: {key}")
+        except OSError:
+            pass
+
+    def _evict(self):
+        cutoff = time.time() - self.ttl
+        for key in list(self.index):
+            try:
+                expired = os.path.getmtime(self.path_for(key)) < cutoff
+            except OSError:
+                expired = True
+            if expired:
+                self.total_bytes -= self.index.pop(key)
+                self._remove(key)
+        while self.total_bytes > self.max_bytes and len(self.index) > 1:
+            key, size = self.index.popitem(last=False)
+            self.total_bytes -= size
+            self._remove(key)
+
+    def _load(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.tmp'):
+                # Left behind by a crashed writer
+                if os.path.getmtime(path) < time.time() - 3600:
+                    os.remove(path)
+                continue
+            if not name.endswith('.mp4'):
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name[:-len('.mp4')], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._add(key, size)
+        with self.lock:
+            self._evict()
+
+
+# Shared cache used by service.py
+output_cache = OutputCache()
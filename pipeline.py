@@ -0,0 +1,116 @@
+import time
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from metrics import observe_stage
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineCancelled(Exception):
+    """Raised for stages skipped because a sibling stage failed."""
+
+
+class Pipeline:
+    """Runs stages as a dependency graph with concurrent execution.
+
+    Each stage is ``fn(**results_of_its_deps)``. Stages start as soon as
+    their dependencies finish, so the wall-clock time is the critical path
+    rather than the sum of all stages. When a stage fails, stages that have
+    not started are cancelled and the first error is re-raised without
+    waiting for the running ones. Those are not interrupted: a stage that
+    makes several network calls should call ``check_cancelled()`` between
+    them, so it stops at the next call instead of finishing work nobody
+    will use. Per-stage timings are kept in ``timings``.
+    """
+
+    def __init__(self, name, max_workers=4):
+        self.name = name
+        self.max_workers = max_workers
+        self.stages = {}
+        self.timings = {}
+        self.cancelled = threading.Event()
+
+    def stage(self, name, fn, deps=()):
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dep}")
+        self.stages[name] = {'fn': fn, 'deps': tuple(deps)}
+        return self
+
+    def check_cancelled(self):
+        """Raise PipelineCancelled once a sibling stage has failed"""
+        if self.cancelled.is_set():
+            raise PipelineCancelled(f"{self.name} cancelled")
+
+    def run(self):
+        """Execute every stage; returns {stage name: result}"""
+        results = {}
+        pending = dict(self.stages)
+        running = {}
+        error = None
+        started = time.perf_counter()
+        executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=f"{self.name}-stage")
+        try:
+            while pending or running:
+                for name, stage in list(pending.items()):
+                    if all(dep in results for dep in stage['deps']):
+                        kwargs = {dep: results[dep] for dep in stage['deps']}
+                        future = executor.submit(contextvars.copy_context().run,
+                                                 self._run_stage, name, stage['fn'], kwargs, started)
+                        running[future] = name
+                        del pending[name]
+                if not running:
+                    raise ValueError(f"{self.name}: dependency cycle between {sorted(pending)}")
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        error = e
+                        logger.error(f"{self.name}: stage {name} failed, cancelling {sorted(pending) + sorted(running.values())}")
+                        break
+                if error is not None:
+                    break
+        finally:
+            if error is not None:
+                # Don't wait for siblings: queued stages are dropped, running ones see `cancelled`
+                self.cancelled.set()
+                for name in pending:
+                    self.timings[name] = {'status': 'cancelled'}
+                for name in running.values():
+                    self.timings.setdefault(name, {'status': 'abandoned'})
+            executor.shutdown(wait=error is None, cancel_futures=True)
+
+        total = time.perf_counter() - started
+        self.timings['_total'] = {'seconds': round(total, 3)}
+        logger.info(f"{self.name}: " + ', '.join(
+            f"{name}={timing['seconds']}s" for name, timing in self.timings.items() if 'seconds' in timing))
+        if error is not None:
+            raise error
+        return results
+
+    def _run_stage(self, name, fn, kwargs, started):
+        if self.cancelled.is_set():
+            self.timings[name] = {'status': 'cancelled'}
+            raise PipelineCancelled(f"Stage {name} cancelled")
+        start = time.perf_counter()
+        status = 'failed'
+        try:
+            result = fn(**kwargs)
+            status = 'completed'
+            return result
+        except PipelineCancelled:
+            status = 'cancelled'
+            raise
+        finally:
+            end = time.perf_counter()
+            observe_stage(f"{self.name}.{name}", end - start, 'ok' if status == 'completed' else 'error')
+            self.timings[name] = {
+                'status': status,
+                'start': round(start - started, 3),
+                'end': round(end - started, 3),
+                'seconds': round(end - start, 3),
+            }
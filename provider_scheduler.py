@@ -0,0 +1,316 @@
+"""Per-provider rate limits, concurrency quotas and priority lanes.
+
+A2E and HeyGen cap both the request rate and the number of jobs a key may
+have processing at once. Every provider gets:
+
+* a token bucket (``rate`` requests per second, up to ``burst`` at once)
+  that each API call draws from,
+* ``concurrency`` job slots, held from submitting a job until its result
+  is in,
+* a Retry-After block: a 429 empties the bucket and stops every caller
+  until the provider's Retry-After has passed.
+
+Waiters are served in lane order, interactive before batch, then first
+come first served. Status polls never queue: they take a token when one is
+free, and while callers are queued they get every other token, so polls
+for jobs already holding slots keep going under submit pressure.
+
+The lane is a ContextVar, so a batch route sets it once and every task it
+starts inherits it. The render pool's backlog starts queued renders in
+lane order too, so an interactive render is not stuck behind queued batch
+renders:
+
+    with lane('batch'):
+        asyncio.create_task(...)
+
+    with scheduler.slot('a2e'):
+        response = scheduler.call('a2e', lambda: client.post(...))
+        ...
+"""
+import os
+import time
+import heapq
+import logging
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Lanes in priority order
+LANES = ('interactive', 'batch')
+# Seconds a call may wait for a slot or token before giving up
+PROVIDER_QUEUE_TIMEOUT = float(os.getenv('PROVIDER_QUEUE_TIMEOUT', '600'))
+# Times a call answered with 429 is retried after Retry-After
+PROVIDER_429_RETRIES = int(os.getenv('PROVIDER_429_RETRIES', '3'))
+# Back-off when a 429 has no usable Retry-After
+DEFAULT_RETRY_AFTER = 5.0
+# Provider quotas: requests per second, requests allowed in a burst, jobs processing at once
+A2E_RATE_LIMIT = float(os.getenv('A2E_RATE_LIMIT', '2'))
+A2E_BURST = int(os.getenv('A2E_BURST', '4'))
+A2E_MAX_JOBS = int(os.getenv('A2E_MAX_JOBS', '4'))
+HEYGEN_RATE_LIMIT = float(os.getenv('HEYGEN_RATE_LIMIT', '1'))
+HEYGEN_BURST = int(os.getenv('HEYGEN_BURST', '3'))
+HEYGEN_MAX_JOBS = int(os.getenv('HEYGEN_MAX_JOBS', '3'))
+
+current_lane = contextvars.ContextVar('provider_lane', default='interactive')
+
+provider_wait_seconds = registry.histogram('provider_wait_seconds', 'Time spent queued for a provider slot or token',
+                                           labels=('provider', 'lane', 'kind'))
+provider_throttled = registry.counter('provider_throttled_total', '429 responses received, per provider',
+                                      labels=('provider',))
+
+
+class ProviderBusy(Exception):
+    """Raised when a provider slot or token could not be had within the queue timeout."""
+
+
+class RateLimited(Exception):
+    """Raised by status checks that got a 429; the poller backs off for retry_after."""
+
+    def __init__(self, retry_after=DEFAULT_RETRY_AFTER):
+        super().__init__(f"Rate limited, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+@contextmanager
+def lane(name):
+    """Run the block (and jobs queued from it) in the given priority lane"""
+    if name not in LANES:
+        raise ValueError(f"Unknown lane: {name}")
+    token = current_lane.set(name)
+    try:
+        yield
+    finally:
+        current_lane.reset(token)
+
+
+def retry_after_seconds(headers, default=DEFAULT_RETRY_AFTER):
+    """Parse a Retry-After header (seconds or HTTP date)"""
+    value = (headers.get('Retry-After') or '').strip()
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+class ProviderQuota:
+    """Token bucket, job slots and Retry-After block for one provider"""
+
+    def __init__(self, name, rate, burst, concurrency):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.active = 0
+        # Whether the last token went to a status poll (polls alternate with queued callers)
+        self.poll_took_last = False
+        # Heaps of (lane priority, sequence) tickets
+        self.slot_waiters = []
+        self.token_waiters = []
+        self.condition = threading.Condition()
+        self.counts = {'requests': 0, 'polls': 0, 'throttled': 0, 'slots': 0}
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _token_delay(self, now):
+        """Seconds until a token is free, 0 if one is free now"""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def _wait_turn(self, waiters, ticket, ready, deadline):
+        """Queue ticket and block until it is first in line and ready() returns 0.
+
+        ready returns seconds to wait before checking again, or None to wait
+        for a notify. Called with the condition held.
+        """
+        heapq.heappush(waiters, ticket)
+        try:
+            while True:
+                now = time.monotonic()
+                wait = ready(now) if waiters[0] == ticket else None
+                if wait == 0:
+                    heapq.heappop(waiters)
+                    self.condition.notify_all()
+                    return
+                if now >= deadline:
+                    raise ProviderBusy(f"Timed out waiting for {self.name} capacity")
+                self.condition.wait(min(wait, deadline - now) if wait is not None else deadline - now)
+        except BaseException:
+            if ticket in waiters:
+                waiters.remove(ticket)
+                heapq.heapify(waiters)
+                self.condition.notify_all()
+            raise
+
+    def take_token(self, ticket, deadline):
+        def ready(now):
+            self._refill(now)
+            return self._token_delay(now)
+
+        with self.condition:
+            self._wait_turn(self.token_waiters, ticket, ready, deadline)
+            self.tokens -= 1
+            self.poll_took_last = False
+            self.counts['requests'] += 1
+
+    def try_token(self):
+        """Take a token without waiting; returns 0 or seconds to retry in.
+
+        While callers are queued a poll only gets every other token, so
+        neither side can starve the other.
+        """
+        with self.condition:
+            now = time.monotonic()
+            self._refill(now)
+            delay = self._token_delay(now)
+            if self.token_waiters and self.poll_took_last:
+                return max(delay, 1 / self.rate)
+            if delay == 0:
+                self.tokens -= 1
+                self.poll_took_last = True
+                self.counts['requests'] += 1
+                self.counts['polls'] += 1
+            return delay
+
+    def take_slot(self, ticket, deadline):
+        with self.condition:
+            self._wait_turn(self.slot_waiters, ticket,
+                            lambda now: 0 if self.active < self.concurrency else None, deadline)
+            self.active += 1
+            self.counts['slots'] += 1
+
+    def release_slot(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def throttle(self, seconds):
+        """Stop handing out tokens for seconds (a 429's Retry-After)"""
+        with self.condition:
+            self.tokens = 0.0
+            self.updated = time.monotonic()
+            self.blocked_until = max(self.blocked_until, self.updated + seconds)
+            self.counts['throttled'] += 1
+
+    def stats(self):
+        with self.condition:
+            queued = {f"{kind}/{name}": 0 for kind in ('slot', 'token') for name in LANES}
+            for kind, waiters in (('slot', self.slot_waiters), ('token', self.token_waiters)):
+                for priority, _ in waiters:
+                    queued[f"{kind}/{LANES[priority]}"] += 1
+            return dict(self.counts, rate=self.rate, burst=self.burst, concurrency=self.concurrency,
+                        active=self.active, queued=queued,
+                        blocked_for=round(max(0.0, self.blocked_until - time.monotonic()), 3))
+
+
+class ProviderScheduler:
+    """Registry of provider quotas, with helpers that wait in the caller's lane"""
+
+    def __init__(self, queue_timeout=PROVIDER_QUEUE_TIMEOUT, retries=PROVIDER_429_RETRIES):
+        self.queue_timeout = queue_timeout
+        self.retries = retries
+        self.quotas = {}
+        self.sequence = itertools.count()
+
+    def configure(self, provider, rate=1.0, burst=1, concurrency=4):
+        """Set (or replace) a provider's request rate, burst and job concurrency"""
+        self.quotas[provider] = ProviderQuota(provider, rate, burst, concurrency)
+
+    def _quota(self, provider):
+        quota = self.quotas.get(provider)
+        if quota is None:
+            raise ValueError(f"Unknown provider: {provider}")
+        return quota
+
+    def _ticket(self):
+        name = current_lane.get()
+        return (LANES.index(name) if name in LANES else 0, next(self.sequence)), name
+
+    def _timed(self, provider, kind, take):
+        ticket, lane_name = self._ticket()
+        start = time.monotonic()
+        try:
+            take(ticket, start + self.queue_timeout)
+        finally:
+            waited = time.monotonic() - start
+            provider_wait_seconds.observe(waited, provider=provider, lane=lane_name, kind=kind)
+        if waited > 1:
+            logger.info(f"Waited {waited:.1f}s for a {provider} {kind} in the {lane_name} lane")
+
+    def request(self, provider):
+        """Block until the provider's rate limit allows one more call"""
+        self._timed(provider, 'token', self._quota(provider).take_token)
+
+    def try_request(self, provider):
+        """Non-blocking request() for background work: 0 if allowed, else seconds to retry in"""
+        quota = self.quotas.get(provider)
+        return quota.try_token() if quota else 0.0
+
+    @contextmanager
+    def slot(self, provider):
+        """Hold one of the provider's job slots for the block (submit until result)"""
+        self.acquire_slot(provider)
+        try:
+            yield
+        finally:
+            self.release_slot(provider)
+
+    def acquire_slot(self, provider):
+        self._timed(provider, 'slot', self._quota(provider).take_slot)
+
+    def release_slot(self, provider):
+        self._quota(provider).release_slot()
+
+    def throttled(self, provider, seconds):
+        """Record a 429 from the provider and block its callers for seconds"""
+        provider_throttled.inc(provider=provider)
+        logger.warning(f"{provider} rate limited us, pausing its calls for {seconds:.1f}s")
+        self._quota(provider).throttle(seconds)
+
+    def call(self, provider, send):
+        """Rate-limited send() -> requests.Response; a 429 is retried after its Retry-After.
+
+        After the retries the last 429 response is returned to the caller.
+        """
+        for attempt in range(self.retries + 1):
+            self.request(provider)
+            response = send()
+            if response.status_code != 429 or attempt == self.retries:
+                return response
+            self.throttled(provider, retry_after_seconds(response.headers))
+            response.close()
+        return response
+
+    def stats(self):
+        return {name: quota.stats() for name, quota in self.quotas.items()}
+
+
+# Shared scheduler used by a2e_service.py, generate_video.py and the status poller
+scheduler = ProviderScheduler()
+scheduler.configure('a2e', rate=A2E_RATE_LIMIT, burst=A2E_BURST, concurrency=A2E_MAX_JOBS)
+scheduler.configure('heygen', rate=HEYGEN_RATE_LIMIT, burst=HEYGEN_BURST, concurrency=HEYGEN_MAX_JOBS)
+
+registry.gauge('provider_queue_depth', 'Callers queued for a provider slot or token, by provider/kind/lane',
+               lambda: {f"{name}/{key}": count for name, stats in scheduler.stats().items()
+                        for key, count in stats['queued'].items()})
+registry.gauge('provider_jobs_active', 'Provider job slots in use',
+               lambda: {name: stats['active'] for name, stats in scheduler.stats().items()})
@@ -0,0 +1,516 @@
+"""Process-pool render farm for the compositing/encode stage.
+
+Render specs are plain dicts so they pickle cheaply:
+
+    {'layout': 'avatar', 'output_path': ..., 'avatar_path': ...,
+     'background_path': ..., 'background_color': '#D3D3D3',
+     'product_path': ..., 'product_width': 540, 'avatar_width': 270,
+     'fragmented': False, 'profile': 'balanced'}
+
+    {'layout': 'still', 'output_path': ..., 'audio_path': ..., ...}
+
+An avatar still downloading is passed as pipe paths instead:
+'avatar_path' and 'avatar_audio_path' each replay the file, and
+'avatar_probe_path' holds its header.
+
+Each worker process is pinned to its own slice of RENDER_CORES, and the
+ffmpeg processes it starts inherit that affinity.
+
+Renders also reserve memory from RENDER_MEMORY_BUDGET before they are
+dispatched. A job's reservation is the peak RSS (worker plus its ffmpeg
+processes) recently observed for its layout and encode profile. Jobs that do not fit wait
+in the queue instead of pushing workers into the OOM killer. A render that
+still grows past RENDER_RSS_LIMIT has its ffmpeg processes killed and
+fails, so a single runaway job cannot take the host down.
+
+submit_later() queues a render without blocking: renders wait in a
+backlog, ordered by provider lane (interactive before batch) and then
+first come first served, that is fed to the pool as earlier renders
+finish, so no thread is held per queued render. is_full() admits new
+work by that queue depth: a lane is full once RENDER_QUEUE_SIZE renders
+wait ahead of it, so queued batch renders never turn interactive
+requests away and new batches wait for the batch backlog to drain.
+"""
+import os
+import time
+import heapq
+import signal
+import logging
+import itertools
+import resource
+import threading
+import contextvars
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from metrics import registry, observe_stage, trace_id
+from provider_scheduler import LANES, current_lane
+from compositor import ENCODE_PROFILE
+
+logger = logging.getLogger(__name__)
+
+
+def parse_cores(value):
+    """'0-3,6' -> [0, 1, 2, 3, 6]; empty means every core this process may use"""
+    if not value:
+        return sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    cores = []
+    for part in value.split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            cores.extend(range(int(start), int(end) + 1))
+        elif part.strip():
+            cores.append(int(part))
+    return cores
+
+
+RENDER_CORES = parse_cores(os.getenv('RENDER_CORES', ''))
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', str(len(RENDER_CORES))))
+# Renders allowed to wait for a worker before new work is rejected
+RENDER_QUEUE_SIZE = int(os.getenv('RENDER_QUEUE_SIZE', str(RENDER_WORKERS * 2)))
+
+
+def default_memory_budget():
+    """Half of the memory this process may use (cgroup limit or physical RAM)"""
+    try:
+        with open('/sys/fs/cgroup/memory.max') as f:
+            limit = f.read().strip()
+        if limit != 'max':
+            return int(limit) // 2
+    except (OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2
+    except (ValueError, OSError, AttributeError):
+        return 4 * 1024 ** 3
+
+
+# Bytes of RSS all in-flight renders may use together; 0 disables the check
+RENDER_MEMORY_BUDGET = int(os.getenv('RENDER_MEMORY_BUDGET', str(default_memory_budget())))
+# Reservation for a layout before any job of that layout has been measured
+RENDER_JOB_MEMORY = int(os.getenv('RENDER_JOB_MEMORY', str(400 * 1024 * 1024)))
+# RSS (worker plus ffmpeg) at which a render's ffmpeg processes are killed; 0 disables the watchdog
+RENDER_RSS_LIMIT = int(os.getenv('RENDER_RSS_LIMIT', str(RENDER_MEMORY_BUDGET)))
+# Address space limit (setrlimit RLIMIT_AS) of each worker and its ffmpeg processes; 0 leaves it unset.
+# Virtual size is far above RSS for threaded encoders, so set it with headroom.
+RENDER_WORKER_MAX_VSIZE = int(os.getenv('RENDER_WORKER_MAX_VSIZE', '0'))
+RSS_SAMPLE_INTERVAL = 0.05
+
+render_cpu = registry.counter('render_cpu_seconds_total', 'CPU time spent rendering, by process',
+                              labels=('part',))
+render_peak_rss = registry.histogram('render_peak_rss_bytes', 'Peak RSS of a render, worker plus ffmpeg',
+                                     labels=('layout', 'profile'),
+                                     buckets=tuple(mb * 1024 * 1024 for mb in (64, 128, 256, 512, 1024, 2048, 4096)))
+
+
+class RenderQueueFull(Exception):
+    """Raised when the render queue is at capacity; map to HTTP 429."""
+
+    def __init__(self, retry_after=10):
+        super().__init__("Render queue is full, try again later")
+        self.retry_after = retry_after
+
+
+def _init_worker(cores, per_worker, counter):
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    if hasattr(os, 'sched_setaffinity') and cores:
+        start = (index * per_worker) % len(cores)
+        pinned = cores[start:start + per_worker] or cores
+        os.sched_setaffinity(0, pinned)
+    if RENDER_WORKER_MAX_VSIZE:
+        # Inherited by the ffmpeg processes, which fail to allocate instead of growing further
+        resource.setrlimit(resource.RLIMIT_AS, (RENDER_WORKER_MAX_VSIZE, RENDER_WORKER_MAX_VSIZE))
+    import compositor
+    try:
+        # Load numpy/PIL and check ffmpeg now rather than in the worker's first render
+        compositor.warmup()
+    except Exception as e:
+        # Raising here would break the whole pool; the render reports the problem instead
+        logger.error(f"Render worker warmup failed: {str(e)}")
+
+
+def _process_rss(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def _children(pid):
+    children = []
+    for task in os.listdir(f'/proc/{pid}/task'):
+        with open(f'/proc/{pid}/task/{task}/children') as f:
+            children.extend(int(child) for child in f.read().split())
+    return children
+
+
+def _tree_rss(pid):
+    """RSS of a process and all its descendants (Linux /proc)"""
+    total = 0
+    pending = [pid]
+    while pending:
+        pid = pending.pop()
+        try:
+            total += _process_rss(pid)
+            pending.extend(_children(pid))
+        except (OSError, ValueError):
+            continue
+    return total
+
+
+class PeakRSS:
+    """Sample the RSS of this process and its children in the background and keep the peak.
+
+    With a limit, the child processes (ffmpeg) are killed as soon as a sample exceeds it.
+    """
+
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL, limit=0):
+        self.interval = interval
+        self.limit = limit
+        self.peak = 0
+        self.exceeded = False
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        self.peak = self._sample()
+        self.thread = threading.Thread(target=self._run, name='rss-sampler', daemon=True)
+        self.thread.start()
+        return self
+
+    def _sample(self):
+        try:
+            return _tree_rss(os.getpid())
+        except OSError:
+            # No /proc: the process's lifetime peak is the best available
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            sample = self._sample()
+            self.peak = max(self.peak, sample)
+            if self.limit and sample > self.limit:
+                self._kill_children(sample)
+
+    def _kill_children(self, sample):
+        try:
+            children = _children(os.getpid())
+        except (OSError, ValueError):
+            return
+        if children and not self.exceeded:
+            logger.error(f"Render RSS {sample} bytes is over RENDER_RSS_LIMIT ({self.limit}), "
+                         f"killing ffmpeg processes {children}")
+        self.exceeded = self.exceeded or bool(children)
+        for child in children:
+            try:
+                os.kill(child, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, self._sample())
+
+
+def run_render(spec):
+    """Worker entry point: composite and encode one spec, with CPU time accounting"""
+    import compositor
+
+    wall_start = time.perf_counter()
+    self_start = resource.getrusage(resource.RUSAGE_SELF)
+    children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    profile = compositor.get_profile(spec.get('profile'))
+    size = compositor.profile_size(profile)
+    # Widths in the spec are for the full-size layout
+    scale = size[0] / compositor.VIDEO_SIZE[0]
+    product_width = int(spec['product_width'] * scale) if spec.get('product_width') else None
+    avatar_width = int(spec['avatar_width'] * scale) // 2 * 2 if spec.get('avatar_width') else None
+    rss = PeakRSS(limit=RENDER_RSS_LIMIT)
+    try:
+        with rss:
+            base_frame = compositor.build_base_frame(
+                size, spec.get('background_path'), spec.get('background_color', '#D3D3D3'),
+                spec.get('product_path'), product_width,
+            )
+            composite_end = time.perf_counter()
+            # Per-frame compositing of the avatar layout, split out of the ffmpeg time
+            timings = {'frame_copy_seconds': 0.0}
+            if spec['layout'] == 'avatar':
+                compositor.render_avatar_video(spec['avatar_path'], spec['output_path'], base_frame,
+                                               avatar_width=avatar_width,
+                                               fragmented=spec.get('fragmented', False),
+                                               audio_path=spec.get('avatar_audio_path'),
+                                               probe_path=spec.get('avatar_probe_path'),
+                                               profile=spec.get('profile'), timings=timings)
+            elif spec['layout'] == 'still':
+                compositor.render_still_video(base_frame, spec['audio_path'], spec['output_path'],
+                                              fragmented=spec.get('fragmented', False),
+                                              profile=spec.get('profile'))
+            else:
+                raise ValueError(f"Unknown layout: {spec['layout']}")
+    finally:
+        if rss.exceeded:
+            # Report the kill rather than ffmpeg's broken pipe
+            raise MemoryError(f"Render stopped at {rss.peak} bytes RSS, over RENDER_RSS_LIMIT ({RENDER_RSS_LIMIT})")
+
+    self_end = resource.getrusage(resource.RUSAGE_SELF)
+    children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+    python_cpu = (self_end.ru_utime - self_start.ru_utime) + (self_end.ru_stime - self_start.ru_stime)
+    ffmpeg_cpu = (children_end.ru_utime - children_start.ru_utime) + (children_end.ru_stime - children_start.ru_stime)
+    return {
+        'output_path': spec['output_path'],
+        'wall_seconds': round(time.perf_counter() - wall_start, 3),
+        'composite_seconds': round(composite_end - wall_start, 3),
+        'frame_copy_seconds': round(timings['frame_copy_seconds'], 3),
+        'encode_seconds': round(time.perf_counter() - composite_end - timings['frame_copy_seconds'], 3),
+        'cpu_seconds': round(python_cpu + ffmpeg_cpu, 3),
+        'python_cpu_seconds': round(python_cpu, 3),
+        'ffmpeg_cpu_seconds': round(ffmpeg_cpu, 3),
+        'peak_rss_bytes': rss.peak,
+        'worker_pid': os.getpid(),
+    }
+
+
+def _lane_priority(lane):
+    return LANES.index(lane) if lane in LANES else 0
+
+
+def _copy_outcome(source, target):
+    error = source.exception()
+    if error is None:
+        target.set_result(source.result())
+    else:
+        target.set_exception(error)
+
+
+class RenderPool:
+    """Bounded process pool for render specs with admission control"""
+
+    def __init__(self, workers=RENDER_WORKERS, cores=RENDER_CORES, queue_size=RENDER_QUEUE_SIZE,
+                 memory_budget=RENDER_MEMORY_BUDGET):
+        self.workers = workers
+        self.cores = cores
+        self.queue_size = queue_size
+        self.capacity = workers + queue_size
+        self.slots = threading.BoundedSemaphore(self.capacity)
+        self.lock = threading.Lock()
+        self.memory_budget = memory_budget
+        self.memory_reserved = 0
+        self.memory_ready = threading.Condition(self.lock)
+        # Expected peak RSS per layout, learned from finished renders
+        self.memory_estimates = {}
+        self.memory_waits = 0
+        self.peak_rss = 0
+        self.executor = None
+        # Heap of (lane priority, sequence, spec, future, context, queued at) queued by submit_later()
+        self.backlog = []
+        self.sequence = itertools.count()
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.cpu_seconds = 0.0
+        self.wall_seconds = 0.0
+
+    def _get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                # spawn: the web process has live threads, forking it is unsafe
+                context = multiprocessing.get_context('spawn')
+                per_worker = max(1, len(self.cores) // self.workers)
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=context,
+                    initializer=_init_worker,
+                    initargs=(self.cores, per_worker, context.Value('i', 0)),
+                )
+            return self.executor
+
+    def warm(self, timeout=None):
+        """Start every worker process now (they load the media stack as they start) and wait for them.
+
+        Returns the seconds it took. Call it after forking: the pool belongs to this process.
+        """
+        start = time.perf_counter()
+        executor = self._get_executor()
+        # Each submit starts a process while none is idle
+        futures = [executor.submit(os.getpid) for _ in range(self.workers)]
+        for future in futures:
+            future.result(timeout)
+        seconds = time.perf_counter() - start
+        logger.info(f"Render pool warm: {self.workers} workers in {seconds:.2f}s")
+        return seconds
+
+    def is_full(self, lane=None):
+        """True when RENDER_QUEUE_SIZE renders already wait ahead of a new one in lane (default: the current lane)"""
+        priority = _lane_priority(current_lane.get() if lane is None else lane)
+        with self.lock:
+            # Renders waiting for a worker inside the pool, then backlog renders that would go first
+            waiting = max(0, self.in_flight - self.workers)
+            waiting += sum(1 for entry in self.backlog if entry[0] <= priority)
+            return waiting >= self.queue_size
+
+    def submit(self, spec, block=False, timeout=None):
+        """Queue a render and return a Future; raises RenderQueueFull when saturated"""
+        if not self.slots.acquire(blocking=block, timeout=timeout if block else None):
+            with self.lock:
+                self.rejected += 1
+            raise RenderQueueFull()
+        return self._start(spec, timeout)
+
+    def submit_later(self, spec):
+        """Queue a render without blocking and return a Future for its result.
+
+        The render is submitted once a slot (and its memory) is free, in lane
+        order, as earlier renders finish.
+        """
+        result = Future()
+        entry = (_lane_priority(current_lane.get()), next(self.sequence), spec, result,
+                 contextvars.copy_context(), time.perf_counter())
+        with self.lock:
+            heapq.heappush(self.backlog, entry)
+        self._drain()
+        return result
+
+    def _drain(self):
+        """Move backlog renders onto the pool while it has room"""
+        while True:
+            with self.lock:
+                if not self.backlog:
+                    return
+                entry = heapq.heappop(self.backlog)
+            priority, _, spec, result, context, queued = entry
+            if not self.slots.acquire(blocking=False):
+                with self.lock:
+                    heapq.heappush(self.backlog, entry)
+                return
+            try:
+                # Run in the submitter's context so the render keeps its trace ID
+                future = context.run(self._start, spec, 0)
+            except RenderQueueFull:
+                # Over the memory budget: retried when a running render finishes
+                with self.lock:
+                    heapq.heappush(self.backlog, entry)
+                return
+            except Exception as e:
+                result.set_exception(e)
+                continue
+            # Backlog wait per lane, e.g. render_backlog.interactive
+            context.run(observe_stage, f"render_backlog.{LANES[priority]}", time.perf_counter() - queued)
+            future.add_done_callback(lambda f, result=result: _copy_outcome(f, result))
+
+    def _start(self, spec, timeout=None):
+        """Dispatch a spec that holds a slot"""
+        with self.lock:
+            self.in_flight += 1
+        submitted = time.perf_counter()
+        try:
+            kind = (spec['layout'], spec.get('profile') or ENCODE_PROFILE)
+            reserved = self._reserve_memory(kind, timeout)
+        except Exception:
+            self._release()
+            raise
+        try:
+            future = self._get_executor().submit(run_render, spec)
+        except Exception:
+            self._release(reserved)
+            raise
+        trace = trace_id.get()
+        future.add_done_callback(lambda f: self._on_done(f, submitted, trace, kind, reserved))
+        return future
+
+    def _reserve_memory(self, kind, timeout=None):
+        """Block until the (layout, profile)'s expected peak RSS fits in the budget; returns the bytes reserved.
+
+        A render that would not fit even on an idle pool still runs, alone.
+        """
+        if not self.memory_budget:
+            return 0
+        with self.lock:
+            need = self.memory_estimates.get(kind, RENDER_JOB_MEMORY)
+
+            def fits():
+                return self.memory_reserved == 0 or self.memory_reserved + need <= self.memory_budget
+
+            if not fits():
+                self.memory_waits += 1
+                logger.info(f"Render memory budget exhausted ({self.memory_reserved} of {self.memory_budget} "
+                            f"bytes reserved), queueing a {'/'.join(kind)} render needing {need}")
+                if not self.memory_ready.wait_for(fits, timeout):
+                    raise RenderQueueFull()
+            self.memory_reserved += need
+            return need
+
+    def render(self, spec, block=True, timeout=None):
+        """Render synchronously; returns the worker's result dict"""
+        result = self.submit(spec, block=block, timeout=timeout).result()
+        logger.info(f"Rendered {result['output_path']} in {result['wall_seconds']}s "
+                    f"({result['cpu_seconds']} CPU s, peak {result['peak_rss_bytes'] // (1024 * 1024)} MB) "
+                    f"on worker {result['worker_pid']} trace_id={trace_id.get() or '-'}")
+        return result
+
+    def _release(self, reserved=0):
+        with self.lock:
+            self.in_flight -= 1
+            self.memory_reserved -= reserved
+            self.memory_ready.notify_all()
+        self.slots.release()
+
+    def _on_done(self, future, submitted, trace, kind, reserved):
+        error = future.exception()
+        elapsed = time.perf_counter() - submitted
+        if error:
+            observe_stage('render', elapsed, 'error', trace)
+        else:
+            result = future.result()
+            observe_stage('render_queue', max(0.0, elapsed - result['wall_seconds']), trace=trace)
+            observe_stage('composite', result['composite_seconds'], trace=trace)
+            observe_stage('frame_copy', result['frame_copy_seconds'], trace=trace)
+            observe_stage('encode', result['encode_seconds'], trace=trace)
+            render_cpu.inc(result['python_cpu_seconds'], part='python')
+            render_cpu.inc(result['ffmpeg_cpu_seconds'], part='ffmpeg')
+            render_peak_rss.observe(result['peak_rss_bytes'], layout=kind[0], profile=kind[1])
+        with self.lock:
+            if error:
+                self.failed += 1
+            else:
+                result = future.result()
+                self.completed += 1
+                self.cpu_seconds += result['cpu_seconds']
+                self.wall_seconds += result['wall_seconds']
+                peak = result['peak_rss_bytes']
+                self.peak_rss = max(self.peak_rss, peak)
+                # Move quickly toward larger peaks, slowly toward smaller ones
+                estimate = self.memory_estimates.get(kind, peak)
+                self.memory_estimates[kind] = max(peak, int(0.9 * estimate + 0.1 * peak))
+        self._release(reserved)
+        self._drain()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'cores': self.cores,
+                'capacity': self.capacity,
+                'in_flight': self.in_flight,
+                'backlog': len(self.backlog),
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'cpu_seconds': round(self.cpu_seconds, 3),
+                'wall_seconds': round(self.wall_seconds, 3),
+                'memory_budget': self.memory_budget,
+                'memory_reserved': self.memory_reserved,
+                'memory_estimates': {'/'.join(kind): need for kind, need in self.memory_estimates.items()},
+                'memory_waits': self.memory_waits,
+                'peak_rss_bytes': self.peak_rss,
+            }
+
+
+# Shared pool used by service.py
+render_pool = RenderPool()
@@ -0,0 +1,997 @@
+"""One async (ASGI) service for every video backend: gTTS still, A2E avatar and HeyGen avatar.
+
+    uvicorn service:app --port 8000
+    gunicorn -c gunicorn.conf.py service:app
+
+app.py and appp.py are shims over create_app(): app.py defaults to A2E
+and answers POST / with the job's links, appp.py defaults to the gTTS
+still and answers with the video itself.
+
+One event loop serves all connections. The long waits (provider jobs,
+downloads, renders, streamed responses) are awaited instead of each
+holding a thread: provider jobs resolve through the shared status
+poller's futures, downloads through Download.future() and renders
+through the render pool's backlog futures. The short blocking steps that
+reuse the existing provider clients (submits, uploads, gTTS, download
+setup) run on a bounded I/O thread pool. A submit may still wait there
+for a provider job slot.
+
+    POST /               form as in index.html (backend= picks one, preview=1 adds a preview)
+    POST /jobs           same form; 202 with the job's links (200 when the output cache has it)
+    GET  /jobs/{id}      status
+    GET  /jobs/{id}/stream   the video as it is encoded
+    GET  /jobs/{id}/preview  the low-resolution preview, rendered first
+    GET  /jobs/{id}/result   the finished video (ETag, Range)
+    GET  /videos/{key}   a video from the output cache
+    POST /batch          many product/background variants around one A2E avatar video
+    GET  /batch/{id}     variant statuses; /batch/{id}/zip downloads them
+"""
+import io
+import os
+import csv
+import json
+import time
+import uuid
+import shutil
+import asyncio
+import logging
+import zipfile
+import contextvars
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import APIRouter, FastAPI, Request
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.datastructures import UploadFile
+
+import compositor
+import warmup
+import generate_video
+from http_client import client
+from a2e_service import AVATAR_ID, submit_avatar_video, track_avatar_video, open_avatar_video, variant_spec
+from downloader import Download
+from media_buffers import MediaBuffer, MediaStream
+from render_pool import render_pool
+from status_poller import poller
+from output_cache import output_cache, fingerprint
+from tts_cache import audio_cache, gtts_audio, normalize_script
+from job_store import job_store
+from provider_scheduler import lane
+from metrics import registry, span, instrument_asgi
+from callbacks import register_asgi_callback_routes
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+# Backend for requests that don't name one (still, a2e or heygen)
+DEFAULT_BACKEND = os.getenv('SERVICE_BACKEND', 'still')
+# Threads for the short blocking provider calls (submits, uploads, TTS, download setup)
+SERVICE_IO_THREADS = int(os.getenv('SERVICE_IO_THREADS', '64'))
+# Seconds between checks for new bytes while streaming a video that is still encoding
+STREAM_POLL_INTERVAL = float(os.getenv('STREAM_POLL_INTERVAL', '0.05'))
+# Stream fragmented MP4 from POST / with chunked transfer instead of sending after the full encode
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', '1') == '1'
+# Seconds GET /jobs/{id}/stream waits for the first bytes before answering 409 with Retry-After
+STREAM_START_TIMEOUT = float(os.getenv('STREAM_START_TIMEOUT', '15'))
+STREAM_RETRY_AFTER = 5
+# Seconds a finished job (and its video) is kept before being pruned
+JOB_TTL = int(os.getenv('JOB_TTL', '3600'))
+# Finished job videos are kept on disk here, one subdirectory per worker process, removed at exit
+JOB_RESULT_DIR = os.getenv('JOB_RESULT_DIR', 'job_results')
+BATCH_MAX_VARIANTS = int(os.getenv('BATCH_MAX_VARIANTS', '100'))
+
+# Shared pool for blocking calls made from the event loop
+io_executor = ThreadPoolExecutor(max_workers=SERVICE_IO_THREADS, thread_name_prefix='service-io')
+
+# Job ID -> job; finished jobs are pruned after JOB_TTL
+jobs = {}
+# Cache key -> job rendering it, so identical requests share one job
+in_flight = {}
+# Batch ID -> batch of variant jobs sharing one avatar video
+batches = {}
+
+
+async def run_io(fn, *args):
+    """Run a blocking call on the I/O pool, keeping the caller's trace ID and lane"""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(io_executor, context.run, fn, *args)
+
+
+# Render stats reported per job (see render_pool.run_render)
+RENDER_STATS = ('wall_seconds', 'cpu_seconds', 'python_cpu_seconds', 'ffmpeg_cpu_seconds', 'peak_rss_bytes')
+
+
+async def render(output, spec):
+    """Render spec into output on the render pool; output sees EOF (or the error) when it ends.
+
+    Renders wait in the pool's backlog (in lane order), so no thread is held.
+    Returns the render's stats.
+    """
+    try:
+        result = await asyncio.wrap_future(render_pool.submit_later(spec))
+    except Exception as e:
+        output.finish(e)
+        raise
+    output.finish()
+    return {name: result[name] for name in RENDER_STATS}
+
+
+async def render_job_output(job, name, output, spec):
+    """Render one of the job's outputs and record its stats under job['renders'][name]"""
+    stats = job['renders'][name] = await render(output, spec)
+    logger.info(f"Rendered {name} for job {job['id']} in {stats['wall_seconds']}s "
+                f"({stats['cpu_seconds']} CPU s, peak {stats['peak_rss_bytes'] // (1024 * 1024)} MB)")
+
+
+async def render_outputs(job, make_spec):
+    """Render the job's preview, when one was asked for, then its video.
+
+    make_spec(output, profile) returns the render spec for one output. A
+    failed preview is only logged; the full render still runs.
+    """
+    preview = job['preview']
+    if preview is not None:
+        try:
+            with span('preview'):
+                await render_job_output(job, 'preview', preview, make_spec(preview, 'preview'))
+        except Exception as e:
+            logger.error(f"Preview render failed: {str(e)}")
+    await render_job_output(job, 'video', job['stream'], make_spec(job['stream'], job['profile']))
+
+
+class StillBackend:
+    """gTTS voiceover over the product image"""
+    name = 'still'
+    previews = True
+
+    def settings(self):
+        return {'product_width': int(compositor.VIDEO_SIZE[0] * 0.8)}
+
+    async def generate(self, job):
+        inputs = job['inputs']
+        # A private copy: cache eviction can't remove it while the render waits in the backlog
+        audio = await run_io(gtts_audio, job['script'])
+        background = inputs['background']
+        try:
+            await render_outputs(job, lambda output, profile: {
+                'layout': 'still',
+                'output_path': output.path,
+                'audio_path': audio.path,
+                'background_path': background.path if background else None,
+                'background_color': job['background_color'],
+                'product_path': inputs['product'].path,
+                'product_width': int(compositor.VIDEO_SIZE[0] * 0.8),
+                'fragmented': True,
+                'profile': profile,
+            })
+        finally:
+            audio.close()
+
+
+class A2EBackend:
+    """A2E avatar composited next to the product"""
+    name = 'a2e'
+    previews = True
+
+    def settings(self):
+        video_size = compositor.VIDEO_SIZE
+        return {'avatar_id': AVATAR_ID, 'product_width': video_size[0]//2, 'avatar_width': video_size[0]//4}
+
+    async def generate(self, job):
+        batch = job.get('batch')
+        if batch is not None:
+            # Batch variants share the batch's avatar video, downloaded once
+            try:
+                await self.render_over(await asyncio.shield(batch['avatar']), job)
+            finally:
+                release_batch_share(batch)
+            return
+        download = await start_avatar_video(job['script'])
+        try:
+            await self.render_over(download, job)
+        finally:
+            download.close()
+            download.media.close()
+
+    async def render_over(self, download, job):
+        """Composite while the avatar is still downloading if it is a faststart MP4, else once it is complete"""
+        inputs = job['inputs']
+
+        def make_spec(output, profile, avatar_streams=None):
+            return variant_spec(download.media, inputs['product'], inputs['background'], job['background_color'],
+                                output, avatar_streams, profile)
+
+        if download.done or not await run_io(download.streamable):
+            with span('download'):
+                await asyncio.wrap_future(download.future())
+            await render_outputs(job, make_spec)
+            return
+
+        logger.info("Avatar video is faststart, compositing while it downloads.")
+        header = await run_io(download.header)
+        try:
+            # Each render replays the download from the start through its own pipes
+            await render_outputs(job, lambda output, profile: make_spec(output, profile, {
+                'avatar_path': download.tail(),
+                'avatar_audio_path': download.tail(),
+                'avatar_probe_path': header.path,
+            }))
+        except Exception:
+            # A failed download makes the render fail too; report the cause
+            if download.error is not None:
+                raise download.error
+            raise
+        finally:
+            header.close()
+        # The render consumed every byte; this verifies the download's length
+        with span('download'):
+            await asyncio.wrap_future(download.future())
+
+
+class HeyGenBackend:
+    """HeyGen talking photo of the product image (generate_video.py), downloaded and kept like a render"""
+    name = 'heygen'
+    previews = False
+
+    def settings(self):
+        return {'voice': 'en-US-AriaNeural'}
+
+    async def generate(self, job):
+        image_bytes = await run_io(job['inputs']['product'].read)
+        video = await run_io(generate_video.start_talking_video, image_bytes, job['script'])
+        try:
+            media, download = await self.fetch(job, video)
+        except Exception:
+            if video['owned']:
+                raise
+            # A recorded video that failed or whose URL stopped working: pay for a new one
+            video = await run_io(generate_video.resubmit_heygen_video, video)
+            media, download = await self.fetch(job, video)
+        try:
+            await run_io(copy_into, media, job['stream'])
+        finally:
+            download.close()
+            download.media.close()
+
+    async def fetch(self, job, video):
+        """Wait for the video and download it; returns (MediaBuffer, Download)"""
+        with span('heygen_wait'):
+            job['video_url'] = await asyncio.wrap_future(generate_video.track_heygen_video(video))
+        download = await run_io(start_download, job['video_url'])
+        try:
+            with span('download'):
+                return await asyncio.wrap_future(download.future()), download
+        except Exception:
+            download.close()
+            download.media.close()
+            raise
+
+
+# Backend name -> backend; add more with register_backend()
+BACKENDS = {}
+
+
+def register_backend(backend):
+    BACKENDS[backend.name] = backend
+
+
+register_backend(StillBackend())
+register_backend(A2EBackend())
+register_backend(HeyGenBackend())
+
+
+async def start_avatar_video(script):
+    """a2e_service.start_avatar_video, awaiting the provider job instead of blocking on it"""
+    for reuse in (True, False):
+        provider_job = await run_io(submit_avatar_video, script, reuse)
+        try:
+            with span('a2e_wait'):
+                video_url = await asyncio.wrap_future(track_avatar_video(provider_job))
+            return await run_io(open_avatar_video, provider_job, video_url)
+        except Exception as e:
+            if provider_job['owned']:
+                raise
+            logger.warning(f"Could not reuse A2E job {provider_job['job_id']}: {str(e)}, submitting a new one")
+
+
+def start_download(url):
+    """Start a Download of url into a new media buffer"""
+    media = MediaBuffer('.mp4')
+    try:
+        return Download(url, media).start()
+    except Exception:
+        media.close()
+        raise
+
+
+def copy_into(media, stream):
+    """Write a finished MediaBuffer through a MediaStream, as a render would"""
+    with media.open('rb') as src, open(stream.path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Per-worker startup (job recovery, render pool processes) without blocking the loop
+    await asyncio.to_thread(warmup.start_worker)
+    await run_io(open_result_dir)
+    yield
+    for job in list(jobs.values()):
+        release_job(job)
+    shutil.rmtree(result_dir(), ignore_errors=True)
+
+
+def result_dir():
+    return os.path.join(JOB_RESULT_DIR, str(os.getpid()))
+
+
+def open_result_dir():
+    """Create this worker's result directory and remove those of workers that are gone"""
+    os.makedirs(JOB_RESULT_DIR, exist_ok=True)
+    for name in os.listdir(JOB_RESULT_DIR):
+        if name.isdigit() and (int(name) == os.getpid() or not process_alive(int(name))):
+            shutil.rmtree(os.path.join(JOB_RESULT_DIR, name), ignore_errors=True)
+    os.makedirs(result_dir())
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+registry.gauge('render_pool_in_flight', 'Renders running or queued on the render pool',
+               lambda: render_pool.stats()['in_flight'])
+registry.gauge('provider_jobs_pending', 'Provider jobs being polled, per provider',
+               lambda: poller.stats()['per_provider'])
+registry.gauge('output_cache_requests', 'Output cache lookups by result',
+               lambda: {k: v for k, v in output_cache.stats().items() if k in ('hits', 'misses')})
+registry.gauge('tts_cache_requests', 'Speech cache lookups by result',
+               lambda: {k: v for k, v in audio_cache.stats().items() if k in ('hits', 'misses')})
+registry.gauge('provider_status_events', 'Status polls, callbacks and callback fallbacks',
+               lambda: {k: v for k, v in poller.stats().items() if k in ('polls', 'callbacks', 'fallbacks')})
+registry.gauge('provider_throttled_polls', 'Status polls answered with 429',
+               lambda: poller.stats()['throttled'])
+registry.gauge('provider_jobs_recorded', 'Provider jobs in the durable job store, by stage',
+               lambda: job_store.stats()['stages'])
+registry.gauge('provider_jobs_recovered', 'Orphaned provider jobs adopted and recovered by this worker',
+               lambda: {k: v for k, v in job_store.stats().items() if k in ('adopted', 'recovered')})
+registry.gauge('http_client_handshakes', 'New connections opened by the provider client',
+               lambda: client.stats()['handshakes'])
+registry.gauge('status_poll_handshakes', 'New connections opened by the status poller',
+               lambda: poller.http_stats()['handshakes'])
+registry.gauge('service_jobs', 'Service jobs by status', lambda: job_counts())
+
+
+def job_counts():
+    counts = {}
+    for job in list(jobs.values()):
+        counts[job['status']] = counts.get(job['status'], 0) + 1
+    return counts
+
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def uploaded(form, field):
+    """The form's file for field, or None when it was left empty"""
+    upload = form.get(field)
+    return upload if isinstance(upload, UploadFile) and upload.filename else None
+
+
+async def buffer_upload(upload):
+    """Copy an upload into a media buffer (memory-backed unless IN_MEMORY_MEDIA=0)"""
+    extension = upload.filename.rsplit('.', 1)[1].lower()
+    return await run_io(MediaBuffer.from_stream, upload.file, '.' + extension)
+
+
+def release_media(buffers):
+    """Release the intermediate media buffers created for a job."""
+    for media in buffers:
+        if media:
+            media.close()
+
+
+def request_fingerprint(backend, product, background, background_color, script, profile):
+    """Cache key for a video: upload contents, normalized form fields and the backend's render settings."""
+    fields = {
+        'backend': backend.name,
+        'script': normalize_script(script),
+        'background_color': None if background else background_color.strip().lower(),
+        'video_size': compositor.VIDEO_SIZE,
+        'fps': compositor.FPS,
+        'profile': sorted(compositor.get_profile(profile).items()),
+    }
+    fields.update(backend.settings())
+    return fingerprint([product.path, background.path if background else None], fields)
+
+
+async def create_job(request):
+    """Validate the form and start its job, or join the identical one still running.
+
+    Returns (job, None, None); (None, cache_key, None) when the output cache
+    already has the video; or (None, None, error response).
+    """
+    form = await request.form()
+    product_image = uploaded(form, 'product_image')
+    script = form.get('script')
+    background_image = uploaded(form, 'background_image')
+    background_color = form.get('background_color', '#D3D3D3')
+    # Encode profile for the final video, and whether to render a quick preview first
+    profile = form.get('profile') or compositor.ENCODE_PROFILE
+    want_preview = form.get('preview', '').lower() in ('1', 'true', 'yes', 'on')
+    backend = BACKENDS.get(form.get('backend') or request.app.state.default_backend)
+
+    if not product_image or not script:
+        return None, None, PlainTextResponse("Please upload a product image and enter a script.", 400)
+    if backend is None:
+        return None, None, PlainTextResponse(f"Unknown backend. Use one of: {', '.join(BACKENDS)}.", 400)
+    if profile not in compositor.ENCODE_PROFILES:
+        return None, None, PlainTextResponse(
+            f"Unknown profile. Use one of: {', '.join(compositor.ENCODE_PROFILES)}.", 400)
+    if want_preview and not backend.previews:
+        return None, None, PlainTextResponse(f"The {backend.name} backend does not render previews.", 400)
+    if not allowed_file(product_image.filename):
+        return None, None, PlainTextResponse("Invalid product image format. Use PNG, JPG, or JPEG.", 400)
+
+    with span('upload_save'):
+        product = await buffer_upload(product_image)
+        background = None
+        if background_image and allowed_file(background_image.filename):
+            background = await buffer_upload(background_image)
+
+    # Identical request already rendered: serve it from the output cache
+    cache_key = await run_io(request_fingerprint, backend, product, background, background_color, script, profile)
+    if await run_io(output_cache.get, cache_key):
+        logger.info(f"Serving cached video {cache_key}")
+        release_media([product, background])
+        return None, cache_key, None
+
+    # Identical request still running: hand out the same job
+    job = in_flight.get(cache_key)
+    if job and job['status'] in ('queued', 'running') and (job['preview'] is not None or not want_preview):
+        logger.info(f"Joining in-flight job {job['id']} for {cache_key}")
+        release_media([product, background])
+        return job, None, None
+
+    # Backpressure: refuse new work while too many renders are queued ahead of it
+    if render_pool.is_full():
+        logger.error("Render queue is full, rejecting request.")
+        release_media([product, background])
+        return None, None, PlainTextResponse("Server is busy, please retry shortly.", 429, {'Retry-After': '10'})
+
+    job = start_job(backend, script, product, background, background_color, profile,
+                    cache_key=cache_key, preview=want_preview, media=[product, background])
+    in_flight[cache_key] = job
+    return job, None, None
+
+
+def start_job(backend, script, product, background, background_color, profile=None, cache_key=None,
+              preview=False, media=(), batch=None):
+    """Record a job and start its task in the caller's lane; media lists the buffers it releases when done"""
+    prune_jobs()
+    job = {
+        'id': uuid.uuid4().hex,
+        'backend': backend.name,
+        'status': 'queued',
+        'error': None,
+        'script': script,
+        'background_color': background_color,
+        'profile': profile,
+        'inputs': {'product': product, 'background': background},
+        'media': list(media),
+        'batch': batch,
+        # Fragmented MP4 written through a pipe, so it can be streamed while encoding
+        'stream': MediaStream('.mp4'),
+        'preview': MediaStream('.mp4') if preview else None,
+        'cache_key': cache_key,
+        'video_url': None,
+        'renders': {},
+        'created_at': time.time(),
+        'finished_at': None,
+    }
+    jobs[job['id']] = job
+    job['task'] = asyncio.create_task(run_job(job, backend))
+    logger.info(f"Job queued: {job['id']} ({backend.name})")
+    return job
+
+
+async def run_job(job, backend):
+    job['status'] = 'running'
+    error = None
+    try:
+        await backend.generate(job)
+    except Exception as e:
+        error = e
+    finally:
+        del job['inputs']
+        release_media(job.pop('media'))
+    # Readers see EOF or the error; a preview that never started would keep its readers waiting
+    stream, preview = job['stream'], job['preview']
+    stream.finish(error)
+    if preview is not None and preview.write_fd is not None:
+        preview.finish(error)
+    # The job is done once every byte is buffered
+    while not stream.done:
+        await asyncio.sleep(STREAM_POLL_INTERVAL)
+    cached_path = None
+    if error is None and job['cache_key']:
+        try:
+            cached_path = await run_io(cache_output, job)
+        except OSError as e:
+            logger.error(f"Error caching rendered video: {str(e)}")
+    # Finished videos are kept for JOB_TTL, on disk rather than in memfd RAM
+    try:
+        await run_io(spill_outputs, job, cached_path)
+    except OSError as e:
+        logger.error(f"Error moving job {job['id']} videos to disk: {str(e)}")
+    if in_flight.get(job['cache_key']) is job:
+        del in_flight[job['cache_key']]
+    if error is None:
+        job['status'] = 'completed'
+        logger.info(f"Job completed: {job['id']}")
+    else:
+        job['status'], job['error'] = 'failed', str(error)
+        logger.error(f"Job failed: {job['id']} - {str(error)}")
+    job['finished_at'] = time.time()
+
+
+def cache_output(job):
+    with job['stream'].open('rb') as f:
+        return output_cache.put(job['cache_key'], f)
+
+
+def spill_outputs(job, cached_path=None):
+    """Move the job's videos into the result directory; a cached video is linked, not copied again"""
+    job['stream'].spill(result_dir(), cached_path)
+    if job['preview'] is not None:
+        job['preview'].spill(result_dir())
+
+
+def release_job(job):
+    """Forget a job and release its videos"""
+    jobs.pop(job['id'], None)
+    for output in (job['stream'], job['preview']):
+        if output is not None:
+            output.close()
+
+
+def prune_jobs():
+    """Drop finished jobs and batches older than JOB_TTL and release their videos"""
+    cutoff = time.time() - JOB_TTL
+    for job in [j for j in jobs.values() if j['finished_at'] and j['finished_at'] < cutoff]:
+        release_job(job)
+    # A batch stays while any variant is queued or running, however long ago it was created
+    for batch_id in [b for b, batch in batches.items() if not batch['remaining'] and batch['created_at'] < cutoff]:
+        del batches[batch_id]
+
+
+async def stream_chunks(stream, f, chunk_size=256 * 1024):
+    """MediaStream.iter_chunks for the event loop: checks for new bytes instead of parking a thread"""
+    position = 0
+    with f:
+        while True:
+            # done is set after the last size update, so read it first
+            done = stream.done
+            size = stream.size
+            while position < size:
+                chunk = f.read(min(chunk_size, size - position))
+                if not chunk:
+                    break
+                position += len(chunk)
+                yield chunk
+            if done:
+                break
+            await asyncio.sleep(STREAM_POLL_INTERVAL)
+    if stream.error is not None:
+        raise stream.error
+
+
+async def stream_response(stream, filename='marketing_video.mp4', start_timeout=None):
+    """Stream a video while it is encoded.
+
+    With start_timeout, a video with no bytes by then gets a 409 with
+    Retry-After instead of a connection held open until it starts.
+    """
+    # Wait for the first bytes, so a job that fails before any output gets an error status
+    deadline = time.monotonic() + start_timeout if start_timeout is not None else None
+    while not (stream.size or stream.done):
+        if deadline is not None and time.monotonic() >= deadline:
+            return JSONResponse({'status': 'pending', 'error': 'The video has not started rendering yet'}, 409,
+                                {'Retry-After': str(STREAM_RETRY_AFTER)})
+        await asyncio.sleep(STREAM_POLL_INTERVAL)
+    if stream.error is not None and not stream.size:
+        return JSONResponse({'status': 'failed', 'error': str(stream.error)}, 500)
+    # Open now: a finished stream is moved to disk, and an open file keeps reading the old copy
+    return StreamingResponse(stream_chunks(stream, stream.open('rb')), media_type='video/mp4',
+                             headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+
+def send_video(request, path, etag=None, max_age=None, filename='marketing_video.mp4'):
+    """FileResponse for a finished video (Range is handled by Starlette), answering If-None-Match with 304"""
+    headers = {}
+    if etag:
+        headers['ETag'] = f'"{etag}"'
+        tags = [tag.strip().removeprefix('W/').strip('"') for tag in request.headers.get('If-None-Match', '').split(',')]
+        if etag in tags or '*' in tags:
+            return Response(status_code=304, headers=headers)
+    if max_age is not None:
+        headers['Cache-Control'] = f'public, max-age={max_age}'
+    return FileResponse(path, media_type='video/mp4', filename=filename, headers=headers)
+
+
+async def job_video(request, job):
+    """The finished job's video: its output cache entry, else the buffered stream"""
+    # Renders are keyed by their request fingerprint, which doubles as the ETag
+    cached_path = await run_io(output_cache.get, job['cache_key']) if job['cache_key'] else None
+    if cached_path:
+        return send_video(request, cached_path, job['cache_key'], output_cache.ttl)
+    return send_video(request, job['stream'].media.path, job['cache_key'])
+
+
+def cached_links(cache_key):
+    url = f"/videos/{cache_key}"
+    return {'status': 'completed', 'cached': True, 'stream_url': url, 'result_url': url}
+
+
+def job_links(job):
+    links = {
+        'job_id': job['id'],
+        'backend': job['backend'],
+        'status_url': f"/jobs/{job['id']}",
+        'stream_url': f"/jobs/{job['id']}/stream",
+        'result_url': f"/jobs/{job['id']}/result",
+    }
+    if job['preview'] is not None:
+        links['preview_url'] = f"/jobs/{job['id']}/preview"
+    return links
+
+
+router = APIRouter()
+
+
+@router.get('/')
+async def index():
+    return FileResponse('index.html')
+
+
+@router.post('/')
+async def generate(request: Request):
+    """The video itself, or with job_responses the job's links (index.html follows either)"""
+    logger.info("Received POST request to generate video.")
+    job, cache_key, error = await create_job(request)
+    if error:
+        return error
+    if request.app.state.job_responses:
+        if cache_key:
+            return JSONResponse(cached_links(cache_key), 200)
+        return JSONResponse(job_links(job), 202)
+    if cache_key:
+        return send_video(request, output_cache.path_for(cache_key), cache_key, output_cache.ttl)
+    if STREAM_RESPONSES:
+        # Chunked response: the client receives fragments while the encode is still running
+        return await stream_response(job['stream'])
+    # The request may go away while the job still runs; shield keeps the job alive
+    await asyncio.shield(job['task'])
+    if job['status'] == 'failed':
+        return JSONResponse({'status': 'failed', 'error': job['error']}, 500)
+    return await job_video(request, job)
+
+
+@router.post('/jobs')
+async def submit_job(request: Request):
+    job, cache_key, error = await create_job(request)
+    if error:
+        return error
+    if cache_key:
+        return JSONResponse(cached_links(cache_key), 200)
+    return JSONResponse(job_links(job), 202)
+
+
+@router.get('/jobs/{job_id}')
+async def job_status(job_id: str):
+    job = jobs.get(job_id)
+    if not job:
+        return JSONResponse({'error': 'Unknown job ID'}, 404)
+    body = {'job_id': job_id, 'backend': job['backend'], 'status': job['status']}
+    if job['status'] == 'failed':
+        body['error'] = job['error']
+    if job['status'] == 'completed':
+        body['result_url'] = f"/jobs/{job_id}/result"
+    if job['preview'] is not None:
+        body['preview_url'] = f"/jobs/{job_id}/preview"
+    if job['video_url']:
+        body['video_url'] = job['video_url']
+    if job['renders']:
+        body['renders'] = job['renders']
+    return body
+
+
+@router.get('/jobs/{job_id}/result')
+async def job_result(job_id: str, request: Request):
+    job = jobs.get(job_id)
+    if not job:
+        return JSONResponse({'error': 'Unknown job ID'}, 404)
+    if job['status'] == 'failed':
+        return JSONResponse({'status': 'failed', 'error': job['error']}, 500)
+    if job['status'] != 'completed':
+        return JSONResponse({'status': job['status']}, 409)
+    return await job_video(request, job)
+
+
+@router.get('/videos/{cache_key}')
+async def cached_video(cache_key: str, request: Request):
+    """Download a cached render; supports If-None-Match and Range."""
+    path = await run_io(output_cache.get, cache_key)
+    if not path:
+        return JSONResponse({'error': 'Unknown or expired video'}, 404)
+    return send_video(request, path, cache_key, output_cache.ttl)
+
+
+@router.get('/jobs/{job_id}/stream')
+async def job_stream(job_id: str):
+    """Stream the video with chunked transfer as fragments are encoded."""
+    job = jobs.get(job_id)
+    if not job:
+        return JSONResponse({'error': 'Unknown job ID'}, 404)
+    if job['status'] == 'failed':
+        return JSONResponse({'status': 'failed', 'error': job['error']}, 500)
+    return await stream_response(job['stream'], start_timeout=STREAM_START_TIMEOUT)
+
+
+@router.get('/jobs/{job_id}/preview')
+async def job_preview(job_id: str):
+    """Stream the low-resolution preview; it is rendered before the full video."""
+    job = jobs.get(job_id)
+    if not job:
+        return JSONResponse({'error': 'Unknown job ID'}, 404)
+    if job['preview'] is None:
+        return JSONResponse({'error': 'No preview was requested for this job'}, 404)
+    return await stream_response(job['preview'], 'marketing_preview.mp4', STREAM_START_TIMEOUT)
+
+
+def parse_manifest(text, is_csv=False):
+    """Return (script or None, variants) from a JSON or CSV manifest."""
+    if is_csv:
+        rows = list(csv.DictReader(io.StringIO(text)))
+        return None, [{k.strip(): (v or '').strip() for k, v in row.items() if k} for row in rows]
+    data = json.loads(text)
+    if isinstance(data, list):
+        return None, data
+    if not isinstance(data, dict):
+        raise ValueError("expected a JSON object or a list of variants")
+    variants = data.get('variants', [])
+    if not isinstance(variants, list):
+        raise ValueError("'variants' must be a list")
+    return data.get('script'), variants
+
+
+async def batch_avatar(script):
+    """The batch's avatar video (A2E job + download), made once and shared by its variants"""
+    download = await start_avatar_video(script)
+    try:
+        with span('download'):
+            await asyncio.wrap_future(download.future())
+    except Exception:
+        download.close()
+        download.media.close()
+        raise
+    return download
+
+
+def release_batch_share(batch):
+    """Called by each variant when it finishes; the last one releases the shared media."""
+    batch['remaining'] -= 1
+    if batch['remaining']:
+        return
+    release_media(batch['media'])
+    avatar = batch['avatar']
+    if avatar.done() and not avatar.cancelled() and avatar.exception() is None:
+        avatar.result().close()
+        avatar.result().media.close()
+
+
+@router.post('/batch')
+async def batch(request: Request):
+    """Render many product/background variants around one shared avatar video.
+
+    Form fields: script, manifest (JSON or CSV file, or JSON text) and one
+    or more image files named ``images``. Each manifest variant names its
+    product_image (and optional background_image) by upload filename and may
+    set background_color.
+    """
+    form = await request.form()
+    manifest = form.get('manifest')
+    try:
+        if isinstance(manifest, UploadFile):
+            text = (await manifest.read()).decode('utf-8-sig')
+            manifest_script, variants = parse_manifest(text, (manifest.filename or '').lower().endswith('.csv'))
+        else:
+            manifest_script, variants = parse_manifest(manifest or '')
+    except (ValueError, KeyError) as e:
+        return JSONResponse({'error': f"Invalid manifest: {str(e)}"}, 400)
+    script = form.get('script') or manifest_script
+    if not script:
+        return JSONResponse({'error': 'A script is required.'}, 400)
+    if not variants:
+        return JSONResponse({'error': 'The manifest has no variants.'}, 400)
+    if len(variants) > BATCH_MAX_VARIANTS:
+        return JSONResponse({'error': f"At most {BATCH_MAX_VARIANTS} variants per batch."}, 400)
+
+    uploads = {f.filename: f for f in form.getlist('images') if isinstance(f, UploadFile) and f.filename}
+    for index, variant in enumerate(variants):
+        if not isinstance(variant, dict):
+            return JSONResponse({'error': f"Variant {index} is not an object."}, 400)
+        for field in ('product_image', 'background_image'):
+            name = variant.get(field)
+            if field == 'product_image' and not name:
+                return JSONResponse({'error': f"Variant {index} has no product_image."}, 400)
+            if name and (not isinstance(name, str) or name not in uploads or not allowed_file(name)):
+                return JSONResponse({'error': f"Variant {index}: {field} '{name}' was not uploaded as a PNG/JPG."},
+                                    400)
+
+    if render_pool.is_full('batch'):
+        logger.error("Render queue is full, rejecting batch.")
+        return JSONResponse({'error': 'Server is busy, please retry shortly.'}, 429, {'Retry-After': '10'})
+
+    # Buffer each distinct image once; variants reuse the same buffers
+    media = {}
+    for name in {v.get(f) for v in variants for f in ('product_image', 'background_image')} - {None, ''}:
+        media[name] = await buffer_upload(uploads[name])
+
+    prune_jobs()
+    batch_id = uuid.uuid4().hex
+    batch = {
+        'id': batch_id,
+        'created_at': time.time(),
+        'media': list(media.values()),
+        'remaining': len(variants),
+        'variants': [],
+    }
+    # Batch work uses the low-priority lane (provider slots, render backlog) so interactive requests go first
+    with lane('batch'):
+        batch['avatar'] = asyncio.create_task(batch_avatar(script))
+        for index, variant in enumerate(variants):
+            job = start_job(BACKENDS['a2e'], script, media[variant['product_image']],
+                            media.get(variant.get('background_image')),
+                            variant.get('background_color') or '#D3D3D3', batch=batch)
+            batch['variants'].append({'index': index, 'job_id': job['id'], 'product_image': variant['product_image']})
+    batches[batch_id] = batch
+
+    logger.info(f"Batch {batch_id} queued with {len(variants)} variants.")
+    return JSONResponse({
+        'batch_id': batch_id,
+        'status_url': f"/batch/{batch_id}",
+        'zip_url': f"/batch/{batch_id}/zip",
+        'jobs': [dict(v, status_url=f"/jobs/{v['job_id']}", result_url=f"/jobs/{v['job_id']}/result")
+                 for v in batch['variants']],
+    }, 202)
+
+
+def avatar_status(batch):
+    avatar = batch['avatar']
+    if not avatar.done():
+        return 'running'
+    return 'failed' if avatar.cancelled() or avatar.exception() else 'completed'
+
+
+@router.get('/batch/{batch_id}')
+async def batch_status(batch_id: str):
+    batch = batches.get(batch_id)
+    if not batch:
+        return JSONResponse({'error': 'Unknown batch ID'}, 404)
+    variants = []
+    for variant in batch['variants']:
+        job = jobs.get(variant['job_id']) or {'status': 'expired', 'error': None}
+        variants.append(dict(variant, status=job['status'], error=job['error']))
+    counts = {}
+    for variant in variants:
+        counts[variant['status']] = counts.get(variant['status'], 0) + 1
+    return {'batch_id': batch_id, 'avatar_status': avatar_status(batch), 'counts': counts, 'jobs': variants}
+
+
+def build_zip(finished):
+    """A MediaBuffer with every completed variant's video"""
+    archive = MediaBuffer('.zip')
+    try:
+        # mp4 is already compressed, so store entries as-is
+        with archive.open('wb') as f, zipfile.ZipFile(f, 'w', zipfile.ZIP_STORED) as zf:
+            for variant, job in finished:
+                if job and job['status'] == 'completed':
+                    stem = variant['product_image'].rsplit('.', 1)[0]
+                    with job['stream'].open('rb') as src, zf.open(f"{variant['index']:03d}_{stem}.mp4", 'w') as dst:
+                        shutil.copyfileobj(src, dst, 1024 * 1024)
+    except Exception:
+        archive.close()
+        raise
+    return archive
+
+
+@router.get('/batch/{batch_id}/zip')
+async def batch_zip(batch_id: str):
+    """Download every completed variant as one zip once the batch has finished."""
+    batch = batches.get(batch_id)
+    if not batch:
+        return JSONResponse({'error': 'Unknown batch ID'}, 404)
+    finished = [(v, jobs.get(v['job_id'])) for v in batch['variants']]
+    if any(job and job['status'] in ('queued', 'running') for _, job in finished):
+        return JSONResponse({'status': 'running'}, 409)
+    archive = await run_io(build_zip, finished)
+    return FileResponse(archive.path, media_type='application/zip', filename=f"batch_{batch_id}.zip",
+                        background=BackgroundTask(archive.close))
+
+
+@router.get('/static/styles.css')
+async def serve_css():
+    return FileResponse('styles.css')
+
+
+@router.get('/static/scripts.js')
+async def serve_js():
+    return FileResponse('scripts.js')
+
+
+@router.get('/stats/http')
+async def http_stats():
+    """Connection pool reuse and handshake counts for the shared provider client.
+
+    Status polls go through the poller's own aiohttp session and are reported under status_polls.
+    """
+    return dict(client.stats(), status_polls=poller.http_stats())
+
+
+@router.get('/stats/cache')
+async def cache_stats():
+    """Output cache hits, misses and size."""
+    return output_cache.stats()
+
+
+@router.get('/stats/jobs')
+async def job_store_stats():
+    """Recorded provider jobs by stage, and jobs reused or recovered after a restart."""
+    return await run_io(job_store.stats)
+
+
+@router.get('/stats/render')
+async def render_stats():
+    """Render pool occupancy and CPU time spent encoding."""
+    return render_pool.stats()
+
+
+@router.get('/stats')
+async def stats(request: Request):
+    return {
+        'jobs': job_counts(),
+        'render_pool': render_pool.stats(),
+        'poller': poller.stats(),
+        'backends': list(BACKENDS),
+        'default_backend': request.app.state.default_backend,
+    }
+
+
+def create_app(default_backend=DEFAULT_BACKEND, job_responses=False):
+    """Build the service app.
+
+    default_backend serves requests that don't name one; with
+    job_responses, POST / answers with the job's links (202) instead of
+    the video.
+    """
+    if default_backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {default_backend}")
+    app = FastAPI(lifespan=lifespan)
+    app.state.default_backend = default_backend
+    app.state.job_responses = job_responses
+    instrument_asgi(app)
+    register_asgi_callback_routes(app)
+    app.include_router(router)
+    return app
+
+
+app = create_app()
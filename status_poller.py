@@ -0,0 +1,348 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+
+from metrics import observe_stage
+from provider_scheduler import scheduler, RateLimited
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for a provider callback before falling back to polling
+CALLBACK_GRACE = float(os.getenv('CALLBACK_GRACE', '120'))
+# Seconds a callback for a job nobody waits on (yet) is kept
+CALLBACK_RETENTION = 600
+# Seconds between checks of the shared store for callbacks that landed on another worker
+CALLBACK_CHECK_INTERVAL = float(os.getenv('CALLBACK_CHECK_INTERVAL', '2'))
+# Seconds wait() gives the poller past a job's timeout before giving up on it
+WAIT_MARGIN = 30
+
+
+class JobFailed(Exception):
+    """The provider reported the job as failed, so it will not produce a result."""
+
+
+class StatusPoller:
+    """Polls provider job status for every waiting caller on one asyncio loop.
+
+    Each provider registers an async check function
+    ``check(session, job_id) -> (status, value)`` where status is 'pending',
+    'completed' (value is the result) or 'failed' (value is the error).
+    On every tick all due jobs are grouped per provider and checked together,
+    bounded by the provider's concurrency limit. Jobs back off independently,
+    so a long render is polled less and less often instead of every few seconds.
+
+    Providers that can call a webhook also register ``parse_callback(payload)
+    -> (job_id, status, value)``. Jobs tracked with ``callback=True`` are not
+    polled at all until callback_grace has passed; resolve_callback() finishes
+    them as soon as the provider reports in, and polling only picks up jobs
+    whose callback is overdue. With share_callbacks(), callbacks are also
+    saved to a store shared by the worker processes, and waiting jobs check
+    it every CALLBACK_CHECK_INTERVAL, so a callback that landed on another
+    worker resolves them too.
+
+    Polls draw from the provider's quota in the shared ProviderScheduler but
+    never queue behind callers: without a free token the poll is pushed
+    back. A check that raises RateLimited pauses the whole provider for its
+    Retry-After without counting as a failed poll.
+
+    Polls use their own aiohttp session, not the shared requests client;
+    http_stats() reports its requests and handshakes the same way.
+    """
+
+    def __init__(self, initial_delay=1.0, max_delay=15.0, backoff=1.5, jitter=0.2, max_errors=5,
+                 callback_grace=CALLBACK_GRACE):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.jitter = jitter
+        self.max_errors = max_errors
+        self.callback_grace = callback_grace
+        self.providers = {}
+        self.pending = {}
+        self.early_callbacks = {}
+        self.counts = {'polls': 0, 'callbacks': 0, 'shared_callbacks': 0, 'fallbacks': 0, 'throttled': 0}
+        # Requests and new connections of the poll session, per host
+        self.http_hosts = {}
+        self.save_callback = None
+        self.lookup_callback = None
+        self.loop = None
+        self.wakeup = None
+        self.start_lock = threading.Lock()
+
+    def register_provider(self, name, check, max_concurrency=16, parse_callback=None, quota=None):
+        """Register (or replace) the status check and optional callback parser for a provider.
+
+        quota names the scheduler quota polls count against (default: name).
+        """
+        self.providers[name] = {'check': check, 'max_concurrency': max_concurrency,
+                                'parse_callback': parse_callback, 'quota': quota or name}
+
+    def share_callbacks(self, save, lookup):
+        """Share callback results between worker processes.
+
+        save(provider, job_id, status, value) records a callback as it
+        arrives; lookup(provider, job_id) returns a recorded (status, value)
+        or None. Both block, so they run off the poller's loop.
+        """
+        self.save_callback = save
+        self.lookup_callback = lookup
+
+    def track(self, provider, job_id, timeout=300, callback=False):
+        """Start tracking a job and return a Future resolved with its result.
+
+        With callback=True the job is expected to be resolved by a provider
+        callback and is only polled once the callback is overdue.
+        """
+        if provider not in self.providers:
+            raise ValueError(f"Unknown provider: {provider}")
+        self.start()
+        future = Future()
+        self.loop.call_soon_threadsafe(self._add, provider, job_id, timeout, future, callback)
+        return future
+
+    def wait(self, provider, job_id, timeout=300, callback=False):
+        """Block the calling thread until the job completes; return its result."""
+        # The poller times the job out itself; the margin only guards against a stalled poller thread
+        return self.track(provider, job_id, timeout, callback).result(timeout + WAIT_MARGIN)
+
+    def resolve_callback(self, provider, payload):
+        """Handle a provider webhook payload; returns the job ID it referred to."""
+        parse = self.providers.get(provider, {}).get('parse_callback')
+        if parse is None:
+            raise ValueError(f"Provider {provider} does not support callbacks")
+        job_id, status, value = parse(payload)
+        if not job_id:
+            raise ValueError("Callback does not name a job")
+        if status != 'pending':
+            if self.save_callback:
+                # For the worker waiting on the job, which may not be this one
+                self.save_callback(provider, job_id, status, value)
+            self.start()
+            self.loop.call_soon_threadsafe(self._resolve, (provider, job_id), status, value)
+        return job_id
+
+    def stats(self):
+        counts = {}
+        for provider, _ in list(self.pending):
+            counts[provider] = counts.get(provider, 0) + 1
+        return dict(self.counts, pending=len(self.pending), per_provider=counts)
+
+    def http_stats(self):
+        """Poll session counts in the shape of ProviderClient.stats(): every new connection is one handshake"""
+        hosts = {host: dict(counts, reused=max(counts['requests'] - counts['handshakes'], 0))
+                 for host, counts in list(self.http_hosts.items())}
+        handshakes = sum(h['handshakes'] for h in hosts.values())
+        sent = sum(h['requests'] for h in hosts.values())
+        return {
+            'requests': sent,
+            'handshakes': handshakes,
+            'reuse_ratio': round(1 - handshakes / sent, 3) if sent else 0.0,
+            'hosts': hosts,
+        }
+
+    async def _on_request_start(self, session, context, params):
+        url = params.url
+        context.host = f"{url.scheme}://{url.host}:{url.port}"
+        counts = self.http_hosts.setdefault(context.host, {'requests': 0, 'handshakes': 0})
+        counts['requests'] += 1
+
+    async def _on_connection_created(self, session, context, params):
+        self.http_hosts[context.host]['handshakes'] += 1
+
+    def start(self):
+        with self.start_lock:
+            if self.loop:
+                return
+            ready = threading.Event()
+            threading.Thread(target=self._thread_main, args=(ready,), name='status-poller', daemon=True).start()
+            ready.wait()
+
+    def _thread_main(self, ready):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.wakeup = asyncio.Event()
+        ready.set()
+        self.loop.run_until_complete(self._run())
+
+    def _add(self, provider, job_id, timeout, future, callback=False):
+        key = (provider, job_id)
+        now = time.monotonic()
+        entry = self.pending.get(key)
+        if entry:
+            # Several callers waiting on the same job share one poll schedule; each keeps its own timeout
+            entry['futures'][future] = now + timeout
+            entry['deadline'] = max(entry['deadline'], now + timeout)
+            self.wakeup.set()
+            return
+        self.pending[key] = {
+            # Future -> its caller's deadline
+            'futures': {future: now + timeout},
+            # Callback jobs are polled once the callback is overdue, at the latest halfway to the deadline
+            'next_poll': now + min(self.callback_grace, timeout / 2) if callback else now,
+            'delay': self.initial_delay,
+            'deadline': now + timeout,
+            'errors': 0,
+            'polls': 0,
+            'callback': callback,
+            # Next look in the shared callback store
+            'next_check': now + CALLBACK_CHECK_INTERVAL if callback and self.lookup_callback else None,
+        }
+        early = self.early_callbacks.pop(key, None)
+        if early:
+            # The provider called back before the caller started waiting
+            self._resolve(key, early[0], early[1])
+            return
+        self.wakeup.set()
+
+    def _resolve(self, key, status, value):
+        self.counts['callbacks'] += 1
+        if key not in self.pending:
+            now = time.monotonic()
+            self.early_callbacks = {k: v for k, v in self.early_callbacks.items()
+                                    if v[2] > now - CALLBACK_RETENTION}
+            self.early_callbacks[key] = (status, value, now)
+            return
+        provider, job_id = key
+        logger.info(f"{provider} job {job_id} {status} via callback after {self.pending[key]['polls']} polls")
+        if status == 'completed':
+            self._finish(key, result=value)
+        else:
+            self._finish(key, error=JobFailed(f"Video generation failed: {value}"))
+
+    def _next_delay(self, entry):
+        delay = entry['delay']
+        entry['delay'] = min(self.max_delay, delay * self.backoff)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _finish(self, key, result=None, error=None):
+        entry = self.pending.pop(key, None)
+        if not entry:
+            return
+        for future in entry['futures']:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    async def _run(self):
+        # Imported on the poller thread: aiohttp is the slowest import in the web process
+        import aiohttp
+
+        timeout = aiohttp.ClientTimeout(total=10)
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(self._on_request_start)
+        trace.on_connection_create_end.append(self._on_connection_created)
+        async with aiohttp.ClientSession(timeout=timeout, trace_configs=[trace]) as session:
+            while True:
+                now = time.monotonic()
+                due = {}
+                shared = []
+                for key, entry in list(self.pending.items()):
+                    if now >= entry['deadline']:
+                        provider, job_id = key
+                        self._finish(key, error=TimeoutError(f"Timed out waiting for {provider} job {job_id}"))
+                        continue
+                    if now >= min(entry['futures'].values()):
+                        self._expire_waiters(key, entry, now)
+                    if now >= entry['next_poll']:
+                        due.setdefault(key[0], []).append(key)
+                    elif entry['next_check'] is not None and now >= entry['next_check']:
+                        entry['next_check'] = now + CALLBACK_CHECK_INTERVAL
+                        shared.append(key)
+                if shared:
+                    await self._check_shared(shared)
+                if due:
+                    await asyncio.gather(*(self._poll_batch(session, provider, keys)
+                                           for provider, keys in due.items()))
+                    continue
+                wait = min((min(e['next_poll'], e['next_check'] or e['next_poll'], *e['futures'].values())
+                            for e in self.pending.values()), default=now + 60) - now
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=max(wait, 0))
+                except asyncio.TimeoutError:
+                    pass
+
+    def _expire_waiters(self, key, entry, now):
+        """Time out the callers whose own deadline passed; the job stays tracked for the others"""
+        provider, job_id = key
+        for future, deadline in list(entry['futures'].items()):
+            if now >= deadline:
+                del entry['futures'][future]
+                if not future.done():
+                    future.set_exception(TimeoutError(f"Timed out waiting for {provider} job {job_id}"))
+
+    async def _check_shared(self, keys):
+        """Resolve callback jobs whose callback another worker received and saved"""
+        try:
+            found = await asyncio.get_running_loop().run_in_executor(
+                None, lambda: [(key, self.lookup_callback(*key)) for key in keys])
+        except Exception as e:
+            logger.error(f"Checking shared callbacks failed: {str(e)}")
+            return
+        for key, result in found:
+            if result and key in self.pending:
+                self.counts['shared_callbacks'] += 1
+                self._resolve(key, *result)
+
+    async def _poll_batch(self, session, provider, keys):
+        config = self.providers[provider]
+        semaphore = asyncio.Semaphore(config['max_concurrency'])
+
+        async def poll(key):
+            async with semaphore:
+                await self._poll_one(session, config['check'], key, config['quota'])
+
+        await asyncio.gather(*(poll(key) for key in keys))
+
+    async def _poll_one(self, session, check, key, quota=None):
+        entry = self.pending.get(key)
+        if not entry:
+            return
+        provider, job_id = key
+        delay = scheduler.try_request(quota) if quota else 0
+        if delay:
+            entry['next_poll'] = time.monotonic() + delay
+            return
+        if entry['callback'] and entry['polls'] == 0:
+            self.counts['fallbacks'] += 1
+            logger.warning(f"Callback for {provider} job {job_id} is overdue, polling instead")
+        entry['polls'] += 1
+        self.counts['polls'] += 1
+        start = time.perf_counter()
+        try:
+            status, value = await check(session, job_id)
+        except RateLimited as e:
+            self.counts['throttled'] += 1
+            if quota in scheduler.quotas:
+                scheduler.throttled(quota, e.retry_after)
+            entry['next_poll'] = time.monotonic() + e.retry_after
+            return
+        except Exception as e:
+            observe_stage(f"poll.{provider}", time.perf_counter() - start, 'error', log=False)
+            entry['errors'] += 1
+            logger.error(f"Status check for {provider} job {job_id} failed: {str(e)}")
+            if entry['errors'] >= self.max_errors:
+                self._finish(key, error=e)
+                return
+            entry['next_poll'] = time.monotonic() + self._next_delay(entry)
+            return
+        observe_stage(f"poll.{provider}", time.perf_counter() - start, log=False)
+        entry['errors'] = 0
+        if status == 'completed':
+            logger.info(f"{provider} job {job_id} completed after {entry['polls']} polls")
+            self._finish(key, result=value)
+        elif status == 'failed':
+            self._finish(key, error=JobFailed(f"Video generation failed: {value}"))
+        else:
+            entry['next_poll'] = time.monotonic() + self._next_delay(entry)
+
+
+# Shared poller used by a2e_service.py, generate_video.py and service.py
+poller = StatusPoller()
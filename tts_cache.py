@@ -0,0 +1,175 @@
+import io
+import os
+import time
+import uuid
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+
+from metrics import span
+from media_buffers import MediaBuffer
+
+logger = logging.getLogger(__name__)
+
+TTS_CACHE_DIR = os.getenv('TTS_CACHE_DIR', 'tts_cache')
+TTS_CACHE_MAX_BYTES = int(os.getenv('TTS_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+# tmpfiles.org deletes uploads after 60 minutes; stop handing out the URL a bit earlier
+TMPFILES_URL_TTL = int(os.getenv('TMPFILES_URL_TTL', '3000'))
+
+
+def normalize_script(script):
+    """Normalize unicode and whitespace so trivially different scripts share an entry"""
+    return ' '.join(unicodedata.normalize('NFC', script).split())
+
+
+class AudioCache:
+    """Content-addressed on-disk cache for synthesized speech.
+
+    Entries are keyed by a hash of (normalized script, voice, output format)
+    and evicted least-recently-used once the directory exceeds max_bytes.
+    Hosted URLs for an entry (e.g. tmpfiles uploads) are remembered in memory
+    until their own expiry.
+    """
+
+    def __init__(self, directory=TTS_CACHE_DIR, max_bytes=TTS_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index = OrderedDict()
+        self.urls = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    @staticmethod
+    def key(script, voice, output_format):
+        raw = '\0'.join((normalize_script(script), voice, output_format))
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.directory, f"{key}.audio")
+
+    def get(self, key):
+        """Return the cached audio path for key, or None on a miss"""
+        path = self.path_for(key)
+        with self.lock:
+            if key not in self.index and os.path.exists(path):
+                # Written by another worker process sharing the directory
+                self._add(key, os.path.getsize(path))
+            if key in self.index and os.path.exists(path):
+                self.index.move_to_end(key)
+                self.hits += 1
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+                return path
+            if key in self.index:
+                self.total_bytes -= self.index.pop(key)
+            self.misses += 1
+            return None
+
+    def get_media(self, key, suffix='.mp3'):
+        """A MediaBuffer copy of the cached audio for key, or None on a miss.
+
+        The copy belongs to the caller (who closes it), so evicting the entry,
+        here or in another worker sharing the directory, cannot remove the
+        audio from under a render that is still queued or running.
+        """
+        path = self.get(key)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return MediaBuffer.from_stream(f, suffix)
+        except FileNotFoundError:
+            # Evicted between the lookup and the copy
+            return None
+
+    def put(self, key, data):
+        """Store audio bytes under key and return the cached path"""
+        path = self.path_for(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            if key in self.index:
+                self.total_bytes -= self.index.pop(key)
+            self._add(key, len(data))
+            self._evict()
+        return path
+
+    def get_url(self, key):
+        """Return a still-valid hosted URL for key, or None"""
+        with self.lock:
+            entry = self.urls.get(key)
+            if entry and entry[1] > time.time():
+                return entry[0]
+            self.urls.pop(key, None)
+            return None
+
+    def put_url(self, key, url, ttl=TMPFILES_URL_TTL):
+        with self.lock:
+            self.urls[key] = (url, time.time() + ttl)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.index),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'urls': len(self.urls),
+            }
+
+    def _add(self, key, size):
+        self.index[key] = size
+        self.total_bytes += size
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self.index) > 1:
+            key, size = self.index.popitem(last=False)
+            self.total_bytes -= size
+            self.urls.pop(key, None)
+            try:
+                os.remove(self.path_for(key))
+                logger.info(f"Evicted cached audio: {key}")
+            except OSError:
+                pass
+
+    def _load(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.audio'):
+                continue
+            path = os.path.join(self.directory, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name[:-len('.audio')], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._add(key, size)
+        with self.lock:
+            self._evict()
+
+
+# Shared cache used by generate_video.py and service.py
+audio_cache = AudioCache()
+
+
+def gtts_audio(script, lang='en'):
+    """MediaBuffer with the gTTS speech for script, synthesized (and cached) on a miss; the caller closes it"""
+    key = audio_cache.key(script, f'gtts:{lang}', 'mp3')
+    media = audio_cache.get_media(key)
+    if media:
+        return media
+    with span('tts'):
+        # Imported on first use: gTTS (and its deps) are slow to import at worker boot
+        from gtts import gTTS
+        buffer = io.BytesIO()
+        gTTS(text=script, lang=lang).write_to_fp(buffer)
+    audio_cache.put(key, buffer.getvalue())
+    return MediaBuffer.from_bytes(buffer.getvalue(), '.mp3')
@@ -0,0 +1,55 @@
+"""Boot-time warmup for the web apps, and the per-worker startup their lifespan runs.
+
+    gunicorn -c gunicorn.conf.py app:app
+    gunicorn -c gunicorn.conf.py appp:app
+    gunicorn -c gunicorn.conf.py service:app
+
+The apps import their heavy media libraries lazily, so importing them is
+cheap. With preload_app the gunicorn master imports the app once and
+warmup() pays the one-time costs before any worker is forked: numpy and
+PIL, resolving the ffmpeg binary and checking its encoders, and the
+provider client libraries. Workers inherit all of it through fork, so
+warmup() must stay fork-safe: no threads, sockets or child processes may be
+left running.
+
+start_worker() then starts, in each worker, what fork can't hand down: the
+job store's heartbeat and recovery thread, and the worker's render pool
+processes. The apps' lifespan (service.py) calls it once per worker, so
+it also runs under plain uvicorn.
+"""
+import os
+import sys
+import time
+import logging
+import importlib
+
+logger = logging.getLogger(__name__)
+
+# Start the render pool's processes at worker boot instead of on the first renders
+RENDER_PREWARM = os.getenv('RENDER_PREWARM', '1') == '1'
+
+
+def warmup():
+    """One-time, fork-safe warmup for whichever app is loaded; returns seconds per step"""
+    import compositor
+
+    steps = [('media', compositor.warmup)]
+    if 'status_poller' in sys.modules:
+        steps.append(('aiohttp', lambda: importlib.import_module('aiohttp')))
+    if 'service' in sys.modules:
+        steps.append(('gtts', lambda: importlib.import_module('gtts')))
+    timings = {}
+    for name, step in steps:
+        start = time.perf_counter()
+        step()
+        timings[name] = round(time.perf_counter() - start, 3)
+    logger.info(f"Warmup done: {', '.join(f'{name}={seconds}s' for name, seconds in timings.items())}")
+    return timings
+
+
+def start_worker():
+    """Per-worker startup, after fork and after the app is loaded"""
+    if 'job_store' in sys.modules:
+        sys.modules['job_store'].job_store.start()
+    if RENDER_PREWARM and 'render_pool' in sys.modules:
+        sys.modules['render_pool'].render_pool.warm()